@@ -20,7 +20,7 @@ from subprocess import Popen, PIPE
 from sanic import Sanic
 from sanic.log import logger
 from sanic_jinja2 import SanicJinja2
-from app.server.utils.database import db_setup
+from app.server.utils.database import db_setup, get_database_writer
 
 # get init arguments
 argument_parser = argparse.ArgumentParser()
@@ -71,25 +71,29 @@ async def after_server_stop(app, loop):
     app.ctx.task_queue_process.terminate()
     logger.info('TASK QUEUE TERMINATED')
 
-    Server.ctx.DB.close()
-    logger.info('DB CLOSED')
+    # commit the records still queued, there is no writer when the database setup failed
+    database_writer = get_database_writer()
+    if database_writer is not None:
+        database_writer.stop()
+    if Server.ctx.DB is not None:
+        Server.ctx.DB.close()
+        logger.info('DB CLOSED')
 
 
 # setup endpoints
 @Server.route('/')
 async def root(request):
-    from app.server.utils.database.models.images import Capture as CaptureModel, Analysis as AnalysisModel
+    from app.server.utils.reports import get_totals
 
-    captures = CaptureModel.select().count()
-    detections = AnalysisModel.select().where(AnalysisModel.detected == True).count()
-    recognition = AnalysisModel.select().where(AnalysisModel.recognized == True).count()
+    # sum of the folder summaries instead of counting every record
+    totals = get_totals()
 
     context = {
         'title': '{}: Image Recognition System to Issue Security Alerts'.format(request.app.name),
         'stats': {
-            'captures': captures,
-            'detections': detections,
-            'recognition': recognition
+            'captures': totals['captures'],
+            'detections': totals['detections'],
+            'recognition': totals['recognitions']
         }
     }
     return jinja.render('home.jinja2', request, context=context)
@@ -13,30 +13,52 @@
 #   limitations under the License.
 
 
-from os.path import join as join_path
-from peewee import fn, JOIN
-from sanic import Blueprint
-from sanic.response import raw
+import asyncio
+from datetime import datetime, timezone
+from email.utils import formatdate, parsedate_to_datetime
+from functools import partial
+import os
+from peewee import JOIN
+from sanic import Blueprint, response
+from sanic.exceptions import HeaderNotFound
+from sanic.handlers import ContentRangeHandler
 from typing import Optional
 from app.server.main import jinja
 from app.server.utils.database.models.images import Capture as CaptureModel, Analysis as AnalysisModel, Recognition as RecognitionModel
-from app.server.utils.database.models.authorized import Authorized as AuthorizedModel
+from app.server.utils.database.models.authorized import Authorized as AuthorizedModel, Person as PersonModel
+from app.server.utils.database.models.reports import ReportSummary as ReportSummaryModel
+from app.server.utils.executors import EndpointExecutor
 from app.server.utils.storage import Storage
+from app.server.utils.storage.event_recorder import capture_still
+from app.server.utils.storage.image_cache import DerivedImageCache
+from app.server.utils.storage.retention import get_storage_metrics, read_retention_report
 import json
-import math
 
 
 alert_module = Blueprint('alert_module', url_prefix='reports')
 config: dict = {}
 storage: Optional[Storage] = None
+image_cache: Optional[DerivedImageCache] = None
+reports_executor: Optional[EndpointExecutor] = None
 
 
 @alert_module.listener('before_server_start')
 async def setup_alert(app, loop):
     global config
     global storage
+    global image_cache
+    global reports_executor
     config = app.config
     storage = Storage(config.get('STORAGE_SETTINGS'))
+    # the frames recorded in video segments or archived are extracted when first needed
+    storage.missing_image = partial(capture_still, storage)
+    image_cache = DerivedImageCache(storage, config.get('IMAGE_CACHE_SETTINGS'))
+    reports_executor = EndpointExecutor('reports', config.get('ENDPOINT_SETTINGS', {}).get('REPORTS'))
+
+
+@alert_module.listener('before_server_stop')
+async def stop_alert(app, loop):
+    await loop.run_in_executor(None, reports_executor.shutdown)
 
 
 @alert_module.route('/', methods=['GET'])
@@ -44,31 +66,176 @@ async def alert_reports(request):
     context = {
         'title': '{}: Reports'.format(request.app.name),
         'data': {
-            'reports': []
+            'reports': [],
+            'pagination': {}
         }
     }
+    args = request.get_args()
 
-    reports = CaptureModel.select(
-        CaptureModel.image_folder,
-        fn.COUNT(CaptureModel.image_file).alias('images'),
-        fn.MIN(CaptureModel.datetime).alias('start'),
-        fn.MAX(CaptureModel.datetime).alias('end')
-    ).group_by(CaptureModel.image_folder).dicts()
+    reports_per_page = 10
+    after = decode_cursor(args.get('after'))
+    before = decode_cursor(args.get('before')) if after is None else None
 
-    for report in reports:
-        if report['image_folder'] == '':
-            report['image_folder'] = 'ungrouped'
+    try:
+        reports, previous_page, next_page = await reports_executor.run(get_summary_page, reports_per_page, after, before)
+    except asyncio.TimeoutError:
+        return response.json({'error': 'reports timed out'}, 503)
 
+    for report in reports:
         context['data']['reports'].append({
             'images_count': report['images'],
+            'detections_count': report['detections'],
+            'recognitions_count': report['recognitions'],
             'date_start': report['start'].strftime('%d/%m/%Y (%H:%M:%S)'),
             'date_end': report['end'].strftime('%d/%m/%Y (%H:%M:%S)'),
-            'report_url': request.app.url_for('alert_module.alert_report_details', group=report['image_folder'])
+            'report_url': request.app.url_for(
+                'alert_module.alert_report_details',
+                group=report['image_folder'] if report['image_folder'] != '' else 'ungrouped'
+            )
         })
 
+    if len(reports) > 0:
+        if previous_page:
+            context['data']['pagination']['previous'] = request.app.url_for(
+                'alert_module.alert_reports', before=encode_cursor(reports[0]['end'], reports[0]['id'])
+            )
+        if next_page:
+            context['data']['pagination']['next'] = request.app.url_for(
+                'alert_module.alert_reports', after=encode_cursor(reports[-1]['end'], reports[-1]['id'])
+            )
+    context['data']['pagination']['first'] = request.app.url_for('alert_module.alert_reports')
+
     return jinja.render('reports.jinja2', request, context=context)
 
 
+def encode_cursor(record_datetime: datetime, record_id: int):
+    return '{}_{}'.format(record_datetime.isoformat(), record_id)
+
+
+def decode_cursor(cursor: str):
+    try:
+        record_datetime, record_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(record_datetime), int(record_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def get_summary_page(reports_per_page: int, after=None, before=None):
+    """
+    Folder summaries from the most recent, starting from a keyset cursor on the last capture date and id
+    """
+    query = ReportSummaryModel.select().where(ReportSummaryModel.end.is_null(False))
+
+    if before is not None:
+        # previous page, walked backwards and turned around
+        query = query.where(
+            (ReportSummaryModel.end > before[0]) | ((ReportSummaryModel.end == before[0]) & (ReportSummaryModel.id > before[1]))
+        ).order_by(ReportSummaryModel.end, ReportSummaryModel.id)
+    else:
+        if after is not None:
+            query = query.where(
+                (ReportSummaryModel.end < after[0]) | ((ReportSummaryModel.end == after[0]) & (ReportSummaryModel.id < after[1]))
+            )
+        query = query.order_by(ReportSummaryModel.end.desc(), ReportSummaryModel.id.desc())
+
+    # one more row tells if there is another page
+    reports = list(query.limit(reports_per_page + 1).dicts())
+    more = len(reports) > reports_per_page
+    reports = reports[:reports_per_page]
+
+    if before is not None:
+        reports.reverse()
+        return reports, more, True
+
+    return reports, after is not None, more
+
+
+def get_report_page(folder: str, images_per_page: int, after=None, before=None):
+    """
+    Captures of the folder ordered by datetime and id, starting from a keyset cursor instead of an offset
+    """
+    query = CaptureModel.select(
+        CaptureModel.id,
+        CaptureModel.image_file,
+        CaptureModel.datetime,
+        AnalysisModel.id.alias('analysis_id'),
+        AnalysisModel.detected,
+        AnalysisModel.analysis_result,
+        AnalysisModel.recognized,
+    ).join(AnalysisModel, JOIN.LEFT_OUTER, on=(AnalysisModel.image_id == CaptureModel.id)).where(CaptureModel.image_folder == folder)
+
+    if before is not None:
+        # previous page, walked backwards and turned around
+        query = query.where(
+            (CaptureModel.datetime < before[0]) | ((CaptureModel.datetime == before[0]) & (CaptureModel.id < before[1]))
+        ).order_by(CaptureModel.datetime.desc(), CaptureModel.id.desc())
+    else:
+        if after is not None:
+            query = query.where(
+                (CaptureModel.datetime > after[0]) | ((CaptureModel.datetime == after[0]) & (CaptureModel.id > after[1]))
+            )
+        query = query.order_by(CaptureModel.datetime, CaptureModel.id)
+
+    # one more row tells if there is another page
+    captures = list(query.limit(images_per_page + 1).dicts())
+    more = len(captures) > images_per_page
+    captures = captures[:images_per_page]
+
+    if before is not None:
+        captures.reverse()
+        return captures, more, True
+
+    return captures, after is not None, more
+
+
+def get_recognitions(analysis_ids: list):
+    """
+    Recognitions of all the analysis with their authorized and person, in a single query
+    """
+    recognitions = {}
+    if len(analysis_ids) == 0:
+        return recognitions
+
+    query = RecognitionModel.select(
+        RecognitionModel.id,
+        RecognitionModel.analysis,
+        RecognitionModel.face_box,
+        AuthorizedModel.id,
+        AuthorizedModel.person,
+        AuthorizedModel.identity,
+        PersonModel.id,
+        PersonModel.name
+    ).join(
+        AuthorizedModel, JOIN.LEFT_OUTER, on=(AuthorizedModel.recognition == RecognitionModel.id), attr='authorized'
+    ).join(
+        PersonModel, JOIN.LEFT_OUTER, on=(AuthorizedModel.person == PersonModel.id)
+    ).where(RecognitionModel.analysis.in_(analysis_ids)).order_by(RecognitionModel.id)
+
+    for recognition in query:
+        recognitions.setdefault(recognition.analysis_id, []).append(recognition)
+    return recognitions
+
+
+def get_image_sizes(folder: str, images: list):
+    """
+    Size of the original captures, the page shows thumbnails and scales the boxes with it
+    """
+    sizes = {}
+    for image in images:
+        try:
+            sizes[image] = list(image_cache.image_size(image_cache.source_path(folder, image)))
+        except (FileNotFoundError, OSError):
+            sizes[image] = None
+    return sizes
+
+
+def get_report_details(folder: str, images_per_page: int, after=None, before=None):
+    report_details, previous_page, next_page = get_report_page(folder, images_per_page, after, before)
+    recognitions = get_recognitions([detail['analysis_id'] for detail in report_details if detail['analysis_id']])
+    image_sizes = get_image_sizes(folder, [detail['image_file'] for detail in report_details])
+    return report_details, previous_page, next_page, recognitions, image_sizes
+
+
 @alert_module.route('/<group:str>', methods=['GET'])
 async def alert_report_details(request, group: str):
     folder = group if group not in ['', 'ungrouped'] else ''
@@ -77,30 +244,27 @@ async def alert_report_details(request, group: str):
         'data': {
             'group': folder,
             'images': [],
-            'pagination': []
+            'pagination': {}
         }
     }
     args = request.get_args()
 
     images_per_page = 10
-    current_page = int(args.get('page', default=1))
-    if current_page <= 0:
-        current_page = 1
-    context['data']['current_page'] = current_page
+    after = decode_cursor(args.get('after'))
+    before = decode_cursor(args.get('before')) if after is None else None
 
-    report_details = CaptureModel.select(
-        CaptureModel.image_file,
-        CaptureModel.datetime,
-        AnalysisModel.id.alias('analysis_id'),
-        AnalysisModel.detected,
-        AnalysisModel.analysis_result,
-        AnalysisModel.recognized,
-    ).join(AnalysisModel, JOIN.LEFT_OUTER, on=(AnalysisModel.image_id == CaptureModel.id)).where(CaptureModel.image_folder == folder).paginate(current_page, images_per_page).dicts()
+    try:
+        report_details, previous_page, next_page, recognitions, image_sizes = await reports_executor.run(
+            get_report_details, folder, images_per_page, after, before
+        )
+    except asyncio.TimeoutError:
+        return response.json({'error': 'report timed out'}, 503)
 
     for detail in report_details:
         image_details = {
             'image_file': detail['image_file'],
             'datetime': detail['datetime'].strftime('%d/%m/%Y (%H:%M:%S)'),
+            'image_size': json.dumps(image_sizes.get(detail['image_file'])),
             'analysis_box': [],
             'recognitions': []
         }
@@ -110,34 +274,110 @@ async def alert_report_details(request, group: str):
                 ymin, xmin, ymax, xmax = box['bounding_box']
                 image_details['analysis_box'].append([xmin, ymin, xmax, ymax])
 
-        recognitions = RecognitionModel.select().where(RecognitionModel.analysis == detail['analysis_id'])
-        for recognition in recognitions:
-            face_box = json.loads(recognition.face_box)
-            authorized = AuthorizedModel.get_or_none(recognition=recognition)
+        for recognition in recognitions.get(detail['analysis_id'], []):
+            authorized = recognition.authorized
             if authorized:
                 image_details['recognitions'].append({
-                    'face_box': face_box,
-                    'name': '{}'.format('unknown {}'.format(authorized.id) if not authorized.person else authorized.person.name),
-                    'recognized': json.dumps(False if not authorized.person else True),
+                    'face_box': json.loads(recognition.face_box),
+                    'name': authorized.display_name,
+                    'recognized': json.dumps(False if not authorized.person_id else True),
                     'record': recognition.id
                 })
 
         context['data']['images'].append(image_details)
 
-    records = CaptureModel.select().where(CaptureModel.image_folder == folder).count()
-    for page in list(range(1, (math.ceil(records / images_per_page) + 1))):
-        context['data']['pagination'].append({
-            'number': page,
-            'url': request.app.url_for('alert_module.alert_report_details', group=group, page=page)
-        })
+    if len(report_details) > 0:
+        if previous_page:
+            first = report_details[0]
+            context['data']['pagination']['previous'] = request.app.url_for(
+                'alert_module.alert_report_details', group=group, before=encode_cursor(first['datetime'], first['id'])
+            )
+        if next_page:
+            last = report_details[-1]
+            context['data']['pagination']['next'] = request.app.url_for(
+                'alert_module.alert_report_details', group=group, after=encode_cursor(last['datetime'], last['id'])
+            )
+    context['data']['pagination']['first'] = request.app.url_for('alert_module.alert_report_details', group=group)
 
     return jinja.render('report_detail.jinja2', request, context=context)
 
 
+def get_cached_image(folder: str, image: str, rendition: Optional[str]):
+    """
+    Path and stats of the capture or its rendition, None if the capture doesn't exist
+    """
+    try:
+        image_path = image_cache.get_path(folder, image, rendition)
+        return image_path, os.stat(image_path)
+    except FileNotFoundError:
+        return None, None
+
+
+def not_modified(request, etag: str, modified: datetime):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        return etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since is not None:
+        try:
+            return modified.replace(microsecond=0) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+
 @alert_module.route('/captured_image', methods=['GET'])
 async def captured_image(request):
     args = request.get_args()
     image_folder = args.get('folder', default='')
     image_name = args.get('image')
-    image = open(join_path(storage.CAPTURE_PATH, image_folder, image_name), 'rb')
-    return raw(image.read(), content_type='image/jpeg')
+    # 'thumbnail', 'collage' or the original when missing
+    rendition = args.get('size')
+    if not image_name:
+        return response.json({'error': 'image is required'}, 400)
+
+    try:
+        image_path, image_stats = await reports_executor.run(get_cached_image, image_folder, image_name, rendition)
+    except asyncio.TimeoutError:
+        return response.json({'error': 'image timed out'}, 503)
+    if image_path is None:
+        return response.json({'error': 'image not found'}, 404)
+
+    modified = datetime.fromtimestamp(image_stats.st_mtime, timezone.utc)
+    etag = '"{:x}-{:x}"'.format(image_stats.st_mtime_ns, image_stats.st_size)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': formatdate(image_stats.st_mtime, usegmt=True),
+        'Cache-Control': 'private, max-age=0, must-revalidate',
+        'Accept-Ranges': 'bytes'
+    }
+
+    if not_modified(request, etag, modified):
+        return response.empty(status=304, headers=headers)
+
+    try:
+        content_range = ContentRangeHandler(request, image_stats)
+    except HeaderNotFound:
+        content_range = None
+
+    # read in chunks without blocking the server loop
+    return await response.file_stream(image_path, mime_type='image/jpeg', headers=headers, _range=content_range)
+
+
+def get_storage_status():
+    return {
+        'metrics': get_storage_metrics(storage),
+        'last_retention': read_retention_report(storage, config.get('RETENTION_SETTINGS'))
+    }
+
+
+@alert_module.route('/storage', methods=['GET'])
+async def storage_status(request):
+    try:
+        status = await reports_executor.run(get_storage_status)
+    except asyncio.TimeoutError:
+        return response.json({'error': 'storage status timed out'}, 503)
+
+    return response.json(status)
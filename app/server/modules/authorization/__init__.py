@@ -13,8 +13,11 @@
 #   limitations under the License.
 
 
+from datetime import datetime
 from sanic import Blueprint, response
-from app.server.utils.database.models.authorized import Person as PersonModel, Authorized as AuthorizedModel
+from app.server.utils.database.models.authorized import Person as PersonModel, Authorized as AuthorizedModel, UnknownIdentity as UnknownIdentityModel
+from app.server.utils.image_analysis.clustering import get_unknown_clustering
+from app.server.utils.image_analysis.embedding_index import get_authorized_index
 
 
 authorization_module = Blueprint('authorization_module')
@@ -45,7 +48,24 @@ async def update_authorized(request):
             if len(new_name) > 0:
                 person, created = PersonModel.get_or_create(name=new_name)
             authorized_record.person = person
+            authorized_record.update_date = datetime.now()
             authorized_record.save()
+
+            # every face of the same anonymous identity belongs to the same person
+            if authorized_record.identity_id is not None:
+                UnknownIdentityModel.update(person=person).where(UnknownIdentityModel.id == authorized_record.identity_id).execute()
+                AuthorizedModel.update(person=person, update_date=authorized_record.update_date).where(
+                    AuthorizedModel.identity == authorized_record.identity_id
+                ).execute()
+
+            authorized_index = get_authorized_index()
+            if authorized_index is not None:
+                authorized_index.update_person(authorized_record.id, person.id if person else None)
+                authorized_index.sync(force=True)
+
+            unknown_clustering = get_unknown_clustering()
+            if unknown_clustering is not None:
+                unknown_clustering.sync(force=True)
             return_msg = 'updated'
         else:
             return_error = True
@@ -13,25 +13,37 @@
 #   limitations under the License.
 
 
+import asyncio
 from datetime import datetime
+from functools import partial
 import io
-from os.path import join as join_path
+from time import monotonic
 from typing import Optional
 from sanic import Blueprint
-from sanic.response import json, raw
+from sanic.response import json, raw, stream
 from sanic.log import logger
+from app.server.main import jinja
 from app.server.utils.camera import Camera
+from app.server.utils.camera.stream_broadcaster import StreamBroadcaster
 from app.server.utils.storage import Storage
-from app.server.utils.database.models.images import Capture as CaptureModel
+from app.server.utils.storage.event_recorder import capture_still
+from app.server.utils.storage.writer import StorageWriter
+from app.server.utils.database import get_database_writer
+from app.server.utils.executors import EndpointExecutor
 from app.server.utils.image_analysis import ImageAnalysis
+from app.server.utils.reports import insert_capture
 from .motion_sensor import MotionSensor
 
 capture_module = Blueprint('capture_module')
 config: dict = {}
 camera: Optional[Camera] = None
 storage: Optional[Storage] = None
+storage_writer: Optional[StorageWriter] = None
 image_analysis: Optional[ImageAnalysis] = None
 motion_capture: Optional[MotionSensor] = None
+capture_executor: Optional[EndpointExecutor] = None
+test_image_executor: Optional[EndpointExecutor] = None
+stream_broadcaster: Optional[StreamBroadcaster] = None
 
 
 @capture_module.listener('before_server_start')
@@ -39,70 +51,162 @@ async def setup_capture(app, loop):
     global config
     global camera
     global storage
+    global storage_writer
     global image_analysis
     global motion_capture
+    global capture_executor
+    global test_image_executor
+    global stream_broadcaster
 
     config = app.config
     camera = Camera(config.get('CAMERA_SETTINGS'))
     storage = Storage(config.get('STORAGE_SETTINGS'))
-    image_analysis = ImageAnalysis(storage)
+    storage.missing_image = partial(capture_still, storage)
+    storage_writer = StorageWriter(storage, config.get('STORAGE_WRITER_SETTINGS'))
+    image_analysis = ImageAnalysis(storage, config)
+    endpoint_settings = config.get('ENDPOINT_SETTINGS', {})
+    capture_executor = EndpointExecutor('capture', endpoint_settings.get('CAPTURE'))
+    test_image_executor = EndpointExecutor('test_image', endpoint_settings.get('TEST_IMAGE'))
+    stream_broadcaster = StreamBroadcaster(camera, config.get('STREAM_SETTINGS'))
+    image_analysis.add_result_listener(stream_broadcaster.publish_overlay)
 
     logger.info('MOTION SENSOR ENABLED: {}'.format(config.get('MOTION_SENSOR_ENABLE')))
     if config.get('MOTION_SENSOR_ENABLE') is True:
-        motion_capture = MotionSensor(camera, storage, image_analysis)
+        motion_capture = MotionSensor(
+            camera, storage, image_analysis, config.get('EVENT_RECORDER_SETTINGS'), storage_writer
+        )
 
 
 @capture_module.listener('before_server_stop')
 async def stop_capture(app, loop):
     if motion_capture is not None:
-        motion_capture.stop()
+        await loop.run_in_executor(None, motion_capture.stop)
+
+    # the queued images are written before their records
+    await loop.run_in_executor(None, storage_writer.stop)
+
+    # let the workers finish the queued images
+    await loop.run_in_executor(None, capture_executor.shutdown)
+    await loop.run_in_executor(None, test_image_executor.shutdown)
+    await loop.run_in_executor(None, image_analysis.stop)
+
+
+def take_capture():
+    """
+    Capture, store and analyse a frame, returns the JPEG with the detected areas or None without camera
+    """
+    captured_frame = camera.get_frame()
+
+    if captured_frame is None:
+        return None
+
+    captured_image = camera.encode_frame(captured_frame)
+    # the name is generated, unique for concurrent captures, the record waits for the file to be durable
+    saved_image = storage_writer.submit(captured_image, storage.prepare_image('', '', camera.IMAGE_EXTENSION)).result()
+
+    # add DB record of captured image
+    capture_id = get_database_writer().submit(
+        insert_capture,
+        saved_image.get('image'),
+        saved_image.get('folder'),
+        datetime.fromtimestamp(saved_image.get('timestamp'))
+    ).result()
+
+    analysis_frame, scale = camera.prepare_analysis_frame(captured_frame)
+    result, authorized = image_analysis.image_process({
+        **saved_image, 'capture_id': capture_id, 'frame': analysis_frame, 'scale': scale
+    })
+    if len(result) > 0:
+        return image_analysis.draw_detected_area(io.BytesIO(captured_image), result, authorized).getvalue()
+
+    return captured_image
+
+
+def analyze_stored_image(image_folder: str, image_name: str):
+    with storage.open_image(image_folder, image_name) as image_file:
+        image = image_file.read()
+
+    analysis_frame, scale = camera.prepare_analysis_frame(image_analysis.decode_image(image), stored=True)
+    result, authorized = image_analysis.image_process({
+        'frame': analysis_frame,
+        'scale': scale,
+        'image': image_name,
+        'folder': image_folder
+    })
+
+    if len(result) > 0:
+        return image_analysis.draw_detected_area(io.BytesIO(image), result, authorized).getvalue()
+
+    return image
 
 
 @capture_module.route('/capture', methods=['GET'])
 async def capture(request):
-    captured_image = camera.get_image()
-
-    if captured_image is not None:
-        saved_image = storage.save_image(
-            captured_image,
-            '',
-            'capture_{}'.format(datetime.now().strftime("%d:%m:%Y_%H:%M:%S")),
-            camera.IMAGE_EXTENSION
-        )
-        saved_image['binary'] = io.BytesIO(captured_image.tobytes())
-
-        # add DB record of captured image
-        CaptureModel.insert(
-            image_file=saved_image.get('image'),
-            image_folder=saved_image.get('folder'),
-            datetime=datetime.fromtimestamp(saved_image.get('timestamp'))
-        ).execute()
-
-        result, authorized = image_analysis.image_process(saved_image)
-        if len(result) > 0:
-            captured_image = image_analysis.draw_detected_area(saved_image["binary"], result, authorized)
-            return raw(captured_image.getvalue(), content_type='image/jpeg')
-
-        return raw(captured_image.tobytes(), content_type='image/jpeg')
-    else:
+    try:
+        captured_image = await capture_executor.run(take_capture)
+    except asyncio.TimeoutError:
+        return json({'error': 'capture timed out'}, 503)
+
+    if captured_image is None:
         return json({'error': 'device not found'}, 500)
 
+    return raw(captured_image, content_type='image/jpeg')
+
 
 @capture_module.route('/test_image', methods=['GET'])
 async def test_image(request):
     args = request.get_args()
     image_folder = args.get('folder', default='')
     image_name = args.get('image')
-    image = open(join_path(storage.CAPTURE_PATH, image_folder, image_name), 'rb')
 
-    result, authorized = image_analysis.image_process({
-        'binary': image,
-        'image': image_name,
-        'folder': image_folder
-    })
+    try:
+        image = await test_image_executor.run(analyze_stored_image, image_folder, image_name)
+    except asyncio.TimeoutError:
+        return json({'error': 'analysis timed out'}, 503)
+    except FileNotFoundError:
+        return json({'error': 'image not found'}, 404)
 
-    if len(result) > 0:
-        image = image_analysis.draw_detected_area(image, result, authorized)
-        return raw(image.getvalue(), content_type='image/jpeg')
+    return raw(image, content_type='image/jpeg')
 
-    return raw(image.read(), content_type='image/jpeg')
+
+@capture_module.route('/stream', methods=['GET'])
+async def live_stream(request):
+    args = request.get_args()
+    # every viewer can ask for a lower frame rate
+    try:
+        frames_per_second = float(args.get('fps', default=stream_broadcaster.FRAMES_PER_SECOND))
+    except ValueError:
+        return json({'error': 'fps must be a number'}, 400)
+    if not frames_per_second > 0:
+        return json({'error': 'fps must be greater than 0'}, 400)
+    frames_per_second = min(frames_per_second, stream_broadcaster.FRAMES_PER_SECOND)
+
+    if not await stream_broadcaster.add_viewer():
+        return json({'error': 'stream not available'}, 503)
+
+    async def send_frames(response):
+        sequence = -1
+        try:
+            while True:
+                start = monotonic()
+                sequence, image = await stream_broadcaster.next_frame(sequence)
+                await response.write(
+                    b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: ' + str(len(image)).encode() + b'\r\n\r\n' +
+                    image + b'\r\n'
+                )
+
+                delay = 1 / frames_per_second - (monotonic() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        finally:
+            await stream_broadcaster.remove_viewer()
+
+    return stream(send_frames, content_type='multipart/x-mixed-replace; boundary=frame')
+
+
+@capture_module.route('/live', methods=['GET'])
+async def live(request):
+    context = {
+        'title': '{}: Live'.format(request.app.name)
+    }
+    return jinja.render('live.jinja2', request, context=context)
@@ -13,7 +13,7 @@
 #   limitations under the License.
 
 
-import io
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from typing import Optional
 import threading
 from signal import SIGTERM, sigwait, pthread_kill
@@ -22,25 +22,85 @@ from uuid import uuid4
 from gpiozero import MotionSensor as GPIOMotionSensor
 from sanic.log import logger
 from app.server.utils.camera import Camera
+from app.server.utils.camera.capture_engine import CaptureEngine
+from app.server.utils.camera.frame_buffer import FrameConsumer
 from app.server.utils.storage import Storage
-from app.server.utils.database.models.images import Capture as CaptureModel
+from app.server.utils.storage.event_recorder import EventRecorder, EventRecorderSettings
+from app.server.utils.storage.writer import StorageWriter
+from app.server.utils.database import get_database_writer
 from app.server.utils.image_analysis import ImageAnalysis
+from app.server.utils.image_analysis.change_filter import FrameChangeFilter
+from app.server.utils.reports import insert_capture
+
+
+class CaptureRecords:
+    """
+    Capture ids by frame sequence, the storage consumer resolves them once the record is inserted
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = {}
+        self.last_popped = -1
+
+    def get(self, sequence: int) -> Future:
+        with self.lock:
+            return self.records.setdefault(sequence, Future())
+
+    def pop(self, sequence: int) -> Future:
+        with self.lock:
+            self.last_popped = max(self.last_popped, sequence)
+            # the analysis goes in order, the frames it dropped are never asked for
+            for stale in [stale for stale in self.records if stale < sequence]:
+                del self.records[stale]
+            return self.records.pop(sequence, None) or Future()
+
+    def resolve(self, sequence: int, capture_id: Optional[int]):
+        with self.lock:
+            if sequence <= self.last_popped and sequence not in self.records:
+                return  # the analysis stopped waiting for it
+            future = self.records.setdefault(sequence, Future())
+        future.set_result(capture_id)
+
+    def attach(self, sequence: int, insert_future: Future):
+        # resolved when the database writer commits the record
+        insert_future.add_done_callback(
+            lambda future: self.resolve(sequence, future.result() if future.exception() is None else None)
+        )
 
 
 class MotionSensor:
     GPIO_PIN: int = 21
+    CAPTURE_RECORD_TIMEOUT: float = 10.0
     ACTIVITY_THREAD: Optional[threading.Thread] = None
-    CAPTURE_THREAD_EVENT: Optional[threading.Event] = None
-    CAPTURE_THREAD: Optional[threading.Thread] = None
+    CAPTURE_ENGINE: Optional[CaptureEngine] = None
+    CAPTURE_CONSUMERS: list = []
+    CAPTURE_RECORDS: Optional[CaptureRecords] = None
+    FIRST_SEQUENCE: int = 0
     CAMERA: Optional[Camera] = None
     STORAGE: Optional[Storage] = None
+    STORAGE_WRITER: Optional[StorageWriter] = None
     IMAGE_ANALYSIS: Optional[ImageAnalysis] = None
+    CHANGE_FILTER: Optional[FrameChangeFilter] = None
     SENSOR_ACTIVATION_ID: str = None
+    RECORDER: Optional[EventRecorder] = None
+    # recorders of the last activations, their analysis can still be running
+    MAX_RECORDERS: int = 2
 
-    def __init__(self, camera: Camera, storage: Storage, image_analysis: ImageAnalysis):
+    def __init__(
+        self,
+        camera: Camera,
+        storage: Storage,
+        image_analysis: ImageAnalysis,
+        recorder_settings: Optional[EventRecorderSettings] = None,
+        storage_writer: Optional[StorageWriter] = None
+    ):
         self.CAMERA = camera
         self.STORAGE = storage
+        self.STORAGE_WRITER = storage_writer if storage_writer is not None else StorageWriter(storage)
         self.IMAGE_ANALYSIS = image_analysis
+        self.RECORDER_SETTINGS = {'FRAMES_PER_SECOND': camera.FRAMES_PER_SECOND, **(recorder_settings or {})}
+        self.RECORDERS = {}
+        self.IMAGE_ANALYSIS.add_result_listener(self.keep_still)
         self.run()
 
     def sensor_activity(self):
@@ -56,38 +116,155 @@ class MotionSensor:
         now = datetime.now()
         timestamp = int(now.timestamp())
         self.SENSOR_ACTIVATION_ID = '{}_{}'.format(timestamp, str(uuid4()))
+        self.CHANGE_FILTER = self.IMAGE_ANALYSIS.create_change_filter()
+        self.CAPTURE_RECORDS = CaptureRecords()
 
-        self.CAPTURE_THREAD_EVENT = threading.Event()
-        self.CAPTURE_THREAD = threading.Thread(
-            target=self.CAMERA.continuous_capture_thread,
-            args=[self.CAPTURE_THREAD_EVENT, self.continuous_capture_callback]
-        )
-        self.CAPTURE_THREAD.start()
+        if self.RECORDER_SETTINGS.get('ENABLED'):
+            # the frames of the activation go to video segments, only the frames with detections are kept as images
+            self.RECORDER = EventRecorder(
+                self.STORAGE, self.SENSOR_ACTIVATION_ID, self.CAMERA.fit_storage_frame, self.RECORDER_SETTINGS
+            )
+            self.RECORDERS[self.SENSOR_ACTIVATION_ID] = self.RECORDER
+            for folder in list(self.RECORDERS.keys())[:-self.MAX_RECORDERS]:
+                del self.RECORDERS[folder]
+
+        self.CAPTURE_ENGINE = self.CAMERA.get_capture_engine()
+        ring_buffer = self.CAPTURE_ENGINE.acquire() if self.CAPTURE_ENGINE is not None else None
+        if ring_buffer is None:
+            logger.error('the camera device is not available')
+            self.CAPTURE_ENGINE = None
+            return
+
+        # every consumer goes at its own pace, a slow one only drops its own frames
+        self.FIRST_SEQUENCE = ring_buffer.write_sequence
+        self.CAPTURE_CONSUMERS = [
+            FrameConsumer(
+                'storage_consumer', ring_buffer, self.store_frame, self.FIRST_SEQUENCE,
+                lambda sequence: self.CAPTURE_RECORDS.resolve(sequence, None)
+            ),
+            FrameConsumer('analysis_consumer', ring_buffer, self.analyze_frame, self.FIRST_SEQUENCE)
+        ]
+        for consumer in self.CAPTURE_CONSUMERS:
+            consumer.start()
 
-    def continuous_capture_callback(self, frame, frames_count):
-        saved_image = self.STORAGE.save_image(
-            frame,
+    def store_frame(self, frame, sequence, timestamp):
+        saved_image = self.STORAGE.prepare_image(
             self.SENSOR_ACTIVATION_ID,
-            'capture_{}'.format(frames_count),
+            'capture_{}'.format(sequence - self.FIRST_SEQUENCE + 1),
             self.CAMERA.IMAGE_EXTENSION
         )
-        saved_image["binary"] = io.BytesIO(frame.tobytes())
+        saved_image['timestamp'] = int(timestamp)
+        # the next activation replaces the records, the writes of this one can still be pending
+        records = self.CAPTURE_RECORDS
+        segment, frame_index, write_future = None, None, None
+
+        try:
+            if self.RECORDER is not None:
+                segment, frame_index = self.RECORDER.write(frame, saved_image.get('image'), timestamp)
+            else:
+                write_future = self.STORAGE_WRITER.submit(self.CAMERA.encode_frame(frame), saved_image)
+        except Exception as e:
+            logger.error('error storing {}: {}'.format(saved_image.get('image'), e))
+            records.resolve(sequence, None)
+            return
+
+        if write_future is None:
+            self.record_capture(records, sequence, saved_image, timestamp, segment, frame_index)
+            return
+
+        # the record is inserted only once the image is durable
+        write_future.add_done_callback(
+            lambda future: self.image_stored(future, records, sequence, saved_image, timestamp)
+        )
+
+    def image_stored(self, future: Future, records: CaptureRecords, sequence: int, saved_image: dict, timestamp: float):
+        if future.exception() is not None:
+            logger.error('error storing {}: {}'.format(saved_image.get('image'), future.exception()))
+            records.resolve(sequence, None)
+            return
+
+        self.record_capture(records, sequence, saved_image, timestamp)
+
+    @staticmethod
+    def record_capture(
+        records: CaptureRecords,
+        sequence: int,
+        saved_image: dict,
+        timestamp: float,
+        segment: str = None,
+        frame_index: int = None
+    ):
+        # add DB record of captured image, the consecutive frames are committed together
+        records.attach(sequence, get_database_writer().submit(
+            insert_capture,
+            saved_image.get('image'),
+            saved_image.get('folder'),
+            datetime.fromtimestamp(timestamp),
+            segment,
+            frame_index
+        ))
+
+    def keep_still(self, result: dict):
+        # listener of the analysis results, the frames with detections are also saved as images
+        recorder = self.RECORDERS.get(result.get('folder'))
+        if recorder is not None and len(result.get('objects', [])) > 0:
+            recorder.keep_still(result.get('image'))
+
+    def analyze_frame(self, frame, sequence, timestamp):
+        # the analysis works on a smaller copy, made once for the filter and the detection
+        analysis_frame, scale = self.CAMERA.prepare_analysis_frame(frame)
+
+        # nearly identical frames are not worth the full analysis
+        analyze, change = self.CHANGE_FILTER.check(analysis_frame)
 
-        # add DB record of captured image
-        CaptureModel.insert(
-            image_file=saved_image.get('image'),
-            image_folder=saved_image.get('folder'),
-            datetime=datetime.fromtimestamp(saved_image.get('timestamp'))
-        ).execute()
+        try:
+            capture_id = self.CAPTURE_RECORDS.get(sequence).result(self.CAPTURE_RECORD_TIMEOUT)
+        except FutureTimeoutError:
+            capture_id = None
+        finally:
+            self.CAPTURE_RECORDS.pop(sequence)
 
-        self.IMAGE_ANALYSIS.add_to_queue([saved_image])
+        if capture_id is None:
+            # the frame wasn't stored, there is nothing to attach the analysis to
+            return
+
+        if not analyze:
+            self.IMAGE_ANALYSIS.skip(capture_id, change)
+            return
+
+        image_data = {
+            'folder': self.SENSOR_ACTIVATION_ID,
+            'image': 'capture_{}{}'.format(sequence - self.FIRST_SEQUENCE + 1, self.CAMERA.IMAGE_EXTENSION),
+            'timestamp': int(timestamp),
+            # the persons are tracked across the frames of the capture
+            'frame_time': timestamp,
+            'capture_id': capture_id,
+            'frame': analysis_frame,
+            'scale': scale
+        }
+
+        # blocks the consumer while the analysis workers are full
+        if not self.IMAGE_ANALYSIS.add_to_queue([image_data]):
+            logger.warning('analysis queue full, {} will not be analysed'.format(image_data.get('image')))
 
     def sensor_off(self):
         logger.info('SENSOR QUIET')
 
-        if self.CAPTURE_THREAD_EVENT:
-            self.CAPTURE_THREAD_EVENT.set()
-            self.CAPTURE_THREAD.join()
+        if self.CAPTURE_ENGINE is not None:
+            self.CAPTURE_ENGINE.release()
+            logger.info('capture: {}'.format(self.CAPTURE_ENGINE.stats()))
+            self.CAPTURE_ENGINE = None
+
+        # the consumers finish the frames left in the buffer
+        for consumer in self.CAPTURE_CONSUMERS:
+            consumer.stop()
+            consumer.join()
+            logger.info('capture consumer: {}'.format(consumer.stats()))
+        self.CAPTURE_CONSUMERS = []
+
+        if self.RECORDER is not None:
+            self.RECORDER.close()
+            self.RECORDER = None
 
     def run(self):
         self.ACTIVITY_THREAD = threading.Thread(target=self.sensor_activity, args=[])
@@ -96,3 +273,6 @@ class MotionSensor:
     def stop(self):
         if self.ACTIVITY_THREAD is not None:
             pthread_kill(self.ACTIVITY_THREAD.ident, SIGTERM)
+
+        # write the pending frames
+        self.sensor_off()
@@ -28,9 +28,10 @@ def send_mail(smtp_config, sender, destination, subject, body, collage_image, re
     message["To"] = ", ".join(destination)
     message.attach(MIMEText(body.get('TEXT', ''), 'plain'))
     message.attach(MIMEText(body.get('HTML', ''), 'html'))
-    img = MIMEImage(collage_image.getvalue())
-    img.add_header('Content-Disposition', 'attachment', filename='motion_detected.jpg')
-    message.attach(img)
+    if collage_image is not None:
+        img = MIMEImage(collage_image.getvalue())
+        img.add_header('Content-Disposition', 'attachment', filename='motion_detected.jpg')
+        message.attach(img)
 
     try:
         server = smtplib.SMTP(smtp_config.get('SMTP_ADDRESS'), smtp_config.get('SMTP_PORT'))
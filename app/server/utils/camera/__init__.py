@@ -13,34 +13,66 @@
 #   limitations under the License.
 
 
-from typing import Optional, Callable
+from functools import partial
+from typing import Optional
 import cv2 as cv
+import numpy as np
 import os
 import re
-from time import sleep
-import threading
+import subprocess
+from .capture_engine import CaptureEngine
+from .jpeg_encoders import get_jpeg_encoder
 from .suppress_output import SuppressOutput
 
 
+class EncodingSettings(dict):
+    QUALITY: int = None
+    SIZE: list = None
+
+
 class CameraSettings(dict):
     DEVICES_PATH: str = None
     PREFERRED_DEVICE: int = None
     DEVICE_BUFFER: int = None
     DEVICE_AVOID_GRAB: int = None
+    FRAME_BUFFER_SIZE: int = None
+    CAPTURE_RESOLUTION: list = None
+    ANALYSIS_RESOLUTION: list = None
+    ENCODER: str = None
+    ROTATION: int = None
+    ROTATION_METHOD: str = None
+    ENCODING: dict = None
 
 
 class Camera:
     API_CONTROL: int = cv.CAP_V4L2
     IMAGE_EXTENSION: str = '.jpg'
-    ENCODE_PARAMETERS: list = [int(cv.IMWRITE_JPEG_QUALITY), 85]
     FRAMES_PER_SECOND: int = 16
+    ROTATIONS: dict = {90: cv.ROTATE_90_CLOCKWISE, 180: cv.ROTATE_180, 270: cv.ROTATE_90_COUNTERCLOCKWISE}
+    # v4l2 controls able to turn the image on the sensor, tried in order
+    DEVICE_ROTATION_CONTROLS: dict = {
+        90: [{'rotate': 90}],
+        180: [{'rotate': 180}, {'horizontal_flip': 1, 'vertical_flip': 1}],
+        270: [{'rotate': 270}]
+    }
+    DEFAULT_ENCODING: dict = {'QUALITY': 85, 'SIZE': None}
 
     def __init__(self, camera_settings: Optional[CameraSettings]):
         self.DEVICES_PATH = camera_settings.get('DEVICES_PATH')
         self.PREFERRED_DEVICE = camera_settings.get('PREFERRED_DEVICE')
         self.DEVICE_BUFFER = camera_settings.get('DEVICE_BUFFER')
         self.DEVICE_AVOID_GRAB = camera_settings.get('DEVICE_AVOID_GRAB')
+        self.FRAME_BUFFER_SIZE = camera_settings.get('FRAME_BUFFER_SIZE')
+        self.CAPTURE_RESOLUTION = camera_settings.get('CAPTURE_RESOLUTION', [1280, 960])
+        self.ANALYSIS_RESOLUTION = camera_settings.get('ANALYSIS_RESOLUTION')
+        self.ROTATION = camera_settings.get('ROTATION', 180)
+        self.ROTATION_METHOD = camera_settings.get('ROTATION_METHOD', 'copy')
+        self.ENCODING = camera_settings.get('ENCODING', {})
+        self.ENCODER = get_jpeg_encoder(camera_settings.get('ENCODER'))
+        # rotation left to do on every frame of each device, None when the device does it
+        self.DEVICE_ROTATIONS = {}
         self.AVAILABLE_DEVICES = self.get_available_devices()
+        self.CAPTURE_ENGINES = {}
 
     def get_device(self, index):
         camera_info = None
@@ -51,9 +83,7 @@ class Camera:
 
                 if camera_device.isOpened():
                     camera_info = camera_device
-                    # TODO: move to config
-                    width = 1280
-                    height = 960
+                    width, height = self.CAPTURE_RESOLUTION
                     camera_info.set(cv.CAP_PROP_FRAME_WIDTH, width)
                     camera_info.set(cv.CAP_PROP_FRAME_HEIGHT, height)
                     camera_info.set(cv.CAP_PROP_AUTOFOCUS, False)
@@ -61,8 +91,45 @@ class Camera:
             except Exception as e:
                 pass
 
+        if camera_info is not None:
+            self.DEVICE_ROTATIONS[index] = self.setup_rotation(index)
+
         return camera_info
 
+    def setup_rotation(self, index: int):
+        """
+        Rotate on the device when possible, returns the rotation still needed on the frames
+        """
+        rotation = self.ROTATIONS.get(self.ROTATION)
+        if rotation is None or self.ROTATION_METHOD != 'device':
+            return rotation
+
+        for controls in self.DEVICE_ROTATION_CONTROLS.get(self.ROTATION, []):
+            if self.set_device_controls(index, controls):
+                return None
+
+        print('device {} can\'t rotate its image, the frames will be rotated'.format(index))
+        return rotation
+
+    @staticmethod
+    def set_device_controls(index: int, controls: dict):
+        device = '/dev/video{}'.format(index)
+        try:
+            subprocess.run(
+                ['v4l2-ctl', '-d', device, '--set-ctrl={}'.format(','.join('{}={}'.format(*c) for c in controls.items()))],
+                check=True, capture_output=True, timeout=5
+            )
+            # unknown controls aren't an error on every version, read them back
+            result = subprocess.run(
+                ['v4l2-ctl', '-d', device, '--get-ctrl={}'.format(','.join(controls.keys()))],
+                check=True, capture_output=True, timeout=5, text=True
+            )
+        except (OSError, subprocess.SubprocessError):
+            return False
+
+        values = dict(line.replace(' ', '').split(':', 1) for line in result.stdout.splitlines() if ':' in line)
+        return all(values.get(control) == str(value) for control, value in controls.items())
+
     def get_available_devices(self):
         devices = []
         os_devices = os.listdir(self.DEVICES_PATH)
@@ -93,7 +160,100 @@ class Camera:
 
         return device.get('control')
 
-    def get_image(self, device_idx: int = None):
+    @staticmethod
+    def prepare_frame(frame, destination=None, rotation: Optional[int] = cv.ROTATE_180):
+        if destination is not None:
+            if rotation is None:
+                np.copyto(destination, frame)
+                return destination
+            return cv.rotate(frame, rotation, destination)
+
+        # frames are shared between the analysis and the storage, nobody must modify them
+        if rotation is not None:
+            frame = cv.rotate(frame, rotation)
+        frame.setflags(write=False)
+        return frame
+
+    def get_rotation(self, device_idx: int):
+        return self.DEVICE_ROTATIONS.get(device_idx, self.ROTATIONS.get(self.ROTATION))
+
+    def get_frame_preparation(self, device_idx: int):
+        return partial(self.prepare_frame, rotation=self.get_rotation(device_idx))
+
+    def encode_frame(self, frame, stream: str = 'STORAGE') -> bytes:
+        """
+        JPEG bytes of the frame with the quality and size of the stream, 'STORAGE' or 'STREAM'
+        """
+        encoding = self.ENCODING.get(stream, self.DEFAULT_ENCODING)
+        frame = self.fit_frame(frame, encoding.get('SIZE'))
+        return self.ENCODER.encode(frame, encoding.get('QUALITY', self.DEFAULT_ENCODING['QUALITY']))
+
+    @staticmethod
+    def fit_size(frame_shape: tuple, size: Optional[list]):
+        """
+        (width, height) of the frame scaled down inside the size keeping the aspect ratio
+        """
+        height, width = frame_shape[:2]
+        scale = min(1, size[0] / width, size[1] / height) if size is not None else 1
+        return round(width * scale), round(height * scale)
+
+    @staticmethod
+    def fit_frame(frame, size: Optional[list]):
+        width, height = Camera.fit_size(frame.shape, size)
+        if (width, height) == (frame.shape[1], frame.shape[0]):
+            return frame
+        return cv.resize(frame, (width, height), interpolation=cv.INTER_AREA)
+
+    def fit_storage_frame(self, frame):
+        return self.fit_frame(frame, self.ENCODING.get('STORAGE', self.DEFAULT_ENCODING).get('SIZE'))
+
+    def get_storage_size(self, frame_shape: tuple):
+        return self.fit_size(frame_shape, self.ENCODING.get('STORAGE', self.DEFAULT_ENCODING).get('SIZE'))
+
+    def prepare_analysis_frame(self, frame, stored: bool = False):
+        """
+        Copy of the frame at the analysis resolution, with the (x, y) scale from its coordinates to the stored image ones.
+        A stored frame was decoded from the stored image.
+        """
+        analysis_frame = self.fit_frame(frame, self.ANALYSIS_RESOLUTION)
+        if analysis_frame is not frame:
+            analysis_frame.setflags(write=False)
+
+        storage_width, storage_height = (frame.shape[1], frame.shape[0]) if stored else self.get_storage_size(frame.shape)
+        return analysis_frame, (storage_width / analysis_frame.shape[1], storage_height / analysis_frame.shape[0])
+
+    def get_capture_engine(self, device_idx: int = None):
+        """
+        The engine is shared, every user of the device frames must acquire and release it
+        """
+        device_idx = device_idx if device_idx is not None else self.PREFERRED_DEVICE
+        device_control = self.get_device_control(device_idx)
+
+        if device_control is None:
+            return None
+
+        if device_idx not in self.CAPTURE_ENGINES:
+            self.CAPTURE_ENGINES[device_idx] = CaptureEngine(
+                device_control,
+                self.get_frame_preparation(device_idx),
+                self.FRAMES_PER_SECOND,
+                self.FRAME_BUFFER_SIZE,
+                self.DEVICE_AVOID_GRAB,
+                # without rotation the device writes straight into the buffer
+                self.get_rotation(device_idx) is None
+            )
+
+        return self.CAPTURE_ENGINES[device_idx]
+
+    def get_frame(self, device_idx: int = None):
+        device_idx = device_idx if device_idx is not None else self.PREFERRED_DEVICE
+        capture_engine = self.CAPTURE_ENGINES.get(device_idx)
+
+        # the device can't be read from two threads, take the last frame of the running engine
+        if capture_engine is not None and capture_engine.running:
+            latest = capture_engine.ring_buffer.latest()
+            return latest[0] if latest is not None else None
+
         device_control = self.get_device_control(device_idx)
         grab = None
         frame = None
@@ -103,36 +263,6 @@ class Camera:
                 grab = device_control.grab()  # avoid buffer
 
             _, frame = device_control.retrieve(grab)
-            _, frame = cv.imencode(self.IMAGE_EXTENSION, cv.rotate(frame, cv.ROTATE_180), self.ENCODE_PARAMETERS)
+            frame = self.get_frame_preparation(device_idx)(frame)
 
         return frame
-
-    def continuous_capture_thread(self, event_control: threading.Event, capture_callback: Callable[[list, int], None] = None, device_idx: int = None):
-        device_control = self.get_device_control(device_idx)
-
-        if device_control is not None:
-            global_frames_count = 0
-
-            for i in range(self.DEVICE_AVOID_GRAB):
-                device_control.grab()  # avoid buffer
-
-            while not event_control.isSet():
-                frame_counter = 0
-                frame_time = float(1/self.FRAMES_PER_SECOND)
-
-                while frame_counter < self.FRAMES_PER_SECOND:
-                    frame_counter += 1
-                    global_frames_count += 1
-                    grab = device_control.grab()
-                    _, frame = device_control.retrieve(grab)
-                    _, frame = cv.imencode(self.IMAGE_EXTENSION, cv.rotate(frame, cv.ROTATE_180), self.ENCODE_PARAMETERS)
-                    if frame is not None and capture_callback is not None:
-                        capture_callback(frame, global_frames_count)
-                    else:
-                        print('--CAPTURE ERROR--')
-
-                    # check if the sensor turns off while taking photos
-                    if event_control.isSet():
-                        break
-
-                    sleep(frame_time)
@@ -0,0 +1,133 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import threading
+from time import monotonic, sleep, time
+from typing import Callable, Optional
+from .frame_buffer import FrameRingBuffer
+
+
+class CaptureEngine:
+    """
+    Grabs frames from a device into a ring buffer at a steady rate, while somebody uses it
+    """
+    def __init__(
+        self,
+        device_control,
+        prepare_frame: Callable,
+        frames_per_second: int,
+        buffer_size: int,
+        avoid_grab: int = 0,
+        retrieve_in_slot: bool = False
+    ):
+        self.device_control = device_control
+        self.prepare_frame = prepare_frame
+        self.FRAMES_PER_SECOND = frames_per_second
+        self.BUFFER_SIZE = buffer_size
+        self.AVOID_GRAB = avoid_grab
+        self.RETRIEVE_IN_SLOT = retrieve_in_slot
+        self.ring_buffer: Optional[FrameRingBuffer] = None
+        self.lock = threading.Lock()
+        self.users = 0
+        self.thread: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+        self.captured = 0
+        self.failed = 0
+        self.late = 0
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def warm_up(self):
+        for i in range(self.AVOID_GRAB):
+            self.device_control.grab()  # avoid buffer
+
+        # the buffer is shaped after the frames really given by the device
+        self.device_control.grab()
+        _, frame = self.device_control.retrieve()
+        if frame is None:
+            return False
+
+        shape = self.prepare_frame(frame).shape
+        if self.ring_buffer is None or self.ring_buffer.SHAPE != shape:
+            self.ring_buffer = FrameRingBuffer(self.BUFFER_SIZE, shape)
+        return True
+
+    def acquire(self):
+        with self.lock:
+            self.users += 1
+            if self.users == 1:
+                if not self.warm_up():
+                    self.users -= 1
+                    return None
+
+                self.stop_event.clear()
+                self.thread = threading.Thread(target=self.run, name='capture')
+                self.thread.daemon = True
+                self.thread.start()
+
+        return self.ring_buffer
+
+    def release(self):
+        with self.lock:
+            self.users = max(0, self.users - 1)
+            if self.users == 0 and self.thread is not None:
+                self.stop_event.set()
+                self.thread.join()
+                self.thread = None
+
+    def run(self):
+        period = 1 / self.FRAMES_PER_SECOND
+        next_frame_time = monotonic()
+        retrieve_buffer = None
+
+        while not self.stop_event.is_set():
+            grabbed = self.device_control.grab()
+            timestamp = time()
+
+            if self.RETRIEVE_IN_SLOT:
+                slot = self.ring_buffer.next_slot() if grabbed else None
+                _, retrieve_buffer = self.device_control.retrieve(slot) if grabbed else (False, None)
+                if retrieve_buffer is not None and retrieve_buffer is not slot:
+                    # the device changed the frame shape or type, copy it
+                    self.prepare_frame(retrieve_buffer, slot)
+            else:
+                # the retrieve buffer is reused between frames
+                _, retrieve_buffer = self.device_control.retrieve(retrieve_buffer) if grabbed else (False, None)
+                if retrieve_buffer is not None:
+                    # rotate straight into the buffer slot
+                    self.prepare_frame(retrieve_buffer, self.ring_buffer.next_slot())
+
+            if retrieve_buffer is not None:
+                self.ring_buffer.publish(timestamp)
+                self.captured += 1
+            else:
+                self.failed += 1
+                print('--CAPTURE ERROR--')
+
+            # paced against a monotonic clock, the time spent grabbing is part of the period
+            next_frame_time += period
+            delay = next_frame_time - monotonic()
+            if delay > 0:
+                sleep(delay)
+            else:
+                self.late += 1
+                if delay < -period:
+                    # too late to catch up, start counting again from now
+                    next_frame_time = monotonic()
+
+    def stats(self):
+        return {'captured': self.captured, 'failed': self.failed, 'late': self.late}
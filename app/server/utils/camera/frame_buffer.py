@@ -0,0 +1,152 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import numpy as np
+import threading
+from typing import Callable, Optional
+from sanic.log import logger
+
+
+class FrameRingBuffer:
+    """
+    Fixed-size preallocated frames written by a single producer, each consumer keeps its own position.
+
+    Readers never take a lock: every slot records the sequence number of the frame it holds and the
+    reader checks it again after copying, if the producer overwrote the slot meanwhile the frame is dropped.
+    """
+    def __init__(self, capacity: int, shape: tuple, dtype=np.uint8):
+        self.CAPACITY = capacity
+        self.SHAPE = tuple(shape)
+        self.frames = np.empty((capacity, *shape), dtype=dtype)
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.sequences = np.full(capacity, -1, dtype=np.int64)
+        # sequence of the next frame to write, every lower sequence is already published
+        self.write_sequence = 0
+        self.new_frame = threading.Condition()
+
+    def next_slot(self):
+        """
+        Slot where the producer writes the next frame, it is invalid for the readers until published
+        """
+        index = self.write_sequence % self.CAPACITY
+        self.sequences[index] = -1
+        return self.frames[index]
+
+    def publish(self, timestamp: float):
+        index = self.write_sequence % self.CAPACITY
+        self.timestamps[index] = timestamp
+        self.sequences[index] = self.write_sequence
+        self.write_sequence += 1
+
+        with self.new_frame:
+            self.new_frame.notify_all()
+
+    def oldest_sequence(self):
+        return max(0, self.write_sequence - self.CAPACITY + 1)
+
+    def read(self, sequence: int):
+        """
+        Copy of the frame with its timestamp, or None if it isn't in the buffer anymore
+        """
+        index = sequence % self.CAPACITY
+        if self.sequences[index] != sequence:
+            return None
+
+        frame = self.frames[index].copy()
+        timestamp = float(self.timestamps[index])
+
+        if self.sequences[index] != sequence:
+            return None
+
+        frame.setflags(write=False)
+        return frame, timestamp
+
+    def latest(self):
+        if self.write_sequence == 0:
+            return None
+        return self.read(self.write_sequence - 1)
+
+    def wait(self, sequence: int, timeout: float):
+        """
+        Wait until the frame with the given sequence is published
+        """
+        with self.new_frame:
+            return self.new_frame.wait_for(lambda: self.write_sequence > sequence, timeout)
+
+
+class FrameConsumer(threading.Thread):
+    """
+    Reads every frame of the buffer from a starting sequence, counting the frames it was too slow to read
+    """
+    WAIT_TIMEOUT: float = 0.5
+
+    def __init__(
+            self,
+            name: str,
+            ring_buffer: FrameRingBuffer,
+            callback: Callable[[np.ndarray, int, float], None],
+            start_sequence: int,
+            drop_callback: Optional[Callable[[int], None]] = None
+    ):
+        threading.Thread.__init__(self, name=name)
+        self.ring_buffer = ring_buffer
+        self.callback = callback
+        self.drop_callback = drop_callback
+        self.sequence = start_sequence
+        self.stop_event = threading.Event()
+        self.consumed = 0
+        self.dropped = 0
+
+    def drop(self, sequence: int):
+        self.dropped += 1
+        if self.drop_callback is not None:
+            self.drop_callback(sequence)
+
+    def safe_drop(self, sequence: int):
+        try:
+            self.drop(sequence)
+        except Exception:
+            logger.exception('{} drop callback failed on frame {}'.format(self.name, sequence))
+
+    def run(self):
+        # after a stop request, the frames already published are still consumed
+        while not self.stop_event.is_set() or self.sequence < self.ring_buffer.write_sequence:
+            if not self.ring_buffer.wait(self.sequence, self.WAIT_TIMEOUT):
+                continue
+
+            # skip what the producer already overwrote
+            oldest = self.ring_buffer.oldest_sequence()
+            while self.sequence < oldest:
+                self.drop(self.sequence)
+                self.sequence += 1
+
+            frame = self.ring_buffer.read(self.sequence)
+            if frame is None:
+                self.drop(self.sequence)
+            else:
+                try:
+                    self.callback(frame[0], self.sequence, frame[1])
+                    self.consumed += 1
+                except Exception:
+                    # a failed frame is counted as dropped, the consumer goes on with the next ones
+                    logger.exception('{} failed on frame {}'.format(self.name, self.sequence))
+                    self.safe_drop(self.sequence)
+            self.sequence += 1
+
+    def stop(self):
+        self.stop_event.set()
+
+    def stats(self):
+        return {'name': self.name, 'consumed': self.consumed, 'dropped': self.dropped}
@@ -0,0 +1,113 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from abc import ABC, abstractmethod
+from io import BytesIO
+import cv2 as cv
+import numpy as np
+from PIL import Image
+from sanic.log import logger
+
+try:
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
+try:
+    from turbojpeg import TurboJPEG
+except ImportError:
+    TurboJPEG = None
+
+
+class JpegEncoder(ABC):
+    """
+    Encodes BGR frames, as given by OpenCV, to JPEG bytes
+    """
+    NAME: str = None
+
+    @staticmethod
+    def available():
+        return True
+
+    @abstractmethod
+    def encode(self, frame, quality: int) -> bytes:
+        pass
+
+
+class OpenCVEncoder(JpegEncoder):
+    NAME = 'opencv'
+
+    def encode(self, frame, quality):
+        _, image = cv.imencode('.jpg', frame, [int(cv.IMWRITE_JPEG_QUALITY), quality])
+        return image.tobytes()
+
+
+class PillowEncoder(JpegEncoder):
+    NAME = 'pillow'
+
+    def encode(self, frame, quality):
+        height, width = frame.shape[:2]
+        # the raw decoder reads the BGR order without converting the frame first
+        image = Image.frombuffer('RGB', (width, height), np.ascontiguousarray(frame), 'raw', 'BGR', 0, 1)
+        output = BytesIO()
+        image.save(output, format='JPEG', quality=quality)
+        return output.getvalue()
+
+
+class SimpleJpegEncoder(JpegEncoder):
+    NAME = 'simplejpeg'
+
+    @staticmethod
+    def available():
+        return simplejpeg is not None
+
+    def encode(self, frame, quality):
+        return simplejpeg.encode_jpeg(np.ascontiguousarray(frame), quality=quality, colorspace='BGR', fastdct=True)
+
+
+class TurboJpegEncoder(JpegEncoder):
+    NAME = 'turbojpeg'
+
+    @staticmethod
+    def available():
+        if TurboJPEG is None:
+            return False
+        try:
+            # the python module needs the libturbojpeg library too
+            TurboJPEG()
+            return True
+        except (OSError, RuntimeError):
+            return False
+
+    def __init__(self):
+        self.turbo_jpeg = TurboJPEG()
+
+    def encode(self, frame, quality):
+        # BGR is the default pixel format
+        return self.turbo_jpeg.encode(np.ascontiguousarray(frame), quality=quality)
+
+
+JPEG_ENCODERS = {encoder.NAME: encoder for encoder in [OpenCVEncoder, PillowEncoder, SimpleJpegEncoder, TurboJpegEncoder]}
+
+
+def get_jpeg_encoder(name: str = None) -> JpegEncoder:
+    """
+    Encoder by name, OpenCV when it isn't known or its library isn't installed
+    """
+    encoder = JPEG_ENCODERS.get(name, OpenCVEncoder)
+    if not encoder.available():
+        logger.warning('the {} JPEG encoder is not available, using {}'.format(name, OpenCVEncoder.NAME))
+        encoder = OpenCVEncoder
+    return encoder()
@@ -0,0 +1,183 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import asyncio
+import cv2 as cv
+import threading
+from time import monotonic
+from typing import Optional
+from .frame_buffer import FrameConsumer
+
+
+class StreamSettings(dict):
+    FRAMES_PER_SECOND: int = None
+    OVERLAY_TIMEOUT: float = None
+    MAX_VIEWERS: int = None
+
+
+class StreamBroadcaster:
+    """
+    Encodes the frames of the capture engine once for every viewer of the stream, with the last analysis drawn over them.
+
+    Viewers always get the newest frame when they are ready for one, so a slow viewer skips frames instead of
+    accumulating them.
+    """
+    OBJECT_COLOR: tuple = (0, 0, 255)
+    RECOGNIZED_COLOR: tuple = (0, 160, 0)
+
+    def __init__(self, camera, settings: Optional[StreamSettings] = None):
+        settings = settings if settings is not None else {}
+        self.camera = camera
+        self.FRAMES_PER_SECOND = settings.get('FRAMES_PER_SECOND', 8)
+        self.OVERLAY_TIMEOUT = settings.get('OVERLAY_TIMEOUT', 2.0)
+        self.MAX_VIEWERS = settings.get('MAX_VIEWERS', 8)
+        self.lock = threading.Lock()
+        self.state_lock = threading.Lock()
+        self.viewers = 0
+        self.capture_engine = None
+        self.consumer: Optional[FrameConsumer] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.frame_event: Optional[asyncio.Event] = None
+        # outcome of the start, shared by the viewers that arrive while the first one starts the stream
+        self.started: Optional[asyncio.Future] = None
+        self.sequence = -1
+        self.frame: Optional[bytes] = None
+        self.last_encode = 0.0
+        self.overlay: Optional[dict] = None
+        self.overlay_time = 0.0
+
+    def publish_overlay(self, result: dict):
+        """
+        Listener of the analysis results, the boxes are drawn over the next frames
+        """
+        self.overlay = result
+        self.overlay_time = monotonic()
+
+    def draw_overlay(self, frame):
+        if self.overlay is None or monotonic() - self.overlay_time > self.OVERLAY_TIMEOUT:
+            return frame
+
+        # the boxes are in the coordinates of the stored captures
+        storage_width, storage_height = self.camera.get_storage_size(frame.shape)
+        scale_x, scale_y = frame.shape[1] / storage_width, frame.shape[0] / storage_height
+
+        # the frame read from the buffer is a private copy
+        frame.setflags(write=True)
+        for obj in self.overlay.get('objects', []):
+            xmin, ymin, xmax, ymax = obj['box']
+            xmin, xmax = round(xmin * scale_x), round(xmax * scale_x)
+            ymin, ymax = round(ymin * scale_y), round(ymax * scale_y)
+            cv.rectangle(frame, (xmin, ymin), (xmax, ymax), self.OBJECT_COLOR, 2)
+
+        for face in self.overlay.get('faces', []):
+            x, y, w, h = face['box']
+            x, w = round(x * scale_x), round(w * scale_x)
+            y, h = round(y * scale_y), round(h * scale_y)
+            color = self.RECOGNIZED_COLOR if face.get('recognized') else self.OBJECT_COLOR
+            cv.rectangle(frame, (x, y), (x + w, y + h), color, 2)
+            cv.putText(frame, face.get('name', ''), (x, y + h + 16), cv.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
+        return frame
+
+    def encode(self, frame, sequence, timestamp):
+        # the stream can go slower than the capture
+        now = monotonic()
+        if now - self.last_encode < 1 / self.FRAMES_PER_SECOND:
+            return
+        self.last_encode = now
+
+        image = self.camera.encode_frame(self.draw_overlay(frame), 'STREAM')
+        self.loop.call_soon_threadsafe(self.publish_frame, sequence, image)
+
+    def publish_frame(self, sequence, image):
+        # runs in the server loop, wakes up the viewers waiting for this frame
+        self.sequence = sequence
+        self.frame = image
+        frame_event, self.frame_event = self.frame_event, asyncio.Event()
+        frame_event.set()
+
+    async def next_frame(self, last_sequence: int):
+        """
+        Newest frame after the given sequence, as (sequence, JPEG bytes)
+        """
+        while self.sequence <= last_sequence:
+            await self.frame_event.wait()
+        return self.sequence, self.frame
+
+    def start(self):
+        with self.state_lock:
+            if self.consumer is not None:
+                return True  # the last viewer left but the stream didn't stop yet
+
+            self.capture_engine = self.camera.get_capture_engine()
+            ring_buffer = self.capture_engine.acquire() if self.capture_engine is not None else None
+            if ring_buffer is None:
+                self.capture_engine = None
+                return False
+
+            self.consumer = FrameConsumer('stream_consumer', ring_buffer, self.encode, ring_buffer.write_sequence)
+            self.consumer.start()
+            return True
+
+    def stop(self):
+        with self.state_lock:
+            if self.viewers > 0:
+                return  # somebody started watching meanwhile
+
+            if self.consumer is not None:
+                self.consumer.stop()
+                self.consumer.join()
+                self.consumer = None
+
+            if self.capture_engine is not None:
+                self.capture_engine.release()
+                self.capture_engine = None
+
+    async def add_viewer(self):
+        """
+        Returns False if the stream is full or there is no camera
+        """
+        with self.lock:
+            if self.viewers >= self.MAX_VIEWERS:
+                return False
+            self.viewers += 1
+            first_viewer = self.viewers == 1
+
+        if first_viewer:
+            self.loop = asyncio.get_event_loop()
+            self.frame_event = asyncio.Event()
+            self.started = self.loop.create_future()
+            started = False
+            try:
+                # warming up the camera blocks, out of the loop
+                started = await self.loop.run_in_executor(None, self.start)
+            finally:
+                self.started.set_result(started)
+                if not started:
+                    await self.remove_viewer()
+            return started
+
+        # set by the first viewer before it awaits anything
+        started = await asyncio.shield(self.started)
+        if not started:
+            await self.remove_viewer()
+        return started
+
+    async def remove_viewer(self):
+        with self.lock:
+            self.viewers -= 1
+            last_viewer = self.viewers == 0
+
+        if last_viewer:
+            await asyncio.get_event_loop().run_in_executor(None, self.stop)
@@ -14,37 +14,162 @@
 
 
 import os.path
-from peewee import SqliteDatabase
+from peewee import SqliteDatabase, fn
+from playhouse.migrate import SqliteMigrator, migrate
+from app.server.utils.database.models import EmbeddingField
 from app.server.utils.database.models.images import Capture, Analysis, Recognition
 from app.server.utils.database.models.alerts import Alert
-from app.server.utils.database.models.authorized import Person, Authorized
+from app.server.utils.database.models.authorized import Person, UnknownIdentity, Authorized
+from app.server.utils.database.models.reports import ReportSummary
+from app.server.utils.database.writer import DatabaseWriter
+
+database_writer = None
+
+# used when the config doesn't have a profile
+DEFAULT_PROFILE = {
+    'synchronous': 'full',
+    'secure_delete': 1,
+    'journal_size_limit': -1
+}
+
+
+def get_pragmas(database_settings: dict = None):
+    database_settings = database_settings if database_settings is not None else {}
+    profile_name = database_settings.get('PROFILE')
+    profile = database_settings.get('PROFILES', {}).get(profile_name)
+
+    if profile is None:
+        if profile_name is not None:
+            print('database profile \'{}\' does not exist, using the default pragmas'.format(profile_name))
+        profile = DEFAULT_PROFILE
+
+    return (('foreign_keys', 1), ('journal_mode', 'wal')) + tuple(profile.items())
 
 
 def db_setup(conf):
+    global database_writer
     db_path = os.path.join(conf.get('STORAGE_SETTINGS')['DATA_FOLDER'], conf.get('DATABASE_NAME'))
     db_orm = None
 
     try:
-        db_orm = SqliteDatabase(db_path, pragmas=(
-            ('foreign_keys', 1),
-            ('journal_mode', 'wal'),
-            ('journal_size_limit', -1),
-            ('secure_delete', 1),
-            ('synchronous', 'full')
-        ))
+        db_orm = SqliteDatabase(db_path, pragmas=get_pragmas(conf.get('DATABASE_SETTINGS')))
         db_orm.connect()
         check_tables(db_orm)
+        # the thread starts with the first record queued
+        database_writer = DatabaseWriter(db_orm, conf.get('DATABASE_WRITER_SETTINGS'))
     except Exception as e:
         print(e)
 
     return db_orm
 
 
+def get_database_writer():
+    return database_writer
+
+
+def db_maintenance(db):
+    """
+    Refresh the query planner statistics and move the WAL back into the db, returns the checkpoint result
+    """
+    db.execute_sql('PRAGMA optimize')
+    busy, log_frames, checkpointed_frames = db.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+    return {'busy': bool(busy), 'log_frames': log_frames, 'checkpointed_frames': checkpointed_frames}
+
+
 def check_tables(db):
-    models = [Capture, Analysis, Alert, Recognition, Person, Authorized]
+    models = [Capture, Analysis, Alert, Recognition, Person, UnknownIdentity, Authorized, ReportSummary]
     db.bind(models)
 
     for model in models:
         exist = model.table_exists()
         if not exist:
             model.create_table()
+            if model is ReportSummary:
+                # summaries of the captures written before the table existed
+                from app.server.utils.reports import rebuild_report_summaries
+                rebuild_report_summaries(db)
+        else:
+            added_columns = check_columns(db, model)
+            model._schema.create_indexes(safe=True)
+            if model is Analysis and 'change' in added_columns:
+                # the skipped frames kept their change as the analysis result
+                Analysis.update(
+                    change=fn.json_extract(Analysis.analysis_result, '$.change'), analysis_result=None
+                ).where(Analysis.skipped == True).execute()
+
+    check_embeddings(db)
+
+
+def check_columns(db, model):
+    """
+    Add the fields created after the table, returns the names of the columns added
+    """
+    table_name = model._meta.table_name
+    columns = [column.name for column in db.get_columns(table_name)]
+    migrator = SqliteMigrator(db)
+    operations = []
+    added_columns = []
+
+    for field in model._meta.sorted_fields:
+        if field.column_name not in columns:
+            # SQLite adds a NOT NULL column rebuilding the whole table, the rows referencing it would be
+            # cascaded away, the column is added nullable and the default set on the existing rows
+            nullable_field = field.clone()
+            nullable_field.null = True
+            operations.append(migrator.add_column(table_name, field.column_name, nullable_field))
+            if field.default is not None:
+                operations.append(migrator.apply_default(table_name, field.column_name, field))
+            added_columns.append(field.column_name)
+
+    # left by a migration interrupted before
+    leftover_table = '{}__tmp__'.format(table_name)
+    if len(operations) > 0 or db.table_exists(leftover_table):
+        # the pragma can't change inside a transaction
+        db.execute_sql('PRAGMA foreign_keys=OFF')
+        try:
+            with db.atomic():
+                db.execute_sql('DROP TABLE IF EXISTS "{}"'.format(leftover_table))
+                if len(operations) > 0:
+                    migrate(*operations)
+        finally:
+            db.execute_sql('PRAGMA foreign_keys=ON')
+
+    return added_columns
+
+
+def check_embeddings(db, chunk_size: int = 500):
+    """
+    Rewrite the embeddings stored with np.save in the raw format, and hash the recognitions
+    """
+    # replaced by the hash index
+    if 'recognition_result' in [index.name for index in db.get_indexes(Recognition._meta.table_name)]:
+        db.execute_sql('DROP INDEX recognition_result')
+
+    migrated = 0
+    while True:
+        rows = Recognition.select(Recognition.id, Recognition.result).where(
+            Recognition.result_hash.is_null()
+        ).limit(chunk_size).tuples()
+        rows = list(rows)
+        if len(rows) == 0:
+            break
+
+        with db.atomic():
+            for recognition_id, embedding in rows:
+                Recognition.update(
+                    result=embedding,
+                    result_hash=EmbeddingField.content_hash(embedding)
+                ).where(Recognition.id == recognition_id).execute()
+        migrated += len(rows)
+
+    # the centroids don't have a hash, the legacy ones are found by their first byte
+    rows = UnknownIdentity.select(UnknownIdentity.id, UnknownIdentity.centroid).where(
+        fn.substr(UnknownIdentity.centroid, 1, 1) == EmbeddingField.NUMPY_PREFIX[:1]
+    ).tuples()
+    with db.atomic():
+        for identity_id, centroid in list(rows):
+            UnknownIdentity.update(centroid=centroid).where(UnknownIdentity.id == identity_id).execute()
+            migrated += 1
+
+    if migrated > 0:
+        print('{} embeddings moved to the raw format'.format(migrated))
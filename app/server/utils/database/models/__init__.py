@@ -13,8 +13,11 @@
 #   limitations under the License.
 
 
+import io
 import threading
-from peewee import Metadata, Model, IntegerField
+from hashlib import blake2b
+import numpy as np
+from peewee import Metadata, Model, IntegerField, BlobField
 
 
 class ThreadSafeDatabaseMetadata(Metadata):
@@ -51,3 +54,46 @@ class EnumField(IntegerField):
 
     def python_value(self, value):
         return self.choices(value)
+
+
+class EmbeddingField(BlobField):
+    """
+    Face embedding stored as a version byte followed by the raw values, read back without copying
+    """
+    FORMATS = {1: np.float32, 2: np.float16}
+    NUMPY_PREFIX = b'\x93NUMPY'
+
+    def __init__(self, version: int = 1, *args, **kwargs):
+        super(EmbeddingField, self).__init__(*args, **kwargs)
+        self.version = version
+
+    @classmethod
+    def encode(cls, embedding, version: int = 1):
+        values = np.asarray(embedding, dtype=cls.FORMATS[version]).ravel()
+        return bytes([version]) + values.tobytes()
+
+    @classmethod
+    def decode(cls, binary):
+        binary = bytes(binary)
+        if binary.startswith(cls.NUMPY_PREFIX):
+            # written with np.save before the raw format
+            return np.load(io.BytesIO(binary), allow_pickle=False).astype(np.float32).ravel()
+
+        embedding = np.frombuffer(binary, dtype=cls.FORMATS[binary[0]], offset=1)
+        return embedding if embedding.dtype == np.float32 else embedding.astype(np.float32)
+
+    @classmethod
+    def content_hash(cls, embedding, version: int = 1):
+        """
+        Signed 64 bits hash of the stored representation, small enough for a cheap index
+        """
+        binary = embedding if isinstance(embedding, bytes) else cls.encode(embedding, version)
+        return int.from_bytes(blake2b(binary, digest_size=8).digest(), 'big', signed=True)
+
+    def db_value(self, value):
+        if value is None or isinstance(value, (bytes, bytearray, memoryview)):
+            return super(EmbeddingField, self).db_value(value)
+        return super(EmbeddingField, self).db_value(self.encode(value, self.version))
+
+    def python_value(self, value):
+        return self.decode(value) if value is not None else None
@@ -13,15 +13,37 @@
 #   limitations under the License.
 
 
-from peewee import CharField, ForeignKeyField
+from datetime import datetime
+from peewee import CharField, ForeignKeyField, IntegerField, DateTimeField
 from app.server.utils.database.models.images import Recognition
-from . import BaseModel
+from . import BaseModel, EmbeddingField
 
 
 class Person(BaseModel):
     name = CharField(index=True, unique=True)
 
 
+class UnknownIdentity(BaseModel):
+    """
+    Anonymous person grouping the faces that didn't match anybody
+    """
+    centroid = EmbeddingField(null=False)
+    members = IntegerField(default=0)
+    person = ForeignKeyField(Person, backref='identities', on_delete='SET NULL', null=True, index=True, unique=False)
+    create_date = DateTimeField(default=datetime.now)
+    update_date = DateTimeField(default=datetime.now)
+
+
 class Authorized(BaseModel):
     person = ForeignKeyField(Person, backref='authorized', on_delete='SET NULL', null=True, index=True, unique=False)
     recognition = ForeignKeyField(Recognition, backref='authorized', on_delete='CASCADE', index=True, unique=True)
+    identity = ForeignKeyField(UnknownIdentity, backref='authorized', on_delete='SET NULL', null=True, index=True, unique=False)
+    # set again whenever the person changes, the embedding indexes follow the changes from it,
+    # nullable to be added to the existing tables without rebuilding them
+    update_date = DateTimeField(null=True, default=datetime.now, index=True)
+
+    @property
+    def display_name(self):
+        if self.person:
+            return self.person.name
+        return 'unknown {}'.format(self.identity_id if self.identity_id else self.id)
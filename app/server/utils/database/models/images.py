@@ -13,14 +13,23 @@
 #   limitations under the License.
 
 
-from peewee import ForeignKeyField, CharField, BooleanField, DateTimeField, BlobField
-from . import BaseModel
+from peewee import ForeignKeyField, CharField, BooleanField, DateTimeField, BigIntegerField, IntegerField, FloatField
+from . import BaseModel, EmbeddingField
 
 
 class Capture(BaseModel):
     image_file = CharField(index=True, unique=False)
     image_folder = CharField(index=True, unique=False)
     datetime = DateTimeField()
+    # video segment of the folder holding the frame, the image file only exists for the stills
+    segment = CharField(null=True)
+    frame_index = IntegerField(null=True)
+
+    class Meta:
+        # the reports walk the captures of a folder by date
+        indexes = (
+            (('image_folder', 'datetime'), False),
+        )
 
 
 class Analysis(BaseModel):
@@ -28,10 +37,21 @@ class Analysis(BaseModel):
     analyzed = BooleanField(default=False)
     detected = BooleanField(default=False)
     recognized = BooleanField(default=False)
+    # NULL in the analyses written before the column existed, read as False
+    skipped = BooleanField(null=True, default=False)
+    # ratio of changed pixels of the skipped frames, they have no analysis result
+    change = FloatField(null=True)
     analysis_result = CharField(null=True)
 
 
 class Recognition(BaseModel):
     analysis = ForeignKeyField(Analysis, backref='recognition', on_delete='CASCADE', index=True, unique=False)
     face_box = CharField(null=False)
-    result = BlobField(null=False, index=True, unique=True)
+    result = EmbeddingField(null=False)
+    result_hash = BigIntegerField(null=True)
+
+    class Meta:
+        # the same face is stored once per analysis, the hash is much cheaper to index than the embedding
+        indexes = (
+            (('result_hash', 'analysis'), True),
+        )
@@ -0,0 +1,29 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from peewee import CharField, IntegerField, DateTimeField
+from . import BaseModel
+
+
+class ReportSummary(BaseModel):
+    """
+    Totals of the captures of a folder, kept up to date when the records are written
+    """
+    image_folder = CharField(index=True, unique=True)
+    images = IntegerField(default=0)
+    detections = IntegerField(default=0)
+    recognitions = IntegerField(default=0)
+    start = DateTimeField(null=True)
+    end = DateTimeField(null=True, index=True)
@@ -0,0 +1,137 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from concurrent.futures import Future
+from queue import Queue, Empty
+from threading import Thread, Lock, get_ident
+from time import monotonic
+from typing import Callable, Optional
+from sanic.log import logger
+
+
+class DatabaseWriterSettings(dict):
+    BATCH_SIZE: int = None
+    BATCH_DEADLINE: float = None
+    QUEUE_SIZE: int = None
+
+
+class DatabaseWriter:
+    """
+    Single thread writing the records, the intents queued together are committed in one transaction.
+
+    An intent is a function doing the queries of a record, its result is given through a future
+    once the transaction is committed.
+    """
+    def __init__(self, db, settings: Optional[DatabaseWriterSettings] = None):
+        settings = settings if settings is not None else {}
+        self.db = db
+        self.BATCH_SIZE = settings.get('BATCH_SIZE', 64)
+        self.BATCH_DEADLINE = settings.get('BATCH_DEADLINE', 0.1)
+        self.queue = Queue(maxsize=settings.get('QUEUE_SIZE', 1024))
+        self.thread: Optional[Thread] = None
+        self.thread_ident: Optional[int] = None
+        self.lock = Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = Thread(target=self.run, name='database_writer')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def submit(self, intent: Callable, *args, **kwargs) -> Future:
+        future = Future()
+
+        if get_ident() == self.thread_ident:
+            # an intent queuing another one would wait for itself, it's part of the same transaction
+            self.execute(future, intent, args, kwargs)
+            return future
+
+        self.start()
+        self.queue.put((future, intent, args, kwargs))
+        return future
+
+    def get_batch(self):
+        # wait for the first intent, then take whatever arrives until the batch is full or the deadline expires
+        batch = [self.queue.get()]
+        deadline = monotonic() + self.BATCH_DEADLINE
+
+        while len(batch) < self.BATCH_SIZE and batch[-1] is not None:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except Empty:
+                break
+
+        return batch
+
+    @staticmethod
+    def execute(future: Future, intent: Callable, args: tuple, kwargs: dict):
+        try:
+            future.set_result(intent(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+
+    def run(self):
+        self.thread_ident = get_ident()
+        running = True
+
+        while running:
+            # 'None' asks the writer to stop
+            batch = self.get_batch()
+            if batch[-1] is None:
+                running = False
+                batch.pop()
+
+            if len(batch) == 0:
+                continue
+
+            results = []
+            try:
+                with self.db.atomic():
+                    for future, intent, args, kwargs in batch:
+                        try:
+                            # a failed intent only rolls back its own queries
+                            with self.db.atomic():
+                                results.append((True, intent(*args, **kwargs)))
+                        except Exception as e:
+                            results.append((False, e))
+            except Exception as e:
+                logger.error('database writer transaction failed: {}'.format(e))
+                for future, _, _, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            # the results are given only after the commit
+            for (future, _, _, _), (succeeded, result) in zip(batch, results):
+                if succeeded:
+                    future.set_result(result)
+                else:
+                    logger.error('database writer intent failed: {}'.format(result))
+                    future.set_exception(result)
+
+    def stop(self):
+        """
+        Write the queued intents and stop the thread
+        """
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+
+        if thread is not None and thread.is_alive():
+            self.queue.put(None)
+            thread.join()
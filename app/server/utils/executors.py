@@ -0,0 +1,60 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Optional
+
+
+class EndpointSettings(dict):
+    WORKERS: int = None
+    CONCURRENCY: int = None
+    TIMEOUT: float = None
+
+
+class EndpointExecutor:
+    """
+    Threads for the blocking work of an endpoint (camera, ML, files, DB), out of the event loop.
+
+    At most 'CONCURRENCY' requests run or wait for a thread, the rest wait for a slot, and a request gives up
+    after 'TIMEOUT' seconds. The thread of a request that timed out finishes its work anyway.
+    """
+    def __init__(self, name: str, settings: Optional[EndpointSettings] = None):
+        settings = settings if settings is not None else {}
+        self.NAME = name
+        self.WORKERS = settings.get('WORKERS', 1)
+        self.CONCURRENCY = settings.get('CONCURRENCY', self.WORKERS)
+        self.TIMEOUT = settings.get('TIMEOUT', 30)
+        self.executor = ThreadPoolExecutor(max_workers=self.WORKERS, thread_name_prefix=name)
+        self.semaphore: Optional[asyncio.Semaphore] = None
+
+    async def execute(self, function: Callable, *args, **kwargs):
+        if self.semaphore is None:
+            # created inside the server loop
+            self.semaphore = asyncio.Semaphore(self.CONCURRENCY)
+
+        async with self.semaphore:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self.executor, partial(function, *args, **kwargs))
+
+    async def run(self, function: Callable, *args, **kwargs):
+        """
+        Result of the function, raises asyncio.TimeoutError if it takes longer than the endpoint timeout
+        """
+        return await asyncio.wait_for(self.execute(function, *args, **kwargs), self.TIMEOUT)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
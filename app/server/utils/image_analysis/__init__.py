@@ -19,53 +19,378 @@ import json
 from mtcnn_cv2 import MTCNN
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
-from queue import Queue
-from threading import Thread
+from sanic.log import logger
+import threading
 from app.server.utils import NumpyArrayEncoder
 from app.server.utils.alerts import create_alert
+from app.server.utils.reports import count_analysis
 from app.server.utils.storage import Storage
+from app.server.utils.database import db_setup, get_database_writer
+from app.server.utils.database.models import EmbeddingField
 from app.server.utils.database.models.images import Capture as CaptureModel, Analysis as AnalysisModel, Recognition as RecognitionModel
 from app.server.utils.database.models.authorized import Authorized as AuthorizedModel
+from .analysis_pool import AnalysisPool
+from .change_filter import FrameChangeFilter
 from .ml_interpreter import TensorFlowInterpreter
 from .detection_phase import DetectionPhase
-
-
-class ImageAnalysisWorker(Thread):
-    def __init__(self, queue):
-        Thread.__init__(self)
-        self.queue = queue
-
-    def run(self):
-        while True:
-            # Get the task from the queue and execute
-            task, image_data = self.queue.get()
-            try:
-                task(image_data)
-            finally:
-                self.queue.task_done()
+from .clustering import setup_unknown_clustering
+from .embedding_index import setup_authorized_index
+from .tracker import TrackerRegistry
 
 
 class ImageAnalysis:
-    queue = Queue()
-
-    def __init__(self, storage: Storage):
+    def __init__(self, storage: Storage, config: dict, start_workers: bool = True):
+        self.config = config
         self.storage = storage
         self.ml_interpreter = TensorFlowInterpreter(storage)
-        self.face_detector = MTCNN()
+        self.local = threading.local()
         self.detection_phase = DetectionPhase(self.ml_interpreter)
-        self.worker = ImageAnalysisWorker(self.queue)
-        self.worker.daemon = True
-        self.worker.start()
+        self.authorized_index = setup_authorized_index(config)
+        self.unknown_clustering = setup_unknown_clustering(config)
+        self.pool = None
+        self.result_listeners = []
+        tracking_settings = config.get('TRACKING_SETTINGS', {})
+        self.TRACKING_ENABLED = tracking_settings.get('ENABLED', False)
+        self.FACE_CHECK_INTERVAL = tracking_settings.get('FACE_CHECK_INTERVAL', 8)
+        self.FACE_QUALITY_GAIN = tracking_settings.get('FACE_QUALITY_GAIN', 1.25)
+        self.trackers = TrackerRegistry(tracking_settings)
+
+        if start_workers:
+            self.pool = AnalysisPool(
+                self.analyze_queued, self.create_worker_task, config.get('ANALYSIS_SETTINGS'), self.notify_results
+            )
+
+    @property
+    def face_detector(self):
+        # MTCNN networks can't run concurrently, each worker thread has its own
+        face_detector = getattr(self.local, 'face_detector', None)
+        if face_detector is None:
+            face_detector = self.local.face_detector = MTCNN()
+        return face_detector
+
+    def create_worker_task(self):
+        # runs inside a worker process
+        db_setup(self.config)
+        image_analysis = ImageAnalysis(Storage(self.config.get('STORAGE_SETTINGS')), self.config, start_workers=False)
+
+        # the forked copies only see the faces of the other processes through the database,
+        # they start from it and only the server saves the index file
+        image_analysis.authorized_index.INDEX_PATH = None
+        image_analysis.authorized_index.sync(force=True)
+        image_analysis.unknown_clustering.sync(force=True)
+        return image_analysis.analyze_queued
+
+    def add_result_listener(self, listener):
+        """
+        The listener receives the description of every queued image analysed
+        """
+        self.result_listeners.append(listener)
+
+    def notify_results(self, results: list):
+        for result in results:
+            for listener in list(self.result_listeners):
+                try:
+                    listener(result)
+                except Exception as e:
+                    logger.error('analysis result listener failed: {}'.format(e))
+
+    def create_change_filter(self):
+        settings = self.config.get('ANALYSIS_SETTINGS')
+        return FrameChangeFilter(settings.get('CHANGE_THRESHOLD', 0), settings.get('CHANGE_MAX_SKIPPED', 0))
+
+    def skip(self, capture_id: int, change: float):
+        # the frame is stored but not analysed, leave a record of it
+        return get_database_writer().submit(AnalysisModel.insert(
+            image=capture_id,
+            analyzed=False,
+            skipped=True,
+            change=round(change, 4)
+        ).execute)
 
     def add_to_queue(self, images_data):
+        """
+        Queue images for analysis, returns False if some of them were rejected because the workers are busy
+        """
+        queued = True
         for image_data in images_data:
-            self.queue.put((self.image_process, image_data))
+            queued = self.pool.submit(image_data) and queued
+        return queued
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.stop()
+
+            if self.pool.BACKEND == 'process':
+                # the faces were added by the worker processes, the copy of the server only has them from the database
+                self.authorized_index.sync(force=True)
+
+        self.authorized_index.save()
+
+    @staticmethod
+    def decode_image(binary):
+        frame = cv.imdecode(np.frombuffer(binary, dtype=np.uint8), cv.IMREAD_COLOR)
+        frame.setflags(write=False)
+        return frame
+
+    @staticmethod
+    def search_regions(boxes: list, frame_shape: tuple, padding: float):
+        """
+        Pad the detected boxes and merge the overlapping ones, returns [x_min, y_min, x_max, y_max] regions
+        """
+        height, width = frame_shape[:2]
+        regions = []
+
+        for ymin, xmin, ymax, xmax in boxes:
+            pad_x = (xmax - xmin) * padding
+            pad_y = (ymax - ymin) * padding
+            regions.append([
+                max(0, int(xmin - pad_x)), max(0, int(ymin - pad_y)),
+                min(width, int(xmax + pad_x)), min(height, int(ymax + pad_y))
+            ])
+
+        # a face inside two overlapping boxes must be searched only once
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(regions)):
+                for j in range(i + 1, len(regions)):
+                    a, b = regions[i], regions[j]
+                    if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                        regions[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                        regions.pop(j)
+                        merged = True
+                        break
+                if merged:
+                    break
+
+        return regions
+
+    def detect_faces(self, frame, person_boxes: list):
+        # the frame is BGR as given by the camera, the crops are views of it
+        padding = self.config.get('ANALYSIS_SETTINGS').get('FACE_SEARCH_PADDING', 0.15)
+        faces_info = []
+
+        for x_min, y_min, x_max, y_max in self.search_regions(person_boxes, frame.shape, padding):
+            if x_max - x_min < 12 or y_max - y_min < 12:
+                continue  # smaller than the MTCNN minimum face
+
+            for face_info in self.face_detector.detect_faces(frame[y_min:y_max, x_min:x_max]):
+                # back to full frame coordinates
+                X, Y, W, H = face_info['box']
+                face_info['box'] = [X + x_min, Y + y_min, W, H]
+                face_info['keypoints'] = {
+                    name: (point[0] + x_min, point[1] + y_min) for name, point in face_info.get('keypoints', {}).items()
+                }
+                faces_info.append(face_info)
+
+        return faces_info
 
     def image_process(self, image_data):
-        # create db record for results
-        image_record = CaptureModel.select().where(
+        # a single image, its errors go to the caller
+        frame = image_data['frame']
+        return self.analyze(image_data, frame, self.detection_phase.detect_batch([frame])[0])
+
+    def analyze_queued(self, images_data: list):
+        """
+        Task of the analysis workers, the results are described with plain values to leave the worker processes
+        """
+        return [
+            self.describe_result(image_data, *result)
+            for image_data, result in zip(images_data, self.image_process_batch(images_data))
+            if result is not None
+        ]
+
+    @staticmethod
+    def describe_result(image_data, image_analyzed, authorized_found):
+        objects = []
+        for obj in image_analyzed:
+            ymin, xmin, ymax, xmax = obj['bounding_box']
+            objects.append({'box': [int(xmin), int(ymin), int(xmax), int(ymax)], 'label': obj.get('class_id')})
+
+        faces = []
+        for auth in authorized_found:
+            faces.append({
+                'box': json.loads(auth.recognition.face_box),
+                'name': auth.display_name,
+                'recognized': auth.person_id is not None
+            })
+
+        return {
+            'folder': image_data.get('folder'),
+            'image': image_data.get('image'),
+            'capture_id': image_data.get('capture_id'),
+            'objects': objects,
+            'faces': faces
+        }
+
+    def image_process_batch(self, images_data: list):
+        """
+        Analyse the images together, returns the result of each one or None where it failed
+        """
+        # find persons in all the frames with a single inference
+        frames = [image_data['frame'] for image_data in images_data]
+        images_analyzed = self.detection_phase.detect_batch(frames)
+
+        results = []
+        for image_data, frame, image_analyzed in zip(images_data, frames, images_analyzed):
+            # a failed frame doesn't take the rest of the batch, nor their tracker updates, with it
+            try:
+                results.append(self.analyze(image_data, frame, image_analyzed))
+            except Exception:
+                logger.exception('analysis of {} failed'.format(image_data.get('image')))
+                results.append(None)
+        return results
+
+    def analyze(self, image_data, frame, image_analyzed):
+        if self.TRACKING_ENABLED and image_data.get('frame_time') is not None:
+            return self.analyze_tracked(image_data, frame, image_analyzed)
+
+        # find faces only where persons were detected
+        person_boxes = [result['bounding_box'] for result in image_analyzed if result.get('class_id') == 'person']
+        faces = [self.recognize_face(frame, face_info) for face_info in self.detect_faces(frame, person_boxes)]
+
+        if image_data.get('scale') is not None:
+            # the frame is a smaller copy, the boxes are saved in the coordinates of the stored image
+            image_analyzed, faces = self.scale_boxes(image_analyzed, faces, image_data['scale'])
+
+        # all the records of the image are written together by the database writer
+        return get_database_writer().submit(self.store_analysis, image_data, image_analyzed, faces).result()
+
+    def recognize_face(self, frame, face_info):
+        [X, Y, W, H] = face_info['box']
+        X, Y = max(0, X), max(0, Y)
+        recognized_image = self.detection_phase.recognize(frame[Y:Y+H, X:X+W])
+        # nearest known face, as (authorized id, person id, distance)
+        authorized_matched = self.authorized_index.match(recognized_image)
+        return face_info, recognized_image, authorized_matched[1] if authorized_matched else None
+
+    @staticmethod
+    def face_quality(face_info):
+        # sharp and large faces give better embeddings
+        return face_info.get('confidence', 1.0) * min(face_info['box'][2], face_info['box'][3])
+
+    def analyze_tracked(self, image_data, frame, image_analyzed):
+        """
+        Persons are followed across the frames of the capture, a face is only recognized again when a better one is seen
+        """
+        persons = [result for result in image_analyzed if result.get('class_id') == 'person']
+        tracker = self.trackers.get(image_data.get('folder', ''))
+        tracks = tracker.update([person['bounding_box'] for person in persons], image_data['frame_time'])
+        for person, track in zip(persons, tracks):
+            person['track_id'] = track.ID
+
+        # tracks already recognized only look for a better face from time to time
+        searched = []
+        for track in tracks:
+            track.face_checks += 1
+            if track.authorized is None or track.face_checks >= self.FACE_CHECK_INTERVAL:
+                track.face_checks = 0
+                searched.append(track)
+
+        best_faces = {}
+        for face_info in self.detect_faces(frame, [track.box for track in searched]):
+            track = self.face_track(face_info['box'], searched)
+            if track is None:
+                continue
+            quality = self.face_quality(face_info)
+            if quality > best_faces.get(track.ID, (None, 0))[1]:
+                best_faces[track.ID] = (face_info, quality)
+
+        recognized_tracks = []
+        faces = []
+        for track in tracks:
+            face_info, quality = best_faces.get(track.ID, (None, 0))
+            if face_info is not None and (track.authorized is None or quality >= track.face_quality * self.FACE_QUALITY_GAIN):
+                recognized_tracks.append((track, face_info['box'], quality))
+                faces.append(self.recognize_face(frame, face_info))
+
+        # the other recognized tracks reuse their result with the face moved along the person
+        recognizing = [track for track, _, _ in recognized_tracks]
+        reused = [track for track in tracks if track.authorized is not None and track not in recognizing]
+        reused_boxes = [track.face_box() for track in reused]
+
+        scale = image_data.get('scale')
+        if scale is not None:
+            # the frame is a smaller copy, the boxes are saved in the coordinates of the stored image
+            image_analyzed, faces = self.scale_boxes(image_analyzed, faces, scale)
+            reused_boxes = [
+                [round(x * scale[0]), round(y * scale[1]), round(w * scale[0]), round(h * scale[1])]
+                for x, y, w, h in reused_boxes
+            ]
+        tracked_authorized = [self.tracked_authorized(track.authorized, box) for track, box in zip(reused, reused_boxes)]
+
+        image_analyzed, authorized_found = get_database_writer().submit(
+            self.store_analysis, image_data, image_analyzed, faces, tracked_authorized
+        ).result()
+
+        for (track, face_box, quality), authorized in zip(recognized_tracks, authorized_found):
+            track.set_face(face_box, quality, authorized)
+
+        return image_analyzed, authorized_found
+
+    @staticmethod
+    def face_track(face_box: list, tracks: list):
+        # the track with the nearest box containing the face center
+        x, y, w, h = face_box
+        center_x, center_y = x + w / 2, y + h / 2
+        nearest, nearest_distance = None, None
+        for track in tracks:
+            ymin, xmin, ymax, xmax = track.box
+            if xmin <= center_x <= xmax and ymin <= center_y <= ymax:
+                distance = (center_x - (xmin + xmax) / 2) ** 2 + (center_y - (ymin + ymax) / 2) ** 2
+                if nearest is None or distance < nearest_distance:
+                    nearest, nearest_distance = track, distance
+        return nearest
+
+    @staticmethod
+    def tracked_authorized(authorized, face_box: list):
+        """
+        Unsaved copy of the authorized record of a track, with the face box of the current frame
+        """
+        recognition = RecognitionModel(id=authorized.recognition_id, face_box=json.dumps(face_box))
+        return AuthorizedModel(
+            id=authorized.id, person=authorized.person_id, identity=authorized.identity_id, recognition=recognition
+        )
+
+    @staticmethod
+    def scale_boxes(image_analyzed, faces, scale):
+        scale_x, scale_y = scale
+        image_analyzed = [
+            {**result, 'bounding_box': [
+                result['bounding_box'][0] * scale_y, result['bounding_box'][1] * scale_x,
+                result['bounding_box'][2] * scale_y, result['bounding_box'][3] * scale_x
+            ]}
+            for result in image_analyzed
+        ]
+
+        scaled_faces = []
+        for face_info, recognized_image, person_id in faces:
+            X, Y, W, H = face_info['box']
+            face_info = {
+                **face_info,
+                'box': [round(X * scale_x), round(Y * scale_y), round(W * scale_x), round(H * scale_y)],
+                'keypoints': {
+                    name: (round(point[0] * scale_x), round(point[1] * scale_y))
+                    for name, point in face_info.get('keypoints', {}).items()
+                }
+            }
+            scaled_faces.append((face_info, recognized_image, person_id))
+
+        return image_analyzed, scaled_faces
+
+    @staticmethod
+    def capture_record(image_data):
+        if image_data.get('capture_id') is not None:
+            # the id is enough to reference the record
+            return CaptureModel(id=image_data['capture_id'])
+
+        return CaptureModel.select().where(
             (CaptureModel.image_file == image_data['image']) & (CaptureModel.image_folder == image_data['folder'])
         ).get()
+
+    def store_analysis(self, image_data, image_analyzed, faces, tracked_authorized=None):
+        # create db record for results
+        image_record = self.capture_record(image_data)
         analysis_record, created = AnalysisModel.get_or_create(
             image=image_record,
             defaults={
@@ -73,59 +398,41 @@ class ImageAnalysis:
                 'detected': False
             }
         )
-
-        # find persons in the image
-        raw_image = Image.open(image_data['binary'])
-        image_analyzed = self.detection_phase.detect(raw_image)
+        # an image analysed again is counted only once in the report summary
+        was_detected = False if created else analysis_record.detected
+        was_recognized = False if created else analysis_record.recognized
 
         if len(image_analyzed) > 0:
             analysis_record.detected = True
             analysis_record.analysis_result = json.dumps(image_analyzed, cls=NumpyArrayEncoder)
             analysis_record.save()
 
-        # find faces in the image
-        image_array = cv.cvtColor(np.array(raw_image), cv.COLOR_BGR2RGB)
-        faces_info = self.face_detector.detect_faces(image_array)
         authorized_found = []
 
-        if len(faces_info) > 0:
+        if len(faces) > 0:
             # store each face detected
-            for face_info in faces_info:
-                [X, Y, W, H] = face_info['box']
-                recognized_image = self.detection_phase.recognize(Image.fromarray(image_array[Y:Y+H, X:X+W]))
-
-                recognized_binary = io.BytesIO()
-                np.save(recognized_binary, recognized_image)
-                recognized_binary.seek(0)
-
+            for face_info, recognized_image, person_id in faces:
                 recognition_record, created = RecognitionModel.get_or_create(
                     analysis=analysis_record,
-                    result=recognized_binary.read(),
+                    result_hash=EmbeddingField.content_hash(recognized_image),
                     defaults={
+                        'result': recognized_image,
                         'face_box': json.dumps(face_info['box'])
                     }
                 )
                 authorized = AuthorizedModel.get_or_none(recognition=recognition_record)
 
                 if not authorized:
-                    all_authorized = AuthorizedModel.select()
-                    authorized_matched = None
-
-                    for authorized in all_authorized.objects():
-                        stored_recognition = io.BytesIO(authorized.recognition.result)
-                        stored_recognition.seek(0)
-                        stored_recognition = np.load(stored_recognition, allow_pickle=True)
-
-                        # calculate distance
-                        distance = round(cv.norm(recognized_image, stored_recognition), 3)
-                        if distance <= 0.799:
-                            authorized_matched = authorized
-                            break
+                    # faces of nobody known are grouped with the similar unknown faces
+                    identity_id = self.unknown_clustering.assign(recognized_image) if person_id is None else None
 
                     new_authorized, created = AuthorizedModel.get_or_create(
-                        person=authorized_matched.person if authorized_matched else None,
+                        person=person_id,
+                        identity=identity_id,
                         recognition=recognition_record
                     )
+                    if person_id is not None:
+                        self.authorized_index.add(new_authorized.id, person_id, recognized_image)
                     authorized_found.append(new_authorized)
                 else:
                     authorized_found.append(authorized)
@@ -133,7 +440,19 @@ class ImageAnalysis:
             analysis_record.recognized = True
             analysis_record.save()
 
+        if tracked_authorized:
+            # persons recognized in previous frames of the capture, no new records
+            authorized_found.extend(tracked_authorized)
+            if not analysis_record.recognized:
+                analysis_record.recognized = True
+                analysis_record.save()
+
         create_alert(image_record, analysis_record, authorized_found)
+        count_analysis(
+            image_data.get('folder', ''),
+            int(analysis_record.detected) - int(was_detected),
+            int(analysis_record.recognized) - int(was_recognized)
+        )
         return image_analyzed, authorized_found
 
     def draw_detected_area(self, image, analysis_result, authorized=None):
@@ -153,7 +472,7 @@ class ImageAnalysis:
             draw.rectangle([xmin, ymin, xmin+xmax, ymin+ymax], outline=(0xFF, 0, 0, 0xFF))
 
             font = ImageFont.truetype("DejaVuSerif", size=12)
-            text = '{}'.format('unknown {}'.format(auth.id) if not auth.person else auth.person.name)
+            text = auth.display_name
             text_size = font.getsize(text)
             box = Image.new('RGBA', (text_size[0]+5, text_size[1]+5), "red")
             tex_box = ImageDraw.Draw(box)
@@ -0,0 +1,188 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import multiprocessing
+from queue import Queue, Empty, Full
+from sanic.log import logger
+from threading import Thread
+from time import monotonic
+from typing import Callable, Optional
+import zlib
+
+
+class PoolSettings(dict):
+    WORKERS: int = None
+    BACKEND: str = None
+    QUEUE_SIZE: int = None
+    QUEUE_TIMEOUT: float = None
+    DRAIN_TIMEOUT: float = None
+    BATCH_SIZE: int = None
+    BATCH_DEADLINE: float = None
+
+
+def get_batch(queue, batch_size: int, batch_deadline: float):
+    # wait for the first image, then take whatever arrives until the batch is full or the deadline expires
+    batch = [queue.get()]
+    deadline = monotonic() + batch_deadline
+
+    while len(batch) < batch_size and batch[-1] is not None:
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(queue.get(timeout=remaining))
+        except Empty:
+            break
+
+    return batch
+
+
+def consume_queue(queue, task: Callable[[list], list], batch_size: int, batch_deadline: float, result_callback: Optional[Callable[[list], None]] = None):
+    running = True
+
+    while running:
+        # Get the tasks from the queue and execute them together, 'None' asks the worker to stop
+        batch = get_batch(queue, batch_size, batch_deadline)
+        if batch[-1] is None:
+            running = False
+            batch.pop()
+
+        try:
+            if len(batch) > 0:
+                results = task(batch)
+                if result_callback is not None:
+                    result_callback(results)
+        except Exception:
+            logger.exception('image analysis failed')
+
+
+class ImageAnalysisWorker(Thread):
+    def __init__(self, queue: Queue, task: Callable[[list], list], batch_size: int = 1, batch_deadline: float = 0, result_callback: Optional[Callable[[list], None]] = None):
+        Thread.__init__(self)
+        self.queue = queue
+        self.task = task
+        self.batch_size = batch_size
+        self.batch_deadline = batch_deadline
+        self.result_callback = result_callback
+
+    def run(self):
+        consume_queue(self.queue, self.task, self.batch_size, self.batch_deadline, self.result_callback)
+
+
+class ImageAnalysisProcess(multiprocessing.Process):
+    def __init__(self, queue: multiprocessing.Queue, task_factory: Callable[[], Callable[[list], list]], batch_size: int = 1, batch_deadline: float = 0, results_queue: Optional[multiprocessing.Queue] = None):
+        multiprocessing.Process.__init__(self)
+        self.queue = queue
+        self.task_factory = task_factory
+        self.batch_size = batch_size
+        self.batch_deadline = batch_deadline
+        self.results_queue = results_queue
+
+    def run(self):
+        # models and database connections can't be shared with the parent, build them inside the process
+        result_callback = self.results_queue.put if self.results_queue is not None else None
+        consume_queue(self.queue, self.task_factory(), self.batch_size, self.batch_deadline, result_callback)
+
+
+class AnalysisPool:
+    BACKENDS = ['thread', 'process']
+
+    def __init__(
+            self,
+            task: Callable[[list], list],
+            task_factory: Callable[[], Callable[[list], list]],
+            settings: Optional[PoolSettings],
+            result_callback: Optional[Callable[[list], None]] = None
+    ):
+        self.BACKEND = settings.get('BACKEND', 'thread')
+        self.WORKERS = max(1, int(settings.get('WORKERS', 1)))
+        self.QUEUE_SIZE = settings.get('QUEUE_SIZE', 0)
+        self.QUEUE_TIMEOUT = settings.get('QUEUE_TIMEOUT')
+        self.DRAIN_TIMEOUT = settings.get('DRAIN_TIMEOUT', 30)
+        self.queues = []
+        self.workers = []
+        self.results_queue = None
+        self.results_listener = None
+
+        if self.BACKEND not in self.BACKENDS:
+            raise AttributeError('analysis backend \'{}\' not supported'.format(self.BACKEND))
+
+        if self.BACKEND == 'process' and result_callback is not None:
+            # the results of the processes come back through a queue read by a thread of the parent
+            self.results_queue = multiprocessing.Queue()
+            self.results_listener = Thread(target=self.listen_results, args=[result_callback], name='analysis_results')
+            self.results_listener.daemon = True
+            self.results_listener.start()
+
+        for _ in range(self.WORKERS):
+            if self.BACKEND == 'process':
+                queue = multiprocessing.Queue(self.QUEUE_SIZE)
+                worker = ImageAnalysisProcess(
+                    queue, task_factory, settings.get('BATCH_SIZE'), settings.get('BATCH_DEADLINE'), self.results_queue
+                )
+            else:
+                queue = Queue(self.QUEUE_SIZE)
+                worker = ImageAnalysisWorker(
+                    queue, task, settings.get('BATCH_SIZE'), settings.get('BATCH_DEADLINE'), result_callback
+                )
+
+            worker.daemon = True
+            worker.start()
+            self.queues.append(queue)
+            self.workers.append(worker)
+
+    def listen_results(self, result_callback: Callable[[list], None]):
+        # 'None' stops the listener
+        for results in iter(self.results_queue.get, None):
+            try:
+                result_callback(results)
+            except Exception:
+                logger.exception('analysis result callback failed')
+
+    def get_queue(self, image_data):
+        # images of the same capture always go to the same worker to keep their order
+        shard = zlib.crc32(image_data.get('folder', '').encode()) % self.WORKERS
+        return self.queues[shard]
+
+    def submit(self, image_data):
+        """
+        Wait for room in the worker queue, returns False if the image could not be queued in time
+        """
+        try:
+            self.get_queue(image_data).put(image_data, timeout=self.QUEUE_TIMEOUT)
+        except Full:
+            return False
+        return True
+
+    def stop(self):
+        deadline = monotonic() + self.DRAIN_TIMEOUT
+
+        # every worker finishes the images already queued before stopping
+        for queue in self.queues:
+            try:
+                queue.put(None, timeout=max(0, deadline - monotonic()))
+            except Full:
+                pass
+
+        for worker in self.workers:
+            worker.join(max(0, deadline - monotonic()))
+            if worker.is_alive():
+                logger.warning('analysis worker did not finish in time')
+                if isinstance(worker, multiprocessing.Process):
+                    worker.terminate()
+
+        if self.results_listener is not None:
+            self.results_queue.put(None)
+            self.results_listener.join(max(0, deadline - monotonic()))
@@ -0,0 +1,57 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import cv2 as cv
+import numpy as np
+from typing import Optional
+
+
+class FrameChangeFilter:
+    """
+    Cheap scene change gate, compares a tiny grayscale copy of each frame with the last analysed one
+    """
+    SIGNATURE_SIZE: tuple = (64, 48)
+
+    def __init__(self, threshold: float = 0.02, max_skipped: int = 16):
+        self.THRESHOLD = threshold
+        self.MAX_SKIPPED = max_skipped
+        self.reference: Optional[np.ndarray] = None
+        self.skipped = 0
+
+    def signature(self, frame: np.ndarray):
+        small = cv.resize(frame, self.SIGNATURE_SIZE, interpolation=cv.INTER_AREA)
+        if small.ndim == 3:
+            small = cv.cvtColor(small, cv.COLOR_BGR2GRAY)
+        return small.astype(np.int16)
+
+    def check(self, frame: np.ndarray):
+        """
+        Returns if the frame must be analysed, and how much it changed (0 to 1) since the last analysed frame
+        """
+        signature = self.signature(frame)
+
+        if self.reference is None:
+            change = 1.0
+        else:
+            change = float(np.mean(np.abs(signature - self.reference))) / 255
+
+        # the slow changes accumulate against the reference, a frame is analysed from time to time anyway
+        if change >= self.THRESHOLD or self.skipped >= self.MAX_SKIPPED:
+            self.reference = signature
+            self.skipped = 0
+            return True, change
+
+        self.skipped += 1
+        return False, change
@@ -0,0 +1,227 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from datetime import datetime
+import numpy as np
+import threading
+from time import monotonic
+from typing import Optional
+from app.server.utils.database.models.images import Recognition as RecognitionModel
+from app.server.utils.database.models.authorized import Authorized as AuthorizedModel, UnknownIdentity as UnknownIdentityModel
+from .embedding_index import EmbeddingIndex
+
+CHUNK_SIZE = 500
+
+
+class UnknownClustering:
+    """
+    Groups the faces that didn't match any person into anonymous identities, each one
+    represented by the centroid of its faces
+    """
+    SYNC_INTERVAL: float = 5.0
+
+    def __init__(self, distance_threshold: float = 0.799):
+        self.DISTANCE_THRESHOLD = distance_threshold
+        self.lock = threading.RLock()
+        self.index = EmbeddingIndex()
+        self.members = {}
+        self.versions = {}
+        self.last_sync: Optional[float] = None
+
+    def sync(self, force: bool = False):
+        """
+        Follow the identities created, resolved or re-clustered by other workers and processes
+        """
+        with self.lock:
+            if not force and self.last_sync is not None and monotonic() - self.last_sync < self.SYNC_INTERVAL:
+                return
+
+            unresolved = {}
+            versions = {}
+            for identity_id, members, update_date in UnknownIdentityModel.select(
+                UnknownIdentityModel.id, UnknownIdentityModel.members, UnknownIdentityModel.update_date
+            ).where(UnknownIdentityModel.person.is_null()).tuples():
+                unresolved[identity_id] = members
+                versions[identity_id] = update_date
+
+            for identity_id in list(self.members.keys()):
+                if identity_id not in unresolved:
+                    self.index.remove(identity_id)
+                    self.members.pop(identity_id)
+
+            # new identities, or centroids updated somewhere else
+            missing = [identity_id for identity_id, version in versions.items() if self.versions.get(identity_id) != version]
+            for start in range(0, len(missing), CHUNK_SIZE):
+                rows = UnknownIdentityModel.select(UnknownIdentityModel.id, UnknownIdentityModel.centroid).where(
+                    UnknownIdentityModel.id.in_(missing[start:start + CHUNK_SIZE])
+                ).tuples()
+                for identity_id, centroid in rows:
+                    self.set_centroid(identity_id, centroid)
+
+            self.versions = versions
+            self.members.update(unresolved)
+            self.last_sync = monotonic()
+
+    def set_centroid(self, identity_id: int, centroid: np.ndarray):
+        if identity_id in self.index.positions:
+            self.index.update_embedding(identity_id, centroid)
+        else:
+            self.index.add(identity_id, None, centroid)
+
+    def assign(self, embedding: np.ndarray):
+        """
+        Add the face to the nearest identity, or start a new one, returns the identity id
+        """
+        with self.lock:
+            self.sync()
+            embedding = np.asarray(embedding, dtype=np.float32).ravel()
+
+            while True:
+                nearest = self.index.nearest(embedding)
+                if nearest is None or round(nearest[2], 3) > self.DISTANCE_THRESHOLD:
+                    break
+
+                identity_id = nearest[0]
+                members = self.members[identity_id] + 1
+                centroid = self.index.matrix[self.index.positions[identity_id]]
+                # running mean of all the faces of the identity
+                centroid = centroid + (embedding - centroid) / members
+
+                update_date = datetime.now()
+                updated = UnknownIdentityModel.update(
+                    centroid=centroid,
+                    members=UnknownIdentityModel.members + 1,
+                    update_date=update_date
+                ).where(UnknownIdentityModel.id == identity_id).execute()
+
+                if updated > 0:
+                    self.set_centroid(identity_id, centroid)
+                    self.members[identity_id] = members
+                    self.versions[identity_id] = update_date
+                    return identity_id
+
+                # deleted by the re-clustering task or the retention, the identities are reloaded
+                self.index.remove(identity_id)
+                self.members.pop(identity_id, None)
+                self.versions.pop(identity_id, None)
+                self.sync(force=True)
+
+            identity = UnknownIdentityModel.create(centroid=embedding, members=1)
+            identity_id = identity.id
+            self.set_centroid(identity_id, embedding)
+            self.members[identity_id] = 1
+            self.versions[identity_id] = identity.update_date
+            return identity_id
+
+
+def nearest_centroids(embeddings: np.ndarray, centroids: np.ndarray):
+    labels = np.empty(len(embeddings), dtype=np.int64)
+    distances = np.empty(len(embeddings), dtype=np.float32)
+    centroids_norms = np.einsum('ij,ij->i', centroids, centroids)
+
+    for start in range(0, len(embeddings), CHUNK_SIZE):
+        chunk = embeddings[start:start + CHUNK_SIZE]
+        squared = centroids_norms - 2 * (chunk @ centroids.T) + np.einsum('ij,ij->i', chunk, chunk)[:, None]
+        labels[start:start + CHUNK_SIZE] = np.argmin(squared, axis=1)
+        distances[start:start + CHUNK_SIZE] = np.sqrt(np.maximum(0, squared.min(axis=1)))
+    return labels, distances
+
+
+def label_centroids(embeddings: np.ndarray, labels: np.ndarray):
+    """
+    Centroid of every cluster of the labels, returns the labels renumbered without the empty clusters and the centroids
+    """
+    counts = np.bincount(labels)
+    kept = np.flatnonzero(counts)
+    sums = np.zeros((len(counts), embeddings.shape[1]), dtype=np.float32)
+    np.add.at(sums, labels, embeddings)
+
+    renumbered = np.full(len(counts), -1, dtype=np.int64)
+    renumbered[kept] = np.arange(len(kept))
+    return renumbered[labels], sums[kept] / counts[kept, None]
+
+
+def recluster_unknown_faces(db, distance_threshold: float = 0.799, iterations: int = 3):
+    """
+    Rebuild all the unresolved identities from the faces not assigned to a person,
+    returns the number of identities created
+    """
+    rows = AuthorizedModel.select(AuthorizedModel.id, RecognitionModel.result).join(
+        RecognitionModel
+    ).where(AuthorizedModel.person.is_null()).order_by(AuthorizedModel.id).tuples()
+
+    authorized_ids = []
+    embeddings = []
+    for authorized_id, result in rows:
+        authorized_ids.append(authorized_id)
+        embeddings.append(result)
+
+    if len(authorized_ids) == 0:
+        return 0
+
+    # leader pass: every face joins the first close enough cluster or starts a new one
+    embeddings = np.stack(embeddings)
+    leaders = EmbeddingIndex()
+    labels = np.empty(len(embeddings), dtype=np.int64)
+    for i, embedding in enumerate(embeddings):
+        nearest = leaders.nearest(embedding)
+        if nearest is not None and nearest[2] <= distance_threshold:
+            labels[i] = nearest[0]
+        else:
+            labels[i] = leaders.size
+            leaders.add(leaders.size, None, embedding)
+
+    # refine the clusters with a few k-means iterations starting from the leaders,
+    # the centroids are computed again after every reassignment so they match the labels stored
+    labels, centroids = label_centroids(embeddings, labels)
+    for _ in range(iterations):
+        labels, _ = nearest_centroids(embeddings, centroids)
+        labels, centroids = label_centroids(embeddings, labels)
+
+    counts = np.bincount(labels, minlength=len(centroids))
+    with db.atomic():
+        UnknownIdentityModel.delete().where(UnknownIdentityModel.person.is_null()).execute()
+
+        created = 0
+        for label in np.flatnonzero(counts):
+            identity = UnknownIdentityModel.create(
+                centroid=centroids[label],
+                members=int(counts[label])
+            )
+            members = [authorized_ids[i] for i in np.flatnonzero(labels == label)]
+            for start in range(0, len(members), CHUNK_SIZE):
+                AuthorizedModel.update(identity=identity).where(
+                    AuthorizedModel.id.in_(members[start:start + CHUNK_SIZE])
+                ).execute()
+            created += 1
+
+    return created
+
+
+unknown_clustering: Optional[UnknownClustering] = None
+
+
+def setup_unknown_clustering(config: dict):
+    global unknown_clustering
+
+    if unknown_clustering is None:
+        settings = config.get('RECOGNITION_SETTINGS')
+        unknown_clustering = UnknownClustering(settings.get('CLUSTER_DISTANCE_THRESHOLD', 0.799))
+
+    return unknown_clustering
+
+
+def get_unknown_clustering():
+    return unknown_clustering
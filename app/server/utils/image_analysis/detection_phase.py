@@ -13,6 +13,7 @@
 #   limitations under the License.
 
 
+import cv2 as cv
 import numpy as np
 from os.path import join as join_path
 from .ml_interpreter import TensorFlowInterpreter
@@ -28,59 +29,71 @@ class DetectionPhase:
     def __init__(self, interpreter: TensorFlowInterpreter):
         self.interpreter = interpreter
 
-    def detect(self, image_data):
-        def detection(labels, interpreter):
-            interpreter.allocate_tensors()
+    def detect_batch(self, images_data: list):
+        def detection(labels, model):
             threshold = 0.4
-            input_details = interpreter.get_input_details()
-            input_shape = input_details[0]['shape']
-            height = input_shape[1]
-            width = input_shape[2]
-
-            self.interpreter.set_input_tensor(interpreter, image_data.copy().convert('RGB').resize((width, height)))
-            interpreter.invoke()
-
-            boxes = self.interpreter.get_output_tensor(interpreter, 0)
-            classes = self.interpreter.get_output_tensor(interpreter, 1)
-            scores = self.interpreter.get_output_tensor(interpreter, 2)
-            count = int(self.interpreter.get_output_tensor(interpreter, 3))
-
-            results = []
-            for i in range(count):
-                if scores[i] >= threshold:
-                    ymin, xmin, ymax, xmax = boxes[i]
-                    result = {
-                        'bounding_box': [ymin * image_data.height, xmin * image_data.width, ymax * image_data.height, xmax * image_data.width],
-                        'class_id': labels[classes[i]],
-                        'score': scores[i]
-                    }
-
-                    if result.get('class_id') in self.entities_allowed:
-                        results.append(result)
-            return results
+            batch_size = model.resize_batch(len(images_data))
+            height = model.INPUT_SHAPE[1]
+            width = model.INPUT_SHAPE[2]
+
+            # resize all the BGR frames into a single RGB input tensor
+            batch = np.empty((len(images_data), height, width, 3), dtype=model.INPUT_TYPE)
+            for i, image in enumerate(images_data):
+                batch[i] = cv.resize(image, (width, height), interpolation=cv.INTER_AREA)[..., ::-1]
+
+            outputs = [[], [], [], []]
+            for start in range(0, len(images_data), batch_size):
+                chunk = batch[start:start + batch_size]
+                if len(chunk) < batch_size:
+                    chunk = np.concatenate([chunk, np.zeros((batch_size - len(chunk), *chunk.shape[1:]), dtype=chunk.dtype)])
+
+                model.interpreter.set_tensor(model.INPUT_INDEX, chunk)
+                model.interpreter.invoke()
+
+                for index in range(len(outputs)):
+                    outputs[index].append(self.interpreter.get_batch_output_tensor(model, index))
+
+            boxes, classes, scores, counts = [np.concatenate(output)[:len(images_data)] for output in outputs]
+
+            # split the results back for each image
+            batch_results = []
+            for n, image in enumerate(images_data):
+                image_height, image_width = image.shape[:2]
+                results = []
+                for i in range(int(counts[n])):
+                    if scores[n][i] >= threshold:
+                        ymin, xmin, ymax, xmax = boxes[n][i]
+                        result = {
+                            'bounding_box': [ymin * image_height, xmin * image_width, ymax * image_height, xmax * image_width],
+                            'class_id': labels[classes[n][i]],
+                            'score': scores[n][i]
+                        }
+
+                        if result.get('class_id') in self.entities_allowed:
+                            results.append(result)
+                batch_results.append(results)
+            return batch_results
+
+        if len(images_data) == 0:
+            return []
 
         label_file_path = join_path('detection', 'labelmap.txt')
         model_file_path = join_path('detection', 'detect.tflite')
         return self.interpreter.detect_callback(detection, label_file_path, model_file_path)
 
     def recognize(self, image_data):
-        def recognition(interpreter):
-            interpreter.allocate_tensors()
-            input_details = interpreter.get_input_details()
-            output_details = interpreter.get_output_details()
-            input_shape = input_details[0]['shape']
-            height = input_shape[1]
-            width = input_shape[2]
-
-            normalized = image_data.resize((width, height))
+        def recognition(model):
+            height = model.INPUT_SHAPE[1]
+            width = model.INPUT_SHAPE[2]
+
+            normalized = cv.resize(image_data, (width, height))
             normalized = (np.float32(normalized) - 127.5) / 127.5
             normalized = np.expand_dims(normalized, axis=0)
 
-            interpreter.set_tensor(input_details[0]['index'], normalized)
-            interpreter.invoke()
+            model.interpreter.set_tensor(model.INPUT_INDEX, normalized)
+            model.interpreter.invoke()
 
-            output_data = interpreter.get_tensor(output_details[0]['index'])
-            return np.squeeze(output_data)
+            return self.interpreter.get_output_tensor(model, 0)
 
         model_file_path = join_path('recognition', 'MobileFaceNet.tflite')
         return self.interpreter.recognize_callback(recognition, model_file_path)
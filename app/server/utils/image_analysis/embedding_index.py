@@ -0,0 +1,438 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from datetime import datetime, timedelta
+import numpy as np
+import os
+from os.path import join as join_path
+import threading
+from time import monotonic
+from typing import Optional
+from peewee import fn
+from app.server.utils.database.models.images import Recognition as RecognitionModel
+from app.server.utils.database.models.authorized import Authorized as AuthorizedModel
+
+
+class RecognitionSettings(dict):
+    DISTANCE_THRESHOLD: float = None
+    INDEX_TYPE: str = None
+    INDEX_FILE: str = None
+    IVF_LISTS: int = None
+    IVF_PROBES: int = None
+    IVF_MIN_TRAIN_SIZE: int = None
+
+
+class EmbeddingIndex:
+    """
+    In-memory matrix with the face embedding of every authorized record assigned to a person,
+    used for exact nearest-neighbour matching
+    """
+    DISTANCE_THRESHOLD: float = 0.799
+    SYNC_INTERVAL: float = 5.0
+    SAVE_INTERVAL: float = 300.0
+    NO_PERSON: int = -1
+
+    def __init__(self, index_path: Optional[str] = None):
+        self.INDEX_PATH = index_path
+        self.lock = threading.RLock()
+        self.size = 0
+        self.ids = np.empty(0, dtype=np.int64)
+        self.persons = np.empty(0, dtype=np.int64)
+        self.matrix: Optional[np.ndarray] = None
+        self.squared_norms = np.empty(0, dtype=np.float32)
+        self.positions = {}
+        self.last_id = 0
+        # the person changes are followed from the update date of the records
+        self.last_update: Optional[datetime] = None
+        self.last_sync: Optional[float] = None
+        self.last_save = monotonic()
+        self.unsaved = False
+
+    def reserve(self, dimensions: int, extra: int):
+        capacity = len(self.ids)
+        if self.matrix is not None and self.size + extra <= capacity:
+            return
+
+        # grow by doubling so adding one row at a time stays cheap
+        capacity = max(16, capacity * 2, self.size + extra)
+        matrix = np.empty((capacity, dimensions), dtype=np.float32)
+        ids = np.empty(capacity, dtype=np.int64)
+        persons = np.empty(capacity, dtype=np.int64)
+        squared_norms = np.empty(capacity, dtype=np.float32)
+
+        if self.matrix is not None:
+            matrix[:self.size] = self.matrix[:self.size]
+            ids[:self.size] = self.ids[:self.size]
+            persons[:self.size] = self.persons[:self.size]
+            squared_norms[:self.size] = self.squared_norms[:self.size]
+
+        self.matrix, self.ids, self.persons, self.squared_norms = matrix, ids, persons, squared_norms
+
+    def add_many(self, authorized_ids: list, person_ids: list, embeddings: np.ndarray):
+        """
+        Append the embeddings not indexed yet, returns the positions where they were stored
+        """
+        with self.lock:
+            embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(authorized_ids), -1)
+            new_rows = [i for i, authorized_id in enumerate(authorized_ids) if authorized_id not in self.positions]
+            if len(new_rows) == 0:
+                return np.empty(0, dtype=np.int64)
+
+            self.reserve(embeddings.shape[1], len(new_rows))
+            start, end = self.size, self.size + len(new_rows)
+            self.matrix[start:end] = embeddings[new_rows]
+            self.squared_norms[start:end] = np.einsum('ij,ij->i', embeddings[new_rows], embeddings[new_rows])
+            for position, row in enumerate(new_rows, start):
+                self.ids[position] = authorized_ids[row]
+                self.persons[position] = person_ids[row] if person_ids[row] is not None else self.NO_PERSON
+                self.positions[authorized_ids[row]] = position
+            self.size = end
+            self.unsaved = True
+
+            return np.arange(start, end)
+
+    def add(self, authorized_id: int, person_id: Optional[int], embedding: np.ndarray):
+        self.add_many([authorized_id], [person_id], embedding)
+
+    def update_embedding(self, authorized_id: int, embedding: np.ndarray):
+        with self.lock:
+            position = self.positions[authorized_id]
+            self.matrix[position] = np.asarray(embedding, dtype=np.float32).ravel()
+            self.squared_norms[position] = self.matrix[position] @ self.matrix[position]
+            self.unsaved = True
+
+    def remove(self, authorized_id: int):
+        with self.lock:
+            position = self.positions.get(authorized_id)
+            if position is not None:
+                # an infinite norm keeps the row out of every search without moving the matrix
+                self.squared_norms[position] = np.inf
+                self.persons[position] = self.NO_PERSON
+                self.unsaved = True
+
+    def load_embeddings(self, query):
+        new_ids, new_persons, new_embeddings = [], [], []
+        # the embeddings are read-only views of the raw records, copied once into the matrix
+        for authorized_id, person_id, result in query.tuples():
+            new_ids.append(authorized_id)
+            new_persons.append(person_id)
+            new_embeddings.append(result)
+
+        if len(new_ids) > 0:
+            self.add_many(new_ids, new_persons, np.stack(new_embeddings))
+        return new_ids
+
+    def update_person(self, authorized_id: int, person_id: Optional[int]):
+        """
+        Only faces assigned to a person are matched, the record joins or leaves the index accordingly
+        """
+        with self.lock:
+            position = self.positions.get(authorized_id)
+
+            if person_id is None:
+                self.remove(authorized_id)
+            elif position is None:
+                self.load_embeddings(AuthorizedModel.select(
+                    AuthorizedModel.id, AuthorizedModel.person, RecognitionModel.result
+                ).join(RecognitionModel).where(AuthorizedModel.id == authorized_id))
+            else:
+                if self.persons[position] == self.NO_PERSON:
+                    self.squared_norms[position] = self.matrix[position] @ self.matrix[position]
+                self.persons[position] = person_id
+                self.unsaved = True
+
+    def sync(self, force: bool = False):
+        """
+        Load the records assigned to a person since the last sync, and refresh the persons of the records updated
+        """
+        with self.lock:
+            if not force and self.last_sync is not None and monotonic() - self.last_sync < self.SYNC_INTERVAL:
+                return
+
+            # the updates being committed while this sync runs are looked at again by the next one
+            sync_date = datetime.now() - timedelta(seconds=self.SYNC_INTERVAL)
+
+            # 'last_id' only moves here, records added directly by other workers could have lower ids
+            last_id = AuthorizedModel.select(fn.MAX(AuthorizedModel.id)).scalar() or 0
+            self.load_embeddings(AuthorizedModel.select(
+                AuthorizedModel.id, AuthorizedModel.person, RecognitionModel.result
+            ).join(RecognitionModel).where(
+                (AuthorizedModel.id > self.last_id) & (AuthorizedModel.id <= last_id) &
+                AuthorizedModel.person.is_null(False)
+            ))
+
+            # other workers, processes or users could have changed the person of older records,
+            # an index loaded without its update date checks all of them once
+            if self.last_update is not None or self.last_id > 0:
+                query = AuthorizedModel.select(AuthorizedModel.id, AuthorizedModel.person).where(
+                    AuthorizedModel.id <= self.last_id
+                )
+                if self.last_update is not None:
+                    query = query.where(AuthorizedModel.update_date >= self.last_update)
+                for authorized_id, person_id in query.tuples():
+                    position = self.positions.get(authorized_id)
+                    current = None if position is None or self.persons[position] == self.NO_PERSON else self.persons[position]
+                    if person_id != current:
+                        self.update_person(authorized_id, person_id)
+
+            self.last_id = last_id
+            self.last_update = sync_date
+            self.last_sync = monotonic()
+            self.updated()
+
+            if self.unsaved and monotonic() - self.last_save >= self.SAVE_INTERVAL:
+                self.save()
+
+    def updated(self):
+        """
+        Hook called after each sync, to maintain any extra structure
+        """
+        pass
+
+    def get_state(self):
+        return {
+            'ids': self.ids[:self.size],
+            'persons': self.persons[:self.size],
+            'matrix': self.matrix[:self.size] if self.matrix is not None else np.empty((0, 0), dtype=np.float32),
+            'last_id': np.int64(self.last_id),
+            'last_update': np.float64(self.last_update.timestamp() if self.last_update is not None else np.nan)
+        }
+
+    def set_state(self, state):
+        # removed rows are not restored
+        kept = state['persons'] != self.NO_PERSON
+        if np.any(kept):
+            self.add_many(state['ids'][kept].tolist(), state['persons'][kept].tolist(), state['matrix'][kept])
+        self.last_id = int(state['last_id'])
+        if 'last_update' in state and not np.isnan(state['last_update']):
+            self.last_update = datetime.fromtimestamp(float(state['last_update']))
+
+    def save(self):
+        if self.INDEX_PATH is None:
+            return
+
+        with self.lock:
+            # write a new file and replace the old one, a crash never leaves a broken index
+            temporary_path = '{}.tmp.npz'.format(self.INDEX_PATH)
+            np.savez(temporary_path, **self.get_state())
+            os.replace(temporary_path, self.INDEX_PATH)
+            self.last_save = monotonic()
+            self.unsaved = False
+
+    def load(self):
+        if self.INDEX_PATH is None or not os.path.isfile(self.INDEX_PATH):
+            return
+
+        with self.lock:
+            try:
+                with np.load(self.INDEX_PATH) as state:
+                    self.set_state(state)
+                self.unsaved = False
+            except (OSError, KeyError, ValueError) as e:
+                # the index is only a cache of the database, it will be rebuilt
+                print(e)
+
+    def squared_distances(self, query: np.ndarray, positions: Optional[np.ndarray] = None):
+        # |a - b|^2 = |a|^2 - 2ab + |b|^2
+        if positions is None:
+            return self.squared_norms[:self.size] - 2 * (self.matrix[:self.size] @ query) + query @ query
+        return self.squared_norms[positions] - 2 * (self.matrix[positions] @ query) + query @ query
+
+    def candidates(self, query: np.ndarray):
+        """
+        Positions worth comparing with the query, None means all of them
+        """
+        return None
+
+    def nearest(self, embedding: np.ndarray):
+        with self.lock:
+            if self.size == 0:
+                return None
+
+            query = np.asarray(embedding, dtype=np.float32).ravel()
+            positions = self.candidates(query)
+            squared_distances = self.squared_distances(query, positions)
+            if len(squared_distances) == 0:
+                return None
+
+            nearest = int(np.argmin(squared_distances))
+            squared_distance = squared_distances[nearest]
+            if positions is not None:
+                nearest = int(positions[nearest])
+
+            distance = float(np.sqrt(max(0.0, squared_distance)))
+            person_id = int(self.persons[nearest])
+            return int(self.ids[nearest]), person_id if person_id != self.NO_PERSON else None, distance
+
+    def search(self, embedding: np.ndarray):
+        """
+        Find the nearest stored embedding, returns (authorized id, person id, distance) or None if the index is empty
+        """
+        self.sync()
+        return self.nearest(embedding)
+
+    def match(self, embedding: np.ndarray):
+        """
+        Same as search but only returns a result when it is close enough to be the same face
+        """
+        result = self.search(embedding)
+        if result is not None and round(result[2], 3) <= self.DISTANCE_THRESHOLD:
+            return result
+        return None
+
+
+class IVFEmbeddingIndex(EmbeddingIndex):
+    """
+    Inverted file index, the embeddings are grouped around k-means centroids and only the lists
+    of the centroids nearest to the query are scanned
+    """
+    TRAIN_ITERATIONS: int = 10
+    TRAIN_SAMPLES_PER_LIST: int = 256
+    CHUNK_SIZE: int = 4096
+
+    def __init__(self, index_path: Optional[str] = None, lists: int = 64, probes: int = 8, min_train_size: int = 1024):
+        super().__init__(index_path)
+        self.LISTS = lists
+        self.PROBES = probes
+        self.MIN_TRAIN_SIZE = max(min_train_size, lists)
+        self.centroids: Optional[np.ndarray] = None
+        self.inverted_lists = []
+        self.trained_size = 0
+
+    def nearest_centroids(self, embeddings: np.ndarray, centroids: np.ndarray):
+        labels = np.empty(len(embeddings), dtype=np.int64)
+        centroids_norms = np.einsum('ij,ij->i', centroids, centroids)
+
+        for start in range(0, len(embeddings), self.CHUNK_SIZE):
+            chunk = embeddings[start:start + self.CHUNK_SIZE]
+            labels[start:start + self.CHUNK_SIZE] = np.argmin(centroids_norms - 2 * (chunk @ centroids.T), axis=1)
+        return labels
+
+    def build_lists(self, labels: np.ndarray):
+        order = np.argsort(labels, kind='stable')
+        bounds = np.searchsorted(labels[order], np.arange(self.LISTS + 1))
+        self.inverted_lists = [order[bounds[i]:bounds[i + 1]] for i in range(self.LISTS)]
+
+    def train(self):
+        with self.lock:
+            data = self.matrix[:self.size]
+            generator = np.random.default_rng(0)
+            samples_count = min(self.size, self.LISTS * self.TRAIN_SAMPLES_PER_LIST)
+            samples = data[generator.choice(self.size, samples_count, replace=False)]
+            centroids = samples[generator.choice(samples_count, self.LISTS, replace=False)].copy()
+
+            for _ in range(self.TRAIN_ITERATIONS):
+                labels = self.nearest_centroids(samples, centroids)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, labels, samples)
+                counts = np.bincount(labels, minlength=self.LISTS)
+                # empty lists keep their previous centroid
+                filled = counts > 0
+                centroids[filled] = sums[filled] / counts[filled, None]
+
+            self.centroids = centroids
+            self.build_lists(self.nearest_centroids(data, centroids))
+            self.trained_size = self.size
+            self.unsaved = True
+
+    def add_many(self, authorized_ids: list, person_ids: list, embeddings: np.ndarray):
+        with self.lock:
+            positions = super().add_many(authorized_ids, person_ids, embeddings)
+
+            # new embeddings join the nearest existing list, the centroids are retrained as the gallery grows
+            if self.centroids is not None and len(positions) > 0:
+                labels = self.nearest_centroids(self.matrix[positions], self.centroids)
+                for label in np.unique(labels):
+                    self.inverted_lists[label] = np.concatenate([self.inverted_lists[label], positions[labels == label]])
+
+            return positions
+
+    def updated(self):
+        if self.size >= self.MIN_TRAIN_SIZE and self.size >= 2 * self.trained_size:
+            self.train()
+
+    def candidates(self, query: np.ndarray):
+        # small galleries are scanned entirely until there are enough embeddings to train
+        if self.centroids is None:
+            return None
+
+        distances = np.einsum('ij,ij->i', self.centroids, self.centroids) - 2 * (self.centroids @ query)
+        probes = min(self.PROBES, self.LISTS)
+        nearest_lists = np.argpartition(distances, probes - 1)[:probes]
+        return np.concatenate([self.inverted_lists[i] for i in nearest_lists])
+
+    def get_state(self):
+        state = super().get_state()
+        if self.centroids is not None:
+            labels = np.empty(self.size, dtype=np.int64)
+            for label, positions in enumerate(self.inverted_lists):
+                labels[positions] = label
+            state.update({'centroids': self.centroids, 'labels': labels, 'trained_size': np.int64(self.trained_size)})
+        return state
+
+    def set_state(self, state):
+        super().set_state(state)
+        # the labels of the removed rows are left out like their embeddings
+        labels = state['labels'][state['persons'] != self.NO_PERSON] if 'labels' in state.files else None
+        if 'centroids' in state.files and len(state['centroids']) == self.LISTS and len(labels) == self.size:
+            self.centroids = state['centroids']
+            self.build_lists(labels)
+            self.trained_size = int(state['trained_size'])
+        else:
+            self.updated()
+
+
+def create_embedding_index(settings: Optional[RecognitionSettings], index_path: Optional[str] = None):
+    index_type = settings.get('INDEX_TYPE', 'exact')
+
+    if index_type == 'ivf':
+        index = IVFEmbeddingIndex(
+            index_path,
+            settings.get('IVF_LISTS', 64),
+            settings.get('IVF_PROBES', 8),
+            settings.get('IVF_MIN_TRAIN_SIZE', 1024)
+        )
+    elif index_type == 'exact':
+        index = EmbeddingIndex(index_path)
+    else:
+        raise AttributeError('embedding index \'{}\' not supported'.format(index_type))
+
+    index.DISTANCE_THRESHOLD = settings.get('DISTANCE_THRESHOLD', index.DISTANCE_THRESHOLD)
+    return index
+
+
+authorized_index: Optional[EmbeddingIndex] = None
+
+
+def setup_authorized_index(config: dict):
+    """
+    Create the shared index of authorized faces, restoring it from the file next to the database
+    """
+    global authorized_index
+
+    if authorized_index is None:
+        settings: RecognitionSettings = config.get('RECOGNITION_SETTINGS')
+        index_path = None
+        if settings.get('INDEX_FILE'):
+            index_path = join_path(config.get('STORAGE_SETTINGS').get('DATA_FOLDER'), settings.get('INDEX_FILE'))
+
+        authorized_index = create_embedding_index(settings, index_path)
+        authorized_index.load()
+
+    return authorized_index
+
+
+def get_authorized_index():
+    return authorized_index
@@ -14,40 +14,134 @@
 
 
 import numpy as np
+import os
 from os.path import join as join_path
 import re
+import threading
+from time import monotonic
 from tflite_runtime.interpreter import Interpreter
 from app.server.utils.storage import Storage
 
 
+class LoadedModel:
+    """
+    An interpreter with its tensors already allocated, bound to the thread that created it
+    """
+    def __init__(self, model_content: bytes, version: float):
+        self.VERSION = version
+        self.interpreter = Interpreter(model_content=model_content)
+        self.interpreter.allocate_tensors()
+        self.input_details = self.interpreter.get_input_details()
+        self.output_details = self.interpreter.get_output_details()
+        self.INPUT_INDEX = self.input_details[0]['index']
+        self.INPUT_SHAPE = self.input_details[0]['shape']
+        self.INPUT_TYPE = self.input_details[0]['dtype']
+        self.OUTPUT_INDEXES = [details['index'] for details in self.output_details]
+        self.BATCH_SIZE = int(self.INPUT_SHAPE[0])
+        self.BATCH_RESIZABLE = 'shape_signature' in self.input_details[0] and self.input_details[0]['shape_signature'][0] == -1
+
+    def resize_batch(self, batch_size: int):
+        """
+        Grow the input batch dimension if the model allows it, returns the batch size in use.
+        The allocation is kept for the smaller batches, they are padded up to it
+        """
+        if batch_size <= self.BATCH_SIZE or not self.BATCH_RESIZABLE:
+            return self.BATCH_SIZE
+
+        try:
+            self.interpreter.resize_tensor_input(self.INPUT_INDEX, [batch_size, *self.INPUT_SHAPE[1:]])
+            self.interpreter.allocate_tensors()
+        except (RuntimeError, ValueError):
+            # the model refused the new shape, go back to the original one
+            self.BATCH_RESIZABLE = False
+            self.interpreter.resize_tensor_input(self.INPUT_INDEX, [self.BATCH_SIZE, *self.INPUT_SHAPE[1:]])
+            self.interpreter.allocate_tensors()
+            return self.BATCH_SIZE
+
+        self.BATCH_SIZE = batch_size
+        self.INPUT_SHAPE = self.interpreter.get_input_details()[0]['shape']
+        return self.BATCH_SIZE
+
+
+class ModelRegistry:
+    RELOAD_CHECK_INTERVAL: float = 5.0
+
+    def __init__(self, models_path: str):
+        self.MODELS_PATH = models_path
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.models = {}
+        self.labels = {}
+
+    def model_file(self, model_file_path):
+        """
+        Keep the model file content in memory, reading it again only when it changes on disk
+        """
+        with self.lock:
+            model = self.models.get(model_file_path)
+            now = monotonic()
+
+            if model is None or now - model['checked'] >= self.RELOAD_CHECK_INTERVAL:
+                full_path = join_path(self.MODELS_PATH, model_file_path)
+                version = os.stat(full_path).st_mtime
+
+                if model is None or model['version'] != version:
+                    with open(full_path, 'rb') as f:
+                        model = {'content': f.read(), 'version': version}
+                    self.models[model_file_path] = model
+                model['checked'] = now
+
+            return model
+
+    def get_model(self, model_file_path) -> LoadedModel:
+        model_file = self.model_file(model_file_path)
+        thread_models = getattr(self.local, 'models', None)
+        if thread_models is None:
+            thread_models = self.local.models = {}
+
+        # one interpreter per thread, rebuilt only if the model file was updated
+        loaded_model = thread_models.get(model_file_path)
+        if loaded_model is None or loaded_model.VERSION != model_file['version']:
+            loaded_model = LoadedModel(model_file['content'], model_file['version'])
+            thread_models[model_file_path] = loaded_model
+
+        return loaded_model
+
+    def get_labels(self, label_file_path):
+        labels = self.labels.get(label_file_path)
+
+        if labels is None:
+            with open(join_path(self.MODELS_PATH, label_file_path), 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+                labels = {}
+                for row_number, content in enumerate(lines):
+                    pair = re.split(r'[:\s]+', content.strip(), maxsplit=1)
+                    if len(pair) == 2 and pair[0].strip().isdigit():
+                        labels[int(pair[0])] = pair[1].strip()
+                    else:
+                        labels[row_number] = pair[0].strip()
+            self.labels[label_file_path] = labels
+
+        return labels
+
+
 class TensorFlowInterpreter:
     def __init__(self, storage: Storage):
         self.storage = storage
+        self.registry = ModelRegistry(self.storage.ML_MODEL_PATH)
 
     def load_labels(self, path):
-        with open(join_path(self.storage.ML_MODEL_PATH, path), 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-            labels = {}
-            for row_number, content in enumerate(lines):
-                pair = re.split(r'[:\s]+', content.strip(), maxsplit=1)
-                if len(pair) == 2 and pair[0].strip().isdigit():
-                    labels[int(pair[0])] = pair[1].strip()
-                else:
-                    labels[row_number] = pair[0].strip()
-        return labels
+        return self.registry.get_labels(path)
 
-    def set_input_tensor(self, interpreter, image):
-        tensor_index = interpreter.get_input_details()[0]['index']
-        input_tensor = interpreter.tensor(tensor_index)()[0]
-        input_tensor[:, :] = image
-
-    def get_output_tensor(self, interpreter, index):
-        output_details = interpreter.get_output_details()[index]
-        tensor = np.squeeze(interpreter.get_tensor(output_details['index']))
+    def get_output_tensor(self, model: LoadedModel, index):
+        tensor = np.squeeze(model.interpreter.get_tensor(model.OUTPUT_INDEXES[index]))
         return tensor
 
+    def get_batch_output_tensor(self, model: LoadedModel, index):
+        return model.interpreter.get_tensor(model.OUTPUT_INDEXES[index])
+
     def detect_callback(self, callback, label_file_path, model_file_path):
-        return callback(self.load_labels(label_file_path), Interpreter(join_path(self.storage.ML_MODEL_PATH, model_file_path)))
+        return callback(self.load_labels(label_file_path), self.registry.get_model(model_file_path))
 
     def recognize_callback(self, callback, model_file_path):
-        return callback(Interpreter(join_path(self.storage.ML_MODEL_PATH, model_file_path)))
+        return callback(self.registry.get_model(model_file_path))
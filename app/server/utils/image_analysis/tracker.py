@@ -0,0 +1,175 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import numpy as np
+import threading
+from time import monotonic
+from typing import Optional
+
+
+class TrackingSettings(dict):
+    ENABLED: bool = None
+    IOU_THRESHOLD: float = None
+    MAX_MISSES: int = None
+    FACE_CHECK_INTERVAL: int = None
+    FACE_QUALITY_GAIN: float = None
+    TRACKER_TIMEOUT: float = None
+
+
+class Track:
+    """
+    Person followed across frames, with a constant velocity Kalman filter over its box center and size
+    """
+    # state: center x, center y, width, height and their velocities in pixels per second
+    MEASUREMENT = np.hstack([np.eye(4), np.zeros((4, 4))])
+    MEASUREMENT_NOISE = np.diag([4.0, 4.0, 16.0, 16.0])
+    PROCESS_NOISE = np.diag([1.0, 1.0, 1.0, 1.0, 100.0, 100.0, 25.0, 25.0])
+
+    def __init__(self, track_id: int, box: list, timestamp: float):
+        self.ID = track_id
+        self.state = np.hstack([self.to_measurement(box), np.zeros(4)])
+        self.covariance = np.diag([16.0, 16.0, 64.0, 64.0, 1e4, 1e4, 1e3, 1e3])
+        self.timestamp = timestamp
+        self.misses = 0
+        self.face_checks = 0
+        # result of the last recognition, reused while the person stays in the scene
+        self.authorized = None
+        self.face_offset: Optional[list] = None
+        self.face_quality = 0.0
+
+    @staticmethod
+    def to_measurement(box):
+        ymin, xmin, ymax, xmax = box
+        return np.array([(xmin + xmax) / 2, (ymin + ymax) / 2, xmax - xmin, ymax - ymin], dtype=np.float64)
+
+    @property
+    def box(self):
+        """
+        Estimated [ymin, xmin, ymax, xmax], like the detected boxes
+        """
+        center_x, center_y, width, height = self.state[:4]
+        width, height = max(width, 1.0), max(height, 1.0)
+        return [center_y - height / 2, center_x - width / 2, center_y + height / 2, center_x + width / 2]
+
+    def predict(self, timestamp: float):
+        elapsed = max(0.0, timestamp - self.timestamp)
+        transition = np.eye(8)
+        transition[:4, 4:] = np.eye(4) * elapsed
+        self.state = transition @ self.state
+        self.covariance = transition @ self.covariance @ transition.T + self.PROCESS_NOISE * max(elapsed, 1e-3)
+        self.timestamp = timestamp
+
+    def update(self, box: list):
+        residual = self.to_measurement(box) - self.MEASUREMENT @ self.state
+        innovation = self.MEASUREMENT @ self.covariance @ self.MEASUREMENT.T + self.MEASUREMENT_NOISE
+        gain = self.covariance @ self.MEASUREMENT.T @ np.linalg.inv(innovation)
+        self.state = self.state + gain @ residual
+        self.covariance = (np.eye(8) - gain @ self.MEASUREMENT) @ self.covariance
+        self.misses = 0
+
+    def face_box(self):
+        """
+        [x, y, w, h] of the recognized face moved with the person box
+        """
+        ymin, xmin, ymax, xmax = self.box
+        width, height = xmax - xmin, ymax - ymin
+        x, y, w, h = self.face_offset
+        return [round(xmin + x * width), round(ymin + y * height), round(w * width), round(h * height)]
+
+    def set_face(self, face_box: list, quality: float, authorized=None):
+        ymin, xmin, ymax, xmax = self.box
+        width, height = max(xmax - xmin, 1.0), max(ymax - ymin, 1.0)
+        x, y, w, h = face_box
+        self.face_offset = [(x - xmin) / width, (y - ymin) / height, w / width, h / height]
+        self.face_quality = quality
+        self.authorized = authorized
+
+
+class ObjectTracker:
+    """
+    Associates the person boxes of consecutive frames by the overlap with the predicted boxes of the tracks
+    """
+    def __init__(self, settings: Optional[TrackingSettings] = None):
+        settings = settings if settings is not None else {}
+        self.IOU_THRESHOLD = settings.get('IOU_THRESHOLD', 0.3)
+        self.MAX_MISSES = settings.get('MAX_MISSES', 8)
+        self.tracks: list = []
+        self.next_id = 1
+        self.last_update = monotonic()
+
+    @staticmethod
+    def iou(boxes_a: np.ndarray, boxes_b: np.ndarray):
+        # boxes as [ymin, xmin, ymax, xmax], returns the matrix of every pair
+        ymin = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+        xmin = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+        ymax = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+        xmax = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+        intersection = np.clip(ymax - ymin, 0, None) * np.clip(xmax - xmin, 0, None)
+        area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+        area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+        return intersection / np.maximum(area_a[:, None] + area_b[None, :] - intersection, 1e-6)
+
+    def update(self, boxes: list, timestamp: float):
+        """
+        Track of each box, a new one for the boxes matching no track
+        """
+        self.last_update = monotonic()
+        for track in self.tracks:
+            track.predict(timestamp)
+
+        assigned = [None] * len(boxes)
+        if len(boxes) > 0 and len(self.tracks) > 0:
+            overlaps = self.iou(np.array([track.box for track in self.tracks]), np.array(boxes, dtype=np.float64))
+            # greedy matching from the largest overlap, enough for the few persons of a scene
+            while overlaps.size > 0 and overlaps.max() >= self.IOU_THRESHOLD:
+                track_index, box_index = np.unravel_index(np.argmax(overlaps), overlaps.shape)
+                self.tracks[track_index].update(boxes[box_index])
+                assigned[box_index] = self.tracks[track_index]
+                overlaps[track_index, :] = -1
+                overlaps[:, box_index] = -1
+
+        for track in self.tracks:
+            if track not in assigned:
+                track.misses += 1
+        self.tracks = [track for track in self.tracks if track.misses <= self.MAX_MISSES]
+
+        for index, box in enumerate(boxes):
+            if assigned[index] is None:
+                assigned[index] = Track(self.next_id, box, timestamp)
+                self.next_id += 1
+                self.tracks.append(assigned[index])
+
+        return assigned
+
+
+class TrackerRegistry:
+    """
+    A tracker for each capture folder, they are forgotten once the folder gets no frames for a while
+    """
+    def __init__(self, settings: Optional[TrackingSettings] = None):
+        self.settings = settings if settings is not None else {}
+        self.TRACKER_TIMEOUT = self.settings.get('TRACKER_TIMEOUT', 60)
+        self.lock = threading.Lock()
+        self.trackers = {}
+
+    def get(self, folder: str) -> ObjectTracker:
+        now = monotonic()
+        with self.lock:
+            for stale_folder in [f for f, t in self.trackers.items() if now - t.last_update > self.TRACKER_TIMEOUT]:
+                del self.trackers[stale_folder]
+
+            if folder not in self.trackers:
+                self.trackers[folder] = ObjectTracker(self.settings)
+            return self.trackers[folder]
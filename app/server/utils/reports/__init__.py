@@ -0,0 +1,116 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from peewee import fn, JOIN, EXCLUDED
+from app.server.utils.database.models.images import Capture as CaptureModel, Analysis as AnalysisModel
+from app.server.utils.database.models.reports import ReportSummary as ReportSummaryModel
+
+
+def insert_capture(image_file: str, image_folder: str, capture_datetime, segment: str = None, frame_index: int = None):
+    """
+    Add the capture record and count it in the summary of its folder, returns the capture id
+    """
+    capture_id = CaptureModel.insert(
+        image_file=image_file,
+        image_folder=image_folder,
+        datetime=capture_datetime,
+        segment=segment,
+        frame_index=frame_index
+    ).execute()
+
+    ReportSummaryModel.insert(
+        image_folder=image_folder,
+        images=1,
+        start=capture_datetime,
+        end=capture_datetime
+    ).on_conflict(
+        conflict_target=[ReportSummaryModel.image_folder],
+        update={
+            ReportSummaryModel.images: ReportSummaryModel.images + 1,
+            ReportSummaryModel.start: fn.MIN(ReportSummaryModel.start, EXCLUDED.start),
+            ReportSummaryModel.end: fn.MAX(ReportSummaryModel.end, EXCLUDED.end)
+        }
+    ).execute()
+
+    return capture_id
+
+
+def count_analysis(image_folder: str, detections: int, recognitions: int):
+    if detections == 0 and recognitions == 0:
+        return
+
+    ReportSummaryModel.update(
+        detections=ReportSummaryModel.detections + detections,
+        recognitions=ReportSummaryModel.recognitions + recognitions
+    ).where(ReportSummaryModel.image_folder == image_folder).execute()
+
+
+def rebuild_report_summaries(db):
+    """
+    Count again every folder from the captures and analysis, returns the number of folders
+    """
+    totals = CaptureModel.select(
+        CaptureModel.image_folder,
+        fn.COUNT(CaptureModel.id),
+        fn.COALESCE(fn.SUM(AnalysisModel.detected), 0),
+        fn.COALESCE(fn.SUM(AnalysisModel.recognized), 0),
+        fn.MIN(CaptureModel.datetime),
+        fn.MAX(CaptureModel.datetime)
+    ).join(
+        AnalysisModel, JOIN.LEFT_OUTER, on=(AnalysisModel.image_id == CaptureModel.id)
+    ).group_by(CaptureModel.image_folder)
+
+    with db.atomic():
+        ReportSummaryModel.delete().execute()
+        ReportSummaryModel.insert_from(totals, [
+            ReportSummaryModel.image_folder,
+            ReportSummaryModel.images,
+            ReportSummaryModel.detections,
+            ReportSummaryModel.recognitions,
+            ReportSummaryModel.start,
+            ReportSummaryModel.end
+        ]).execute()
+
+    return ReportSummaryModel.select().count()
+
+
+def refresh_report_summary(image_folder: str):
+    """
+    Count again a single folder, its summary is removed when it has no captures left
+    """
+    totals = CaptureModel.select(
+        fn.COUNT(CaptureModel.id).alias('images'),
+        fn.COALESCE(fn.SUM(AnalysisModel.detected), 0).alias('detections'),
+        fn.COALESCE(fn.SUM(AnalysisModel.recognized), 0).alias('recognitions'),
+        fn.MIN(CaptureModel.datetime).alias('start'),
+        fn.MAX(CaptureModel.datetime).alias('end')
+    ).join(
+        AnalysisModel, JOIN.LEFT_OUTER, on=(AnalysisModel.image_id == CaptureModel.id)
+    ).where(CaptureModel.image_folder == image_folder).dicts().get()
+
+    if totals['images'] == 0:
+        ReportSummaryModel.delete().where(ReportSummaryModel.image_folder == image_folder).execute()
+        return
+
+    ReportSummaryModel.update(**totals).where(ReportSummaryModel.image_folder == image_folder).execute()
+
+
+def get_totals():
+    totals = ReportSummaryModel.select(
+        fn.COALESCE(fn.SUM(ReportSummaryModel.images), 0).alias('captures'),
+        fn.COALESCE(fn.SUM(ReportSummaryModel.detections), 0).alias('detections'),
+        fn.COALESCE(fn.SUM(ReportSummaryModel.recognitions), 0).alias('recognitions')
+    ).dicts().get()
+    return totals
@@ -0,0 +1,32 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Rebuild the report summaries from the captures, after restoring or editing the db by hand.
+# usage: python -m app.server.utils.reports [--mode develop]
+
+import argparse
+import sys
+from config import develop as dev_env, production as prod_env
+from app.server.utils.database import db_setup
+from . import rebuild_report_summaries
+
+
+argument_parser = argparse.ArgumentParser()
+argument_parser.add_argument('--mode', type=str, default='production')
+args = argument_parser.parse_args(sys.argv[1:])
+
+config = dev_env if str(args.mode).lower() == 'develop' else prod_env
+db = db_setup(config.__dict__)
+print('{} report summaries rebuilt'.format(rebuild_report_summaries(db)))
+db.close()
@@ -13,38 +13,189 @@
 #   limitations under the License.
 
 
-from typing import Optional
+from typing import Callable, Optional
+import hashlib
+import os
 from os.path import join as join_path
 from pathlib import Path
+import re
+import threading
 from datetime import datetime
+from uuid import uuid4
 
 
 class StorageSettings(dict):
     DATA_PATH: str = None
     CAPTURE_PATH: str = None
     ML_MODEL_PATH: str = None
+    ARCHIVE_PATH: str = None
+    SHARD_FORMAT: str = None
+    DEDUPLICATE: bool = None
 
 
 class Storage(object):
+    """
+    Captured images sharded by the date and hour of their folder, or of the image for the ones without folder:
+    CAPTURE_PATH/<shard>/<folder>/<image>.
+
+    The folder and image names are enough to find an image, the folders written before the sharding are still
+    found in CAPTURE_PATH/<folder>.
+    """
+    # the capture folders and images start or end with their unix timestamp
+    FOLDER_TIMESTAMP = re.compile(r'^(\d{9,})_')
+    IMAGE_TIMESTAMP = re.compile(r'_(\d{9,})(?:_|\.)')
+    OBJECTS_FOLDER: str = '.objects'
+
     def __init__(self, storage_settings: Optional[StorageSettings]):
         self.DATA_PATH = storage_settings.get('DATA_FOLDER')
         self.CAPTURE_PATH = join_path(self.DATA_PATH, storage_settings.get('CAPTURE_FOLDER'))
         self.ML_MODEL_PATH = join_path(self.DATA_PATH, storage_settings.get('ML_MODEL_FOLDER'))
+        self.ARCHIVE_PATH = join_path(self.DATA_PATH, storage_settings.get('ARCHIVE_FOLDER', 'archived_captures'))
+        self.SHARD_FORMAT = storage_settings.get('SHARD_FORMAT', '%Y/%m/%d/%H')
+        self.DEDUPLICATE = storage_settings.get('DEDUPLICATE', False)
+        self.OBJECTS_PATH = join_path(self.CAPTURE_PATH, self.OBJECTS_FOLDER)
+        # directories known to exist, a mkdir for every image is a lot of syscalls on an SD card
+        self.known_directories = set()
+        self.directories_lock = threading.Lock()
+        # called with the folder and image of a capture without image file, it can create it
+        self.missing_image: Optional[Callable[[str, str], Optional[str]]] = None
         Path(self.CAPTURE_PATH).mkdir(parents=True, exist_ok=True)
 
-    def save_image(self, image, folder_name: str = '', file_name: str = '', file_extension: str = None):
+    def get_shard(self, folder_name: str, file_name: str = ''):
+        match = self.FOLDER_TIMESTAMP.match(folder_name) if folder_name != '' else self.IMAGE_TIMESTAMP.search(file_name)
+        if match is None:
+            return None
+        # the millisecond timestamps of the images have 13 digits
+        timestamp = int(match.group(1)[:10])
+        return datetime.fromtimestamp(timestamp).strftime(self.SHARD_FORMAT)
+
+    def folder_path(self, folder_name: str, file_name: str = ''):
+        """
+        Directory of the images of the folder, for the images without folder it depends on the image name
+        """
+        shard = self.get_shard(folder_name, file_name)
+        if shard is None:
+            return join_path(self.CAPTURE_PATH, folder_name) if folder_name != '' else self.CAPTURE_PATH
+
+        sharded_path = join_path(self.CAPTURE_PATH, shard, folder_name) if folder_name != '' else join_path(self.CAPTURE_PATH, shard)
+        if folder_name != '' and sharded_path not in self.known_directories and not os.path.isdir(sharded_path):
+            legacy_path = join_path(self.CAPTURE_PATH, folder_name)
+            if os.path.isdir(legacy_path):
+                return legacy_path
+        return sharded_path
+
+    def image_path(self, folder_name: str, file_name: str):
+        image_path = join_path(self.folder_path(folder_name, file_name), file_name)
+        if not os.path.abspath(image_path).startswith(os.path.abspath(self.CAPTURE_PATH) + os.sep):
+            raise FileNotFoundError(image_path)
+        return image_path
+
+    def make_directory(self, directory: str):
+        if directory in self.known_directories:
+            return
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        with self.directories_lock:
+            self.known_directories.add(directory)
+
+    def forget_directory(self, directory: str):
+        with self.directories_lock:
+            self.known_directories.discard(directory)
+
+    def find_image(self, folder_name: str, file_name: str):
+        """
+        Path of an existing image, the missing image handler can bring it back, None if it can't be found
+        """
+        image_path = self.image_path(folder_name, file_name)
+        if os.path.isfile(image_path):
+            return image_path
+
+        if self.missing_image is not None and self.missing_image(folder_name, file_name) is not None:
+            return image_path
+        return None
+
+    def open_image(self, folder_name: str, file_name: str, mode: str = 'rb'):
+        image_path = self.find_image(folder_name, file_name)
+        if image_path is None:
+            raise FileNotFoundError(join_path(folder_name, file_name))
+        return open(image_path, mode)
+
+    def prepare_image(self, folder_name: str = '', file_name: str = '', file_extension: str = None):
+        """
+        Resolve where an image will be saved without writing it yet
+        """
         if file_extension is None or file_extension == '':
             raise AttributeError('the file extension must be specified')
 
-        timestamp = int(datetime.now().timestamp())
-        folder_destination = join_path(self.CAPTURE_PATH, folder_name) if folder_name != '' else self.CAPTURE_PATH
-        Path(folder_destination).mkdir(parents=True, exist_ok=True)
+        now = datetime.now()
+        timestamp = int(now.timestamp())
 
         if file_name == '':
-            file_name = 'captured_{}{}'.format(timestamp, file_extension)
+            # unique even for concurrent captures in the same millisecond
+            file_name = 'captured_{}_{}{}'.format(int(now.timestamp() * 1000), uuid4().hex[:8], file_extension)
         else:
             file_name = '{}{}'.format(file_name, file_extension)
 
-        image_path = join_path(folder_destination, file_name)
-        open(image_path, 'wb').write(image.tobytes())
         return {'folder': folder_name, 'image': file_name, 'timestamp': timestamp}
+
+    def write_file(self, file_path: str, content: bytes):
+        # the readers never see a partial file
+        temporary_path = '{}.tmp{}'.format(file_path, threading.get_ident())
+        with open(temporary_path, 'wb') as output_file:
+            output_file.write(content)
+        os.replace(temporary_path, file_path)
+
+    def write_image(self, image, image_info: dict):
+        folder_name = image_info.get('folder')
+        file_name = image_info.get('image')
+        folder_destination = self.folder_path(folder_name, file_name)
+        self.make_directory(folder_destination)
+        image_path = join_path(folder_destination, file_name)
+
+        try:
+            self.write_image_file(image_path, image)
+        except FileNotFoundError:
+            # the directory was removed by the retention of another process
+            self.forget_directory(folder_destination)
+            self.make_directory(folder_destination)
+            self.write_image_file(image_path, image)
+        return image_info
+
+    def write_image_file(self, image_path: str, image: bytes):
+        if self.DEDUPLICATE:
+            self.write_deduplicated(image_path, image)
+        else:
+            self.write_file(image_path, image)
+
+    def write_deduplicated(self, image_path: str, image: bytes):
+        """
+        Identical images are stored once and linked from every path
+        """
+        content_hash = hashlib.blake2b(image, digest_size=16).hexdigest()
+        object_directory = join_path(self.OBJECTS_PATH, content_hash[:2])
+        object_path = join_path(object_directory, content_hash)
+        self.make_directory(object_directory)
+
+        if not os.path.isfile(object_path):
+            self.write_file(object_path, image)
+
+        try:
+            temporary_path = '{}.tmp{}'.format(image_path, threading.get_ident())
+            os.link(object_path, temporary_path)
+            os.replace(temporary_path, image_path)
+        except OSError:
+            # file systems without hard links, like FAT
+            self.write_file(image_path, image)
+
+    def collect_objects(self):
+        """
+        Remove the deduplicated images no longer linked from any capture, returns the bytes freed
+        """
+        freed = 0
+        for root, _, files in os.walk(self.OBJECTS_PATH):
+            for file_name in files:
+                object_path = join_path(root, file_name)
+                stats = os.stat(object_path)
+                if stats.st_nlink == 1:
+                    os.remove(object_path)
+                    freed += stats.st_size
+        return freed
@@ -0,0 +1,88 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import os
+from os.path import join as join_path
+from pathlib import Path
+import tarfile
+import threading
+from typing import Optional
+import zipfile
+from app.server.utils.storage import Storage
+
+
+ARCHIVE_FORMATS: dict = {'tar': '.tar', 'zip': '.zip'}
+
+
+def find_archive(storage: Storage, folder: str) -> Optional[str]:
+    for extension in ARCHIVE_FORMATS.values():
+        archive_path = join_path(storage.ARCHIVE_PATH, folder + extension)
+        if os.path.isfile(archive_path):
+            return archive_path
+    return None
+
+
+def archive_folder(storage: Storage, folder: str, archive_format: str = 'tar'):
+    """
+    Bundle the files of a capture folder in a single archive, returns its path.
+    The JPEG images and MJPEG segments are already compressed, they are stored as they are.
+    """
+    folder_path = storage.folder_path(folder)
+    archive_path = join_path(storage.ARCHIVE_PATH, folder + ARCHIVE_FORMATS[archive_format])
+    temporary_path = '{}.tmp{}'.format(archive_path, threading.get_ident())
+    Path(storage.ARCHIVE_PATH).mkdir(parents=True, exist_ok=True)
+
+    file_names = sorted(os.listdir(folder_path))
+    if archive_format == 'zip':
+        with zipfile.ZipFile(temporary_path, 'w', compression=zipfile.ZIP_STORED) as archive:
+            for file_name in file_names:
+                archive.write(join_path(folder_path, file_name), file_name)
+    else:
+        with tarfile.open(temporary_path, 'w') as archive:
+            for file_name in file_names:
+                archive.add(join_path(folder_path, file_name), file_name)
+
+    os.replace(temporary_path, archive_path)
+    return archive_path
+
+
+def extract_file(storage: Storage, folder: str, file_name: str):
+    """
+    Bring a file of an archived folder back to the capture folder, returns its path or None if it isn't archived
+    """
+    archive_path = find_archive(storage, folder)
+    if archive_path is None:
+        return None
+
+    file_path = join_path(storage.folder_path(folder), file_name)
+    temporary_path = '{}.tmp{}'.format(file_path, threading.get_ident())
+    storage.make_directory(os.path.dirname(file_path))
+
+    try:
+        if archive_path.endswith(ARCHIVE_FORMATS['zip']):
+            with zipfile.ZipFile(archive_path) as archive, archive.open(file_name) as source, open(temporary_path, 'wb') as destination:
+                destination.write(source.read())
+        else:
+            with tarfile.open(archive_path) as archive:
+                source = archive.extractfile(file_name)
+                if source is None:
+                    return None
+                with open(temporary_path, 'wb') as destination:
+                    destination.write(source.read())
+    except KeyError:
+        return None  # not in the archive
+
+    os.replace(temporary_path, file_path)
+    return file_path
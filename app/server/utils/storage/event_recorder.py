@@ -0,0 +1,205 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import cv2 as cv
+import numpy as np
+import os
+from os.path import join as join_path
+import threading
+from typing import Callable, Optional
+from app.server.utils.database.models.images import Capture as CaptureModel
+from app.server.utils.storage import Storage
+from app.server.utils.storage.archive import extract_file
+
+
+class EventRecorderSettings(dict):
+    ENABLED: bool = None
+    CODEC: str = None
+    CONTAINER: str = None
+    QUALITY: int = None
+    FRAMES_PER_SECOND: int = None
+    SEGMENT_FRAMES: int = None
+
+
+class EventRecorder:
+    """
+    Writes the frames of a sensor activation as video segments instead of a JPEG file per frame.
+
+    Every segment has an index with the timestamp of each frame, as float64 values. The frames asked with
+    keep_still are also saved as JPEG images, once their segment is closed and readable.
+    """
+    SEGMENT_NAME: str = 'segment_{:04d}'
+    CONTAINER_EXTENSIONS: tuple = ('.avi', '.mkv', '.mp4')
+    INDEX_EXTENSION: str = '.idx'
+    # the segment being recorded can't be read yet, it takes its name once closed
+    OPEN_SUFFIX: str = '.open'
+
+    def __init__(self, storage: Storage, folder: str, prepare_frame: Callable, settings: Optional[EventRecorderSettings] = None):
+        settings = settings if settings is not None else {}
+        self.CODEC = settings.get('CODEC', 'MJPG')
+        self.CONTAINER = settings.get('CONTAINER', '.avi')
+        self.QUALITY = settings.get('QUALITY', 85)
+        self.FRAMES_PER_SECOND = settings.get('FRAMES_PER_SECOND', 16)
+        self.SEGMENT_FRAMES = settings.get('SEGMENT_FRAMES', 240)
+        self.storage = storage
+        self.folder = folder
+        self.FOLDER_PATH = storage.folder_path(folder)
+        # resize the frames to the storage resolution
+        self.prepare_frame = prepare_frame
+        self.lock = threading.Lock()
+        self.writer: Optional[cv.VideoWriter] = None
+        self.open_path: Optional[str] = None
+        self.index_file = None
+        self.segment_number = 0
+        self.segment_frames = 0
+        self.frames = {}
+        self.pending_stills = []
+        self.closed_segments = set()
+        storage.make_directory(self.FOLDER_PATH)
+
+    def segment_file(self, segment_number: int):
+        return self.SEGMENT_NAME.format(segment_number) + self.CONTAINER
+
+    def open_segment(self, frame):
+        self.segment_number += 1
+        self.segment_frames = 0
+        # the video writer takes the container from the extension
+        self.open_path = join_path(
+            self.FOLDER_PATH, self.SEGMENT_NAME.format(self.segment_number) + self.OPEN_SUFFIX + self.CONTAINER
+        )
+        height, width = frame.shape[:2]
+
+        self.writer = cv.VideoWriter(self.open_path, cv.VideoWriter_fourcc(*self.CODEC), self.FRAMES_PER_SECOND, (width, height))
+        if not self.writer.isOpened():
+            self.writer = None
+            raise IOError('the {} video writer could not open {}'.format(self.CODEC, self.open_path))
+        self.writer.set(cv.VIDEOWRITER_PROP_QUALITY, self.QUALITY)
+        self.index_file = open(join_path(self.FOLDER_PATH, self.SEGMENT_NAME.format(self.segment_number) + self.INDEX_EXTENSION), 'wb')
+
+    def close_segment(self):
+        if self.writer is None:
+            return None
+
+        self.writer.release()
+        self.index_file.close()
+        self.writer = None
+        self.index_file = None
+        os.replace(self.open_path, join_path(self.FOLDER_PATH, self.segment_file(self.segment_number)))
+        self.closed_segments.add(self.segment_file(self.segment_number))
+
+        # the segment can be read now, the stills are written by the caller once the lock is released
+        pending_stills, self.pending_stills = self.pending_stills, []
+        return [(image_file, ) + self.frames[image_file] for image_file in pending_stills]
+
+    def write(self, frame, image_file: str, timestamp: float):
+        """
+        Append the frame to the current segment, returns the (segment file, frame index) where it was written
+        """
+        frame = self.prepare_frame(frame)
+        stills = None
+
+        with self.lock:
+            if self.writer is not None and self.segment_frames >= self.SEGMENT_FRAMES:
+                stills = self.close_segment()
+            if self.writer is None:
+                self.open_segment(frame)
+
+            self.writer.write(frame)
+            self.index_file.write(np.float64(timestamp).tobytes())
+            location = (self.segment_file(self.segment_number), self.segment_frames)
+            self.frames[image_file] = location
+            self.segment_frames += 1
+
+        self.write_stills(stills)
+        return location
+
+    def keep_still(self, image_file: str):
+        """
+        Save the frame also as a JPEG image, when its segment is closed
+        """
+        with self.lock:
+            location = self.frames.get(image_file)
+            if location is None:
+                return
+            if location[0] not in self.closed_segments:
+                self.pending_stills.append(image_file)
+                return
+
+        self.write_stills([(image_file, ) + location])
+
+    def write_stills(self, stills: Optional[list]):
+        # decoding the segment and encoding the JPEG is slow, the frames keep being written meanwhile
+        for image_file, segment_file, frame_index in stills or ():
+            write_still(self.storage, self.folder, image_file, segment_file, frame_index)
+
+    def close(self):
+        with self.lock:
+            stills = self.close_segment()
+        self.write_stills(stills)
+
+
+def read_index(index_path: str):
+    return np.fromfile(index_path, dtype=np.float64)
+
+
+def read_frame(segment_path: str, frame_index: int):
+    # every MJPEG frame is a keyframe, the seek is exact
+    video = cv.VideoCapture(segment_path)
+    try:
+        video.set(cv.CAP_PROP_POS_FRAMES, frame_index)
+        read, frame = video.read()
+        return frame if read else None
+    finally:
+        video.release()
+
+
+def write_still(storage: Storage, folder: str, image_file: str, segment_file: str, frame_index: int, quality: int = 90):
+    """
+    Extract a frame of a segment as a JPEG image next to it, returns its path or None if it can't be read
+    """
+    image_path = storage.image_path(folder, image_file)
+    if os.path.exists(image_path):
+        return image_path
+
+    frame = read_frame(join_path(storage.folder_path(folder), segment_file), frame_index)
+    if frame is None:
+        return None
+
+    _, image = cv.imencode('.jpg', frame, [int(cv.IMWRITE_JPEG_QUALITY), quality])
+    storage.write_file(image_path, image.tobytes())
+    return image_path
+
+
+def capture_still(storage: Storage, folder: str, image_file: str):
+    """
+    Path of the image of a capture, extracted from its segment when it was only recorded there,
+    or from the archive of its folder
+    """
+    image_path = extract_file(storage, folder, image_file)
+    if image_path is not None:
+        return image_path
+
+    capture = CaptureModel.select(CaptureModel.segment, CaptureModel.frame_index).where(
+        (CaptureModel.image_folder == folder) & (CaptureModel.image_file == image_file)
+    ).first()
+
+    if capture is None or capture.segment is None:
+        return None
+
+    if not os.path.isfile(join_path(storage.folder_path(folder), capture.segment)) and \
+            extract_file(storage, folder, capture.segment) is None:
+        # still being recorded, or never closed after a crash
+        return None
+    return write_still(storage, folder, image_file, capture.segment, capture.frame_index)
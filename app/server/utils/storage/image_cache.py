@@ -0,0 +1,157 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import os
+from os.path import join as join_path
+from pathlib import Path
+import threading
+from typing import Optional
+from PIL import Image
+from app.server.utils.storage import Storage
+
+
+class ImageCacheSettings(dict):
+    CACHE_FOLDER: str = None
+    DISK_BUDGET: int = None
+    QUALITY: int = None
+    RENDITIONS: dict = None
+
+
+class DerivedImageCache:
+    """
+    Smaller renditions of the captured images, generated on demand and evicted by least recent use
+    when the cache goes over its disk budget.
+
+    The use of a rendition is recorded in its modification time, it works across the server and task processes.
+    """
+    # 'fit' keeps the aspect ratio inside the size, 'fill' takes exactly the size
+    DEFAULT_RENDITIONS: dict = {
+        'thumbnail': {'SIZE': [480, 360], 'MODE': 'fit'},
+        'collage': {'SIZE': [600, 500], 'MODE': 'fill'}
+    }
+
+    def __init__(self, storage: Storage, settings: Optional[ImageCacheSettings] = None):
+        settings = settings if settings is not None else {}
+        self.storage = storage
+        self.CACHE_PATH = join_path(storage.DATA_PATH, settings.get('CACHE_FOLDER', 'image_cache'))
+        self.DISK_BUDGET = settings.get('DISK_BUDGET', 256 * 1024 * 1024)
+        self.QUALITY = settings.get('QUALITY', 80)
+        self.RENDITIONS = settings.get('RENDITIONS', self.DEFAULT_RENDITIONS)
+        self.lock = threading.Lock()
+        self.used: Optional[int] = None
+        Path(self.CACHE_PATH).mkdir(parents=True, exist_ok=True)
+
+    def source_path(self, folder: str, image: str):
+        source_path = self.storage.find_image(folder, image)
+        if source_path is None:
+            raise FileNotFoundError(join_path(folder, image))
+        return source_path
+
+    def cached_path(self, folder: str, image: str, rendition: str):
+        return join_path(self.CACHE_PATH, rendition, folder, image)
+
+    def get_path(self, folder: str, image: str, rendition: str):
+        """
+        Path of the rendition of a captured image, generated if needed, or the original without rendition
+        """
+        source_path = self.source_path(folder, image)
+        if rendition is None or rendition not in self.RENDITIONS:
+            return source_path
+
+        cached_path = self.cached_path(folder, image, rendition)
+        if not os.path.abspath(cached_path).startswith(os.path.abspath(self.CACHE_PATH) + os.sep):
+            raise FileNotFoundError(cached_path)
+
+        try:
+            if os.stat(cached_path).st_mtime_ns >= os.stat(source_path).st_mtime_ns:
+                # mark it as recently used
+                os.utime(cached_path)
+                return cached_path
+        except FileNotFoundError:
+            pass
+
+        self.generate(source_path, cached_path, self.RENDITIONS[rendition])
+        return cached_path
+
+    def open(self, folder: str, image: str, rendition: str):
+        return Image.open(self.get_path(folder, image, rendition))
+
+    def generate(self, source_path: str, cached_path: str, rendition: dict):
+        size = tuple(rendition.get('SIZE'))
+
+        with Image.open(source_path) as image:
+            # the JPEG decoder scales down by 1/2, 1/4 or 1/8 while decoding, much cheaper than a full decode
+            image.draft('RGB', size)
+            if rendition.get('MODE') == 'fill':
+                image = image.resize(size)
+            else:
+                image.thumbnail(size)
+
+            Path(os.path.dirname(cached_path)).mkdir(parents=True, exist_ok=True)
+            temporary_path = '{}.tmp{}'.format(cached_path, threading.get_ident())
+            image.convert('RGB').save(temporary_path, format='JPEG', quality=self.QUALITY)
+            os.replace(temporary_path, cached_path)
+
+        self.add_usage(os.stat(cached_path).st_size)
+
+    def get_usage(self):
+        used = 0
+        for root, _, files in os.walk(self.CACHE_PATH):
+            for file_name in files:
+                used += os.stat(join_path(root, file_name)).st_size
+        return used
+
+    def add_usage(self, size: int):
+        with self.lock:
+            if self.used is None:
+                self.used = self.get_usage()
+            else:
+                self.used += size
+
+            if self.used > self.DISK_BUDGET:
+                self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used renditions until the cache uses 90% of the budget
+        """
+        renditions = []
+        for root, _, files in os.walk(self.CACHE_PATH):
+            for file_name in files:
+                file_path = join_path(root, file_name)
+                try:
+                    stats = os.stat(file_path)
+                except FileNotFoundError:
+                    continue  # evicted by another process
+                renditions.append((stats.st_mtime, stats.st_size, file_path))
+
+        renditions.sort()
+        self.used = sum(size for _, size, _ in renditions)
+        target = self.DISK_BUDGET * 0.9
+
+        for _, size, file_path in renditions:
+            if self.used <= target:
+                break
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+            self.used -= size
+
+    @staticmethod
+    def image_size(image_path: str):
+        # only the header is read
+        with Image.open(image_path) as image:
+            return image.size
@@ -0,0 +1,419 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import cv2 as cv
+from datetime import datetime, timedelta
+import json
+import logging
+import numpy as np
+import os
+from os.path import join as join_path
+import shutil
+import threading
+from typing import Optional
+from PIL import Image
+from app.server.utils.database.models.alerts import Alert as AlertModel
+from app.server.utils.database.models.authorized import Authorized as AuthorizedModel, UnknownIdentity as UnknownIdentityModel
+from app.server.utils.database.models.images import Capture as CaptureModel, Analysis as AnalysisModel, Recognition as RecognitionModel
+from app.server.utils.database.models.reports import ReportSummary as ReportSummaryModel
+from app.server.utils.reports import refresh_report_summary
+from app.server.utils.storage import Storage
+from app.server.utils.storage.archive import archive_folder, find_archive
+from app.server.utils.storage.event_recorder import EventRecorder, capture_still
+
+# the retention runs in the task queue, its records go with the ones of huey
+logger = logging.getLogger('huey.retention')
+
+
+class RetentionSettings(dict):
+    MAX_AGE_DAYS: float = None
+    NO_DETECTION_AGE_HOURS: float = None
+    ARCHIVE_AGE_DAYS: float = None
+    ARCHIVE_FORMAT: str = None
+    RECOMPRESS_AGE_HOURS: float = None
+    RECOMPRESS_QUALITY: int = None
+    DISK_BUDGET: int = None
+    MIN_FREE_SPACE: int = None
+    BATCH_SIZE: int = None
+    MIN_AGE_MINUTES: float = None
+    INTERVAL: int = None
+    REPORT_FILE: str = None
+
+
+class RetentionManager:
+    """
+    Keeps the captures inside the disk limits, from the oldest folders:
+
+    - the folders without detections and the ones older than the max age are deleted, with their records
+    - the old folders are bundled in an archive, their images are extracted again when needed
+    - the images and segments not so old are recompressed at a lower quality
+
+    The captures with faces assigned to a person are never deleted, they are the gallery of the recognition.
+    """
+    RECOMPRESSED_MARKER: str = '.recompressed'
+
+    def __init__(self, storage: Storage, db, settings: Optional[RetentionSettings] = None):
+        settings = settings if settings is not None else {}
+        self.storage = storage
+        self.db = db
+        self.MAX_AGE = self.to_timedelta(days=settings.get('MAX_AGE_DAYS'))
+        self.NO_DETECTION_AGE = self.to_timedelta(hours=settings.get('NO_DETECTION_AGE_HOURS'))
+        self.ARCHIVE_AGE = self.to_timedelta(days=settings.get('ARCHIVE_AGE_DAYS'))
+        self.ARCHIVE_FORMAT = settings.get('ARCHIVE_FORMAT', 'tar')
+        self.RECOMPRESS_AGE = self.to_timedelta(hours=settings.get('RECOMPRESS_AGE_HOURS'))
+        self.RECOMPRESS_QUALITY = settings.get('RECOMPRESS_QUALITY', 60)
+        self.DISK_BUDGET = settings.get('DISK_BUDGET')
+        self.MIN_FREE_SPACE = settings.get('MIN_FREE_SPACE')
+        self.BATCH_SIZE = settings.get('BATCH_SIZE', 500)
+        # the activation being recorded already has an end, it is left alone until it is this old
+        self.MIN_AGE = timedelta(minutes=settings.get('MIN_AGE_MINUTES') or 10)
+        self.REPORT_PATH = join_path(storage.DATA_PATH, settings.get('REPORT_FILE', 'retention.json'))
+        self.freed = 0
+
+    @staticmethod
+    def to_timedelta(**value):
+        # a missing setting disables its policy
+        return timedelta(**value) if list(value.values())[0] is not None else None
+
+    @staticmethod
+    def folder_size(folder_path: str):
+        size = 0
+        for root, _, files in os.walk(folder_path):
+            for file_name in files:
+                try:
+                    size += os.stat(join_path(root, file_name)).st_size
+                except FileNotFoundError:
+                    pass
+        return size
+
+    def stored_size(self, folder: str):
+        archive_path = find_archive(self.storage, folder)
+        archive_size = os.stat(archive_path).st_size if archive_path is not None else 0
+        return self.folder_size(self.storage.folder_path(folder)) + archive_size
+
+    def get_folders(self, now: datetime):
+        # the root folder keeps the manual captures, it is left out of the retention
+        return list(ReportSummaryModel.select(
+            ReportSummaryModel.image_folder, ReportSummaryModel.detections, ReportSummaryModel.end
+        ).where(
+            (ReportSummaryModel.image_folder != '') & (ReportSummaryModel.end < now - self.MIN_AGE)
+        ).order_by(ReportSummaryModel.end).dicts())
+
+    def protected_captures(self, folder: str):
+        query = CaptureModel.select(CaptureModel.id, CaptureModel.image_file).join(
+            AnalysisModel, on=(AnalysisModel.image_id == CaptureModel.id)
+        ).join(
+            RecognitionModel, on=(RecognitionModel.analysis_id == AnalysisModel.id)
+        ).join(
+            AuthorizedModel, on=(AuthorizedModel.recognition_id == RecognitionModel.id)
+        ).where((CaptureModel.image_folder == folder) & AuthorizedModel.person.is_null(False)).distinct()
+        return {capture_id: image_file for capture_id, image_file in query.tuples()}
+
+    def delete_records(self, folder: str, protected: set):
+        """
+        Delete the records of the folder in short transactions, the server keeps writing meanwhile
+        """
+        deleted = 0
+        while True:
+            query = CaptureModel.select(CaptureModel.id).where(CaptureModel.image_folder == folder)
+            if len(protected) > 0:
+                query = query.where(CaptureModel.id.not_in(list(protected)))
+            capture_ids = [capture_id for capture_id, in query.limit(self.BATCH_SIZE).tuples()]
+            if len(capture_ids) == 0:
+                break
+
+            with self.db.atomic():
+                identity_ids = self.capture_identities(capture_ids)
+                # the alerts don't cascade, the analysis, recognitions and authorized do
+                AlertModel.delete().where(AlertModel.image.in_(capture_ids)).execute()
+                CaptureModel.delete().where(CaptureModel.id.in_(capture_ids)).execute()
+                self.refresh_identities(identity_ids)
+            deleted += len(capture_ids)
+
+        with self.db.atomic():
+            refresh_report_summary(folder)
+        return deleted
+
+    @staticmethod
+    def capture_identities(capture_ids: list):
+        # unknown identities with faces in the captures
+        query = AuthorizedModel.select(AuthorizedModel.identity).distinct().join(
+            RecognitionModel, on=(AuthorizedModel.recognition_id == RecognitionModel.id)
+        ).join(
+            AnalysisModel, on=(RecognitionModel.analysis_id == AnalysisModel.id)
+        ).where(AnalysisModel.image.in_(capture_ids) & AuthorizedModel.identity.is_null(False))
+        return [identity_id for identity_id, in query.tuples()]
+
+    @staticmethod
+    def refresh_identities(identity_ids: list):
+        """
+        Recompute the members and centroids of the identities that lost faces, the empty ones are deleted
+        """
+        for identity_id in identity_ids:
+            embeddings = [result for result, in RecognitionModel.select(RecognitionModel.result).join(
+                AuthorizedModel, on=(AuthorizedModel.recognition_id == RecognitionModel.id)
+            ).where(AuthorizedModel.identity == identity_id).tuples()]
+
+            if len(embeddings) == 0:
+                UnknownIdentityModel.delete().where(UnknownIdentityModel.id == identity_id).execute()
+                continue
+
+            # the new update date makes the clustering of the server reload the centroid
+            UnknownIdentityModel.update(
+                centroid=np.mean(np.stack(embeddings), axis=0),
+                members=len(embeddings),
+                update_date=datetime.now()
+            ).where(UnknownIdentityModel.id == identity_id).execute()
+
+    def delete_folder(self, folder: str):
+        folder_path = self.storage.folder_path(folder)
+        protected = self.protected_captures(folder)
+
+        # the images of the gallery must outlive the segments and the archive
+        for image_file in protected.values():
+            if not os.path.isfile(join_path(folder_path, image_file)):
+                capture_still(self.storage, folder, image_file)
+
+        deleted = self.delete_records(folder, set(protected.keys()))
+        freed = self.stored_size(folder)
+
+        archive_path = find_archive(self.storage, folder)
+        if archive_path is not None:
+            os.remove(archive_path)
+
+        if len(protected) == 0:
+            self.remove_directory(folder_path)
+        else:
+            kept = set(protected.values())
+            for file_name in os.listdir(folder_path):
+                if file_name not in kept:
+                    os.remove(join_path(folder_path, file_name))
+
+        freed -= self.stored_size(folder)
+        self.freed += freed
+        return {'folder': folder, 'captures': deleted, 'kept': len(protected), 'freed': freed}
+
+    def remove_directory(self, folder_path: str):
+        shutil.rmtree(folder_path, ignore_errors=True)
+
+        # the date and hour shards left empty, the writers create them again if needed
+        parent = os.path.dirname(os.path.abspath(folder_path))
+        capture_path = os.path.abspath(self.storage.CAPTURE_PATH)
+        while parent.startswith(capture_path + os.sep):
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break  # not empty
+            parent = os.path.dirname(parent)
+
+    def archive(self, folder: str):
+        folder_path = self.storage.folder_path(folder)
+        if find_archive(self.storage, folder) is not None:
+            # segments brought back from the archive to extract an image
+            for file_name in os.listdir(folder_path) if os.path.isdir(folder_path) else []:
+                if not file_name.endswith('.jpg'):
+                    os.remove(join_path(folder_path, file_name))
+            return None
+
+        if not os.path.isdir(folder_path):
+            return None
+
+        size = self.folder_size(folder_path)
+        archive_path = archive_folder(self.storage, folder, self.ARCHIVE_FORMAT)
+        self.remove_directory(folder_path)
+        freed = size - os.stat(archive_path).st_size
+        self.freed += freed
+        return {'folder': folder, 'archive': os.path.basename(archive_path), 'freed': freed}
+
+    def recompress(self, folder: str):
+        """
+        Encode again the images and segments of the folder at the lower quality, with the same size
+        since the detected boxes are stored in their coordinates
+        """
+        folder_path = self.storage.folder_path(folder)
+        marker_path = join_path(folder_path, self.RECOMPRESSED_MARKER)
+        if not os.path.isdir(folder_path) or os.path.exists(marker_path):
+            return None
+
+        freed = 0
+        for file_name in sorted(os.listdir(folder_path)):
+            file_path = join_path(folder_path, file_name)
+            # the video writer takes the container from the extension
+            root, extension = os.path.splitext(file_path)
+            temporary_path = '{}.tmp{}{}'.format(root, threading.get_ident(), extension)
+            try:
+                if file_name.endswith('.jpg'):
+                    with Image.open(file_path) as image:
+                        image.save(temporary_path, format='JPEG', quality=self.RECOMPRESS_QUALITY, optimize=True)
+                elif file_name.endswith(EventRecorder.CONTAINER_EXTENSIONS):
+                    self.recompress_segment(file_path, temporary_path)
+                else:
+                    continue
+            except (OSError, IOError) as e:
+                logger.warning('{} could not be recompressed: {}'.format(file_path, e))
+                if os.path.exists(temporary_path):
+                    os.remove(temporary_path)
+                continue
+
+            # only worth it when smaller
+            saved = os.stat(file_path).st_size - os.stat(temporary_path).st_size
+            if saved > 0:
+                os.replace(temporary_path, file_path)
+                freed += saved
+            else:
+                os.remove(temporary_path)
+
+        open(marker_path, 'w').close()
+        self.freed += freed
+        return {'folder': folder, 'freed': freed}
+
+    def recompress_segment(self, segment_path: str, temporary_path: str):
+        video = cv.VideoCapture(segment_path)
+        writer = None
+        try:
+            while True:
+                read, frame = video.read()
+                if not read:
+                    break
+                if writer is None:
+                    height, width = frame.shape[:2]
+                    writer = cv.VideoWriter(
+                        temporary_path, int(video.get(cv.CAP_PROP_FOURCC)), video.get(cv.CAP_PROP_FPS), (width, height)
+                    )
+                    if not writer.isOpened():
+                        raise IOError('the video writer could not open {}'.format(temporary_path))
+                    writer.set(cv.VIDEOWRITER_PROP_QUALITY, self.RECOMPRESS_QUALITY)
+                writer.write(frame)
+        finally:
+            video.release()
+            if writer is not None:
+                writer.release()
+
+        if writer is None:
+            raise IOError('empty segment')
+
+    def get_usage(self):
+        """
+        Bytes used by the captures and archives, and free in the disk
+        """
+        used = self.folder_size(self.storage.CAPTURE_PATH) + self.folder_size(self.storage.ARCHIVE_PATH)
+        return used, shutil.disk_usage(self.storage.DATA_PATH).free
+
+    def over_budget(self, used: int, free: int):
+        if self.MIN_FREE_SPACE is not None and free < self.MIN_FREE_SPACE:
+            return True
+        return self.DISK_BUDGET is not None and used > self.DISK_BUDGET
+
+    def run(self):
+        """
+        Apply all the policies, returns a report of the changes
+        """
+        now = datetime.now()
+        self.freed = 0
+        report = {'date': now.isoformat(), 'deleted': [], 'archived': [], 'recompressed': []}
+        folders = self.get_folders(now)
+        remaining = []
+
+        for folder in folders:
+            age = now - folder['end']
+            if (self.MAX_AGE is not None and age > self.MAX_AGE) or \
+                    (self.NO_DETECTION_AGE is not None and folder['detections'] == 0 and age > self.NO_DETECTION_AGE):
+                report['deleted'].append(self.delete_folder(folder['image_folder']))
+            else:
+                remaining.append(folder)
+
+        for folder in remaining:
+            age = now - folder['end']
+            if self.ARCHIVE_AGE is not None and age > self.ARCHIVE_AGE:
+                result = self.archive(folder['image_folder'])
+                if result is not None:
+                    report['archived'].append(result)
+            elif self.RECOMPRESS_AGE is not None and age > self.RECOMPRESS_AGE:
+                result = self.recompress(folder['image_folder'])
+                if result is not None:
+                    report['recompressed'].append(result)
+
+        # still short of space, the oldest folders go first, the usage is measured once
+        used, free = self.get_usage()
+        while len(remaining) > 0 and self.over_budget(used, free):
+            result = self.delete_folder(remaining.pop(0)['image_folder'])
+            report['deleted'].append(result)
+            used -= result['freed']
+            free += result['freed']
+
+        if self.over_budget(used, free):
+            logger.warning('still over the disk budget, no folder older than {} left to delete'.format(self.MIN_AGE))
+
+        if self.storage.DEDUPLICATE:
+            self.freed += self.storage.collect_objects()
+
+        report['freed'] = self.freed
+        report['metrics'] = get_storage_metrics(self.storage)
+        self.save_report(report)
+        return report
+
+    def save_report(self, report: dict):
+        temporary_path = '{}.tmp'.format(self.REPORT_PATH)
+        with open(temporary_path, 'w') as report_file:
+            json.dump(report, report_file)
+        os.replace(temporary_path, self.REPORT_PATH)
+
+
+def read_bytes_written():
+    """
+    Bytes written to storage by this process, from the kernel accounting
+    """
+    try:
+        with open('/proc/self/io') as io_file:
+            for line in io_file:
+                if line.startswith('write_bytes:'):
+                    return int(line.split(':')[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def read_device_bytes_written(path: str):
+    """
+    Bytes written to the block device holding the path since boot, what wears an SD card
+    """
+    try:
+        device = os.stat(path).st_dev
+        stat_path = '/sys/dev/block/{}:{}/stat'.format(os.major(device), os.minor(device))
+        with open(stat_path) as stat_file:
+            # the 7th field counts the 512 bytes sectors written
+            return int(stat_file.read().split()[6]) * 512
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def get_storage_metrics(storage: Storage):
+    usage = shutil.disk_usage(storage.DATA_PATH)
+    return {
+        'total': usage.total,
+        'used': usage.used,
+        'free': usage.free,
+        'process_bytes_written': read_bytes_written(),
+        'device_bytes_written': read_device_bytes_written(storage.DATA_PATH)
+    }
+
+
+def read_retention_report(storage: Storage, settings: Optional[RetentionSettings] = None):
+    settings = settings if settings is not None else {}
+    try:
+        with open(join_path(storage.DATA_PATH, settings.get('REPORT_FILE', 'retention.json'))) as report_file:
+            return json.load(report_file)
+    except (OSError, ValueError):
+        return None
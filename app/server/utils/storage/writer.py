@@ -0,0 +1,268 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+
+from concurrent.futures import Future
+import fcntl
+import mmap
+import os
+from os.path import join as join_path, dirname
+from queue import Queue, Empty, Full
+from threading import Thread, Lock, get_ident
+from time import monotonic
+from typing import Optional
+from sanic.log import logger
+from app.server.utils.storage import Storage
+
+
+class StorageWriterSettings(dict):
+    QUEUE_SIZE: int = None
+    QUEUE_TIMEOUT: float = None
+    BATCH_SIZE: int = None
+    BATCH_BYTES: int = None
+    BATCH_DEADLINE: float = None
+    FSYNC: str = None
+    FADVISE: str = None
+    DIRECT_IO: bool = None
+
+
+# 'none': the kernel writes back when it wants, 'file': each image is synced once written,
+# 'batch': the images queued together are written first and synced after
+FSYNC_POLICIES = ('none', 'file', 'batch')
+
+
+class StorageWriter:
+    """
+    Single thread writing the captured images, a slow card blocks this thread instead of the camera consumers.
+
+    The images queued together are written one after another and synced as a batch. The future of an image
+    gives its info once the file is in place and synced, the record of the capture is inserted after it.
+    """
+    # O_DIRECT needs the buffer, offset and size aligned to the logical block size of the device
+    DIRECT_ALIGNMENT: int = 4096
+
+    def __init__(self, storage: Storage, settings: Optional[StorageWriterSettings] = None):
+        settings = settings if settings is not None else {}
+        self.storage = storage
+        self.BATCH_SIZE = settings.get('BATCH_SIZE', 16)
+        self.BATCH_BYTES = settings.get('BATCH_BYTES', 8 * 1024 * 1024)
+        self.BATCH_DEADLINE = settings.get('BATCH_DEADLINE', 0.05)
+        self.QUEUE_TIMEOUT = settings.get('QUEUE_TIMEOUT', 1.0)
+        self.FSYNC = settings.get('FSYNC', 'batch')
+        if self.FSYNC not in FSYNC_POLICIES:
+            logger.warning('fsync policy \'{}\' does not exist, using \'batch\''.format(self.FSYNC))
+            self.FSYNC = 'batch'
+        # the captures are not read again soon, their pages are dropped from the cache once on the card
+        self.FADVISE = settings.get('FADVISE', 'dontneed') == 'dontneed' and hasattr(os, 'posix_fadvise')
+        self.DIRECT_IO = settings.get('DIRECT_IO', False) and hasattr(os, 'O_DIRECT')
+        self.queue = Queue(maxsize=settings.get('QUEUE_SIZE', 64))
+        self.thread: Optional[Thread] = None
+        self.lock = Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = Thread(target=self.run, name='storage_writer')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def submit(self, image: bytes, image_info: dict) -> Future:
+        """
+        Queue the image to be written where the storage prepared it, the future gives the image info
+        """
+        future = Future()
+        self.start()
+
+        try:
+            self.queue.put((future, image, image_info), timeout=self.QUEUE_TIMEOUT)
+        except Full:
+            future.set_exception(IOError('storage writer queue full, {} is dropped'.format(image_info.get('image'))))
+        return future
+
+    def get_batch(self):
+        # wait for the first image, then take whatever arrives until the batch is full or the deadline expires
+        batch = [self.queue.get()]
+        batch_bytes = len(batch[0][1]) if batch[0] is not None else 0
+        deadline = monotonic() + self.BATCH_DEADLINE
+
+        while len(batch) < self.BATCH_SIZE and batch_bytes < self.BATCH_BYTES and batch[-1] is not None:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except Empty:
+                break
+            if batch[-1] is not None:
+                batch_bytes += len(batch[-1][1])
+
+        return batch
+
+    def open_file(self, file_path: str):
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        if self.DIRECT_IO:
+            try:
+                return os.open(file_path, flags | os.O_DIRECT, 0o644)
+            except OSError as e:
+                # tmpfs and some FUSE file systems don't support it
+                logger.warning('O_DIRECT not supported for {}, using buffered writes: {}'.format(file_path, e))
+                self.DIRECT_IO = False
+        return os.open(file_path, flags, 0o644)
+
+    def write_direct(self, file_descriptor: int, content: bytes):
+        # an anonymous map is page aligned, the padding is cut once written
+        size = len(content)
+        aligned_size = max(-(-size // self.DIRECT_ALIGNMENT) * self.DIRECT_ALIGNMENT, self.DIRECT_ALIGNMENT)
+        buffer = mmap.mmap(-1, aligned_size)
+        try:
+            buffer.write(content)
+            os.write(file_descriptor, buffer)
+        finally:
+            buffer.close()
+        os.ftruncate(file_descriptor, size)
+
+    def write_content(self, file_descriptor: int, content: bytes):
+        if self.DIRECT_IO:
+            try:
+                self.write_direct(file_descriptor, content)
+                return
+            except OSError as e:
+                logger.warning('O_DIRECT write failed, using buffered writes: {}'.format(e))
+                self.DIRECT_IO = False
+                flags = fcntl.fcntl(file_descriptor, fcntl.F_GETFL)
+                fcntl.fcntl(file_descriptor, fcntl.F_SETFL, flags & ~os.O_DIRECT)
+                os.lseek(file_descriptor, 0, os.SEEK_SET)
+                os.ftruncate(file_descriptor, 0)
+
+        view = memoryview(content)
+        while len(view) > 0:
+            view = view[os.write(file_descriptor, view):]
+
+    @staticmethod
+    def sync(file_descriptor: int):
+        # the metadata besides the size is not needed to read the image back
+        getattr(os, 'fdatasync', os.fsync)(file_descriptor)
+
+    def write(self, image: bytes, image_info: dict):
+        """
+        Write the image to a temporary file, returns its descriptor, temporary and final paths
+        """
+        folder_name = image_info.get('folder')
+        file_name = image_info.get('image')
+        directory = self.storage.folder_path(folder_name, file_name)
+        self.storage.make_directory(directory)
+        image_path = join_path(directory, file_name)
+
+        if self.storage.DEDUPLICATE:
+            # linked to the stored object by the storage, it is only synced here
+            self.storage.write_image(image, image_info)
+            return os.open(image_path, os.O_RDONLY), None, image_path
+
+        temporary_path = '{}.tmp{}'.format(image_path, get_ident())
+        try:
+            file_descriptor = self.open_file(temporary_path)
+        except FileNotFoundError:
+            # the directory was removed by the retention
+            self.storage.forget_directory(directory)
+            self.storage.make_directory(directory)
+            file_descriptor = self.open_file(temporary_path)
+
+        try:
+            self.write_content(file_descriptor, image)
+            if self.FSYNC == 'file':
+                self.sync(file_descriptor)
+        except Exception:
+            os.close(file_descriptor)
+            os.remove(temporary_path)
+            raise
+        return file_descriptor, temporary_path, image_path
+
+    def complete(self, file_descriptor: int, temporary_path: Optional[str], image_path: str):
+        try:
+            if self.FSYNC == 'batch':
+                self.sync(file_descriptor)
+            if self.FADVISE:
+                os.posix_fadvise(file_descriptor, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(file_descriptor)
+
+        if temporary_path is not None:
+            os.replace(temporary_path, image_path)
+
+    @staticmethod
+    def sync_directory(directory: str):
+        # the renames are durable once their directory is synced
+        directory_descriptor = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_descriptor)
+        finally:
+            os.close(directory_descriptor)
+
+    def write_batch(self, batch: list):
+        written = []
+        for future, image, image_info in batch:
+            try:
+                written.append((future, image_info, self.write(image, image_info)))
+            except Exception as e:
+                logger.error('storage writer failed writing {}: {}'.format(image_info.get('image'), e))
+                future.set_exception(e)
+
+        # the writes of the batch reach the card before any of them is waited on
+        completed = []
+        for future, image_info, (file_descriptor, temporary_path, image_path) in written:
+            try:
+                self.complete(file_descriptor, temporary_path, image_path)
+                completed.append((future, image_info, dirname(image_path)))
+            except Exception as e:
+                logger.error('storage writer failed syncing {}: {}'.format(image_info.get('image'), e))
+                if temporary_path is not None and os.path.exists(temporary_path):
+                    os.remove(temporary_path)
+                future.set_exception(e)
+
+        if self.FSYNC != 'none':
+            for directory in {directory for _, _, directory in completed}:
+                try:
+                    self.sync_directory(directory)
+                except OSError as e:
+                    logger.error('storage writer failed syncing {}: {}'.format(directory, e))
+
+        # the images are reported only once they are durable
+        for future, image_info, _ in completed:
+            future.set_result(image_info)
+
+    def run(self):
+        running = True
+
+        while running:
+            # 'None' asks the writer to stop
+            batch = self.get_batch()
+            if batch[-1] is None:
+                running = False
+                batch.pop()
+
+            if len(batch) > 0:
+                self.write_batch(batch)
+
+    def stop(self):
+        """
+        Write the queued images and stop the thread
+        """
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+
+        if thread is not None and thread.is_alive():
+            self.queue.put(None)
+            thread.join()
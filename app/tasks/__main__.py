@@ -21,6 +21,9 @@ from pathlib import Path
 from app.server.utils.database import db_setup
 from config import develop as dev_env, production as prod_env
 from .alerts import register_alert_tasks
+from .clustering import register_clustering_tasks
+from .database import register_database_tasks
+from .retention import register_retention_tasks
 
 
 environment = os.environ.get('task_queue_environment')
@@ -46,6 +49,9 @@ class TaskQueue(SqliteHuey):
 task_queue = TaskQueue(config)
 app_db = db_setup(config)
 register_alert_tasks(task_queue, config, app_db)
+register_clustering_tasks(task_queue, config, app_db)
+register_database_tasks(task_queue, config, app_db)
+register_retention_tasks(task_queue, config, app_db)
 
 
 def task_run():
@@ -14,13 +14,17 @@
 
 
 from datetime import datetime
+from functools import partial
 from huey import crontab
 from io import BytesIO
+import logging
 import math
-from os.path import join as join_path
 from PIL import Image
 from app.server.utils.database.models.alerts import Alert as AlertModel
 from app.server.utils.alerts.email import send_mail
+from app.server.utils.storage import Storage
+from app.server.utils.storage.event_recorder import capture_still
+from app.server.utils.storage.image_cache import DerivedImageCache
 
 
 MAX_IMAGE_COLLAGE_COLUMNS = 3
@@ -28,8 +32,14 @@ MAX_IMAGE_COLLAGE_ROWS = 5
 IMAGE_COLLAGE_WIDTH = 600
 IMAGE_COLLAGE_HEIGHT = 500
 
+logger = logging.getLogger('huey.alerts')
+
 
 def register_alert_tasks(task_queue, app_cfg, app_db):
+    storage = Storage(app_cfg.get('STORAGE_SETTINGS'))
+    storage.missing_image = partial(capture_still, storage)
+    image_cache = DerivedImageCache(storage, app_cfg.get('IMAGE_CACHE_SETTINGS'))
+
     @task_queue.periodic_task(crontab(minute='*/1'), name='alert')
     def send_alerts_task():
         with app_db:
@@ -45,18 +55,21 @@ def register_alert_tasks(task_queue, app_cfg, app_db):
                 image_folders.append(image_folder)
 
                 if image_count < (MAX_IMAGE_COLLAGE_COLUMNS * MAX_IMAGE_COLLAGE_ROWS):
-                    image = Image.open(join_path(
-                        app_cfg.get('STORAGE_SETTINGS').get('DATA_FOLDER'),
-                        app_cfg.get('STORAGE_SETTINGS').get('CAPTURE_FOLDER'),
-                        alert.image.image_folder,
-                        alert.image.image_file
-                    ))
-                    images.append(image.resize((IMAGE_COLLAGE_WIDTH, IMAGE_COLLAGE_HEIGHT)))
+                    # the collage rendition is generated once and reused while the alert is pending
+                    try:
+                        image = image_cache.open(alert.image.image_folder, alert.image.image_file, 'collage')
+                    except OSError as e:
+                        # a frame of a segment that was never closed has no still, the alert goes without it
+                        logger.warning('alert image {} skipped: {}'.format(alert.image.image_file, e))
+                        continue
+                    if image.size != (IMAGE_COLLAGE_WIDTH, IMAGE_COLLAGE_HEIGHT):
+                        image = image.resize((IMAGE_COLLAGE_WIDTH, IMAGE_COLLAGE_HEIGHT))
+                    images.append(image)
                 else:
                     break
                 image_count += 1
 
-            if image_count > 0:
+            if len(image_folders) > 0:
                 image_count = 0
                 image_length = len(images)
                 collage_columns = image_length if image_length < MAX_IMAGE_COLLAGE_COLUMNS else MAX_IMAGE_COLLAGE_COLUMNS
@@ -73,9 +86,11 @@ def register_alert_tasks(task_queue, app_cfg, app_db):
                             collage.paste(images[image_count], (j, i))
                             image_count += 1
 
-                collage_image = BytesIO()
-                collage.save(collage_image, format='JPEG')
-                collage_image.seek(0)
+                collage_image = None
+                if image_length > 0:
+                    collage_image = BytesIO()
+                    collage.save(collage_image, format='JPEG')
+                    collage_image.seek(0)
 
                 email_body = {
                     'TEXT': 'Security Alerts\nReports:\n{0}',
@@ -0,0 +1,27 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from huey import crontab
+from app.server.utils.image_analysis.clustering import recluster_unknown_faces
+
+
+def register_clustering_tasks(task_queue, app_cfg, app_db):
+    recognition_settings = app_cfg.get('RECOGNITION_SETTINGS')
+
+    @task_queue.periodic_task(crontab(minute='0', hour=str(recognition_settings.get('RECLUSTER_HOUR', 3))), name='recluster_unknown')
+    def recluster_unknown_task():
+        with app_db:
+            identities = recluster_unknown_faces(app_db, recognition_settings.get('CLUSTER_DISTANCE_THRESHOLD', 0.799))
+            print('unknown faces grouped in {} identities'.format(identities))
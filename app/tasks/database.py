@@ -0,0 +1,30 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from app.server.utils.database import db_maintenance
+from .schedules import every_minutes
+
+
+def register_database_tasks(task_queue, app_cfg, app_db):
+    database_settings = app_cfg.get('DATABASE_SETTINGS', {})
+    interval = database_settings.get('MAINTENANCE_INTERVAL', 30)
+
+    @task_queue.periodic_task(every_minutes(interval), name='database_maintenance')
+    def database_maintenance_task():
+        # the pragmas can't run inside a transaction
+        with app_db.connection_context():
+            result = db_maintenance(app_db)
+            if result.get('busy'):
+                print('the WAL could not be truncated, a reader or writer was active')
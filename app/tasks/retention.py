@@ -0,0 +1,34 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from app.server.utils.storage import Storage
+from app.server.utils.storage.retention import RetentionManager
+from .schedules import every_minutes
+
+
+def register_retention_tasks(task_queue, app_cfg, app_db):
+    retention_settings = app_cfg.get('RETENTION_SETTINGS', {})
+    interval = retention_settings.get('INTERVAL', 30)
+    retention_manager = RetentionManager(Storage(app_cfg.get('STORAGE_SETTINGS')), app_db, retention_settings)
+
+    @task_queue.periodic_task(every_minutes(interval), name='retention')
+    @task_queue.lock_task('retention')
+    def retention_task():
+        # a long run is not started again by the next schedule
+        with app_db:
+            report = retention_manager.run()
+            print('retention: {} folders deleted, {} archived, {} recompressed, {} bytes freed'.format(
+                len(report['deleted']), len(report['archived']), len(report['recompressed']), report['freed']
+            ))
@@ -0,0 +1,29 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+def every_minutes(minutes: int):
+    """
+    Periodic task schedule repeating every number of minutes, crontab(minute='*/n') is only
+    even for the divisors of 60: '*/45' runs at :00 and :45, '*/90' once an hour
+    """
+    minutes = int(minutes)
+    if minutes < 1:
+        raise ValueError('the interval must be at least one minute, not {}'.format(minutes))
+
+    def validate_datetime(timestamp):
+        # minutes since the epoch, the spacing is kept across hours and days
+        return int(timestamp.timestamp() // 60) % minutes == 0
+
+    return validate_datetime
@@ -14,7 +14,42 @@ CAMERA_SETTINGS = {
     'DEVICES_PATH': '/sys/class/video4linux',
     'PREFERRED_DEVICE': 0,
     'DEVICE_BUFFER': 1,
-    'DEVICE_AVOID_GRAB': 3
+    'DEVICE_AVOID_GRAB': 3,
+    'FRAME_BUFFER_SIZE': 32,
+    # [width, height] asked to the device, it can give the nearest one supported
+    'CAPTURE_RESOLUTION': [1280, 960],
+    # max [width, height] of the copy of every frame analysed, the detection model takes 300x300 anyway
+    'ANALYSIS_RESOLUTION': [640, 480],
+    # 'opencv', 'pillow', 'simplejpeg' or 'turbojpeg', opencv when the library is not installed
+    'ENCODER': 'opencv',
+    # degrees clockwise: 0, 90, 180 or 270
+    'ROTATION': 180,
+    # 'device' turns the image on the sensor through v4l2-ctl and saves a copy of every frame,
+    # 'copy' rotates every frame, also used when the device can't rotate
+    'ROTATION_METHOD': 'device',
+    # quality and max size [width, height] of the JPEG images, 'STORAGE' for the captures, 'STREAM' for the live stream,
+    # the detected boxes are saved in the coordinates of the stored captures
+    'ENCODING': {
+        'STORAGE': {'QUALITY': 85, 'SIZE': None},
+        'STREAM': {'QUALITY': 70, 'SIZE': [640, 480]}
+    }
+}
+
+# live stream
+STREAM_SETTINGS = {
+    # max frames per second sent, every viewer can ask for less
+    'FRAMES_PER_SECOND': 8,
+    # seconds the boxes of the last analysis stay over the stream
+    'OVERLAY_TIMEOUT': 2.0,
+    'MAX_VIEWERS': 8
+}
+
+# blocking work of the http endpoints, out of the server loop
+ENDPOINT_SETTINGS = {
+    # threads, requests running or waiting for a thread, seconds before answering with an error
+    'CAPTURE': {'WORKERS': 1, 'CONCURRENCY': 2, 'TIMEOUT': 30},
+    'TEST_IMAGE': {'WORKERS': 1, 'CONCURRENCY': 2, 'TIMEOUT': 30},
+    'REPORTS': {'WORKERS': 4, 'CONCURRENCY': 16, 'TIMEOUT': 10}
 }
 
 # storage
@@ -22,7 +57,178 @@ STORAGE_SETTINGS = {
     'DATA_FOLDER': 'data',
     # relatives to 'DATA_FOLDER'
     'CAPTURE_FOLDER': 'captured_images',
-    'ML_MODEL_FOLDER': 'ml_models'
+    'ML_MODEL_FOLDER': 'ml_models',
+    'ARCHIVE_FOLDER': 'archived_captures',
+    # strftime of the date and hour directories the capture folders are sharded into
+    'SHARD_FORMAT': '%Y/%m/%d/%H',
+    # identical frames are stored once and hardlinked, by the hash of their content
+    'DEDUPLICATE': False
+}
+# the captured images are written by a single thread, a slow card doesn't stall the camera consumers
+STORAGE_WRITER_SETTINGS = {
+    # images waiting to be written, a capture waits up to 'QUEUE_TIMEOUT' seconds when it is full
+    'QUEUE_SIZE': 64,
+    'QUEUE_TIMEOUT': 1.0,
+    # images written together before they are synced, waiting up to 'BATCH_DEADLINE' seconds
+    'BATCH_SIZE': 16,
+    'BATCH_BYTES': 8 * 1024 * 1024,
+    'BATCH_DEADLINE': 0.05,
+    # 'none', 'file' or 'batch', the records of the captures are inserted once their images are synced
+    'FSYNC': 'batch',
+    # 'dontneed' drops the written images from the page cache, None keeps them
+    'FADVISE': 'dontneed',
+    # O_DIRECT writes skip the page cache, it falls back to buffered writes where unsupported
+    'DIRECT_IO': False
+}
+
+# the frames of each sensor activation are recorded as video segments instead of a JPEG image per frame,
+# the frames with detections are also kept as images
+EVENT_RECORDER_SETTINGS = {
+    'ENABLED': True,
+    # fourcc and container given to cv.VideoWriter, MJPEG can seek to any frame
+    'CODEC': 'MJPG',
+    'CONTAINER': '.avi',
+    'QUALITY': 85,
+    # a segment can be read once closed
+    'SEGMENT_FRAMES': 240
+}
+
+# retention of the capture folders, a missing value disables its policy
+RETENTION_SETTINGS = {
+    # minutes between runs of the retention task
+    'INTERVAL': 30,
+    # folders deleted with their records, but the faces assigned to a person
+    'MAX_AGE_DAYS': 90,
+    'NO_DETECTION_AGE_HOURS': 24,
+    # folders bundled in a single file, 'tar' or 'zip'
+    'ARCHIVE_AGE_DAYS': 7,
+    'ARCHIVE_FORMAT': 'tar',
+    # images and segments encoded again at a lower quality
+    'RECOMPRESS_AGE_HOURS': 48,
+    'RECOMPRESS_QUALITY': 60,
+    # bytes, the oldest folders are deleted while the captures and archives use more or the disk has less free
+    'DISK_BUDGET': 8 * 1024 * 1024 * 1024,
+    'MIN_FREE_SPACE': 512 * 1024 * 1024,
+    # captures deleted per transaction
+    'BATCH_SIZE': 500,
+    # folders that ended more recently are never touched, the last one can still be recording
+    'MIN_AGE_MINUTES': 10,
+    # relative to 'DATA_FOLDER', result of the last run
+    'REPORT_FILE': 'retention.json'
+}
+
+# smaller renditions of the captures for the reports and the alert collages
+IMAGE_CACHE_SETTINGS = {
+    # relative to 'DATA_FOLDER'
+    'CACHE_FOLDER': 'image_cache',
+    # bytes, the least recently used renditions are removed over it
+    'DISK_BUDGET': 256 * 1024 * 1024,
+    'QUALITY': 80,
+    # 'fit' keeps the aspect ratio inside the size, 'fill' takes exactly the size
+    'RENDITIONS': {
+        'thumbnail': {'SIZE': [480, 360], 'MODE': 'fit'},
+        'collage': {'SIZE': [600, 500], 'MODE': 'fill'}
+    }
+}
+
+# database
+DATABASE_SETTINGS = {
+    # 'safe': every commit is synced to disk, 'balanced': the WAL is synced on checkpoints, a power loss
+    # can lose the last commits but never corrupts the db, 'throughput': no syncs, for tests and benchmarks
+    'PROFILE': 'balanced',
+    'PROFILES': {
+        'safe': {
+            'synchronous': 'full',
+            'secure_delete': 1,
+            'journal_size_limit': -1,
+            'cache_size': -2000,
+            'mmap_size': 0,
+            'temp_store': 'default',
+            'wal_autocheckpoint': 1000
+        },
+        'balanced': {
+            'synchronous': 'normal',
+            'secure_delete': 0,
+            'journal_size_limit': 64 * 1024 * 1024,
+            'cache_size': -16000,
+            'mmap_size': 64 * 1024 * 1024,
+            'temp_store': 'memory',
+            'wal_autocheckpoint': 1000
+        },
+        'throughput': {
+            'synchronous': 'off',
+            'secure_delete': 0,
+            'journal_size_limit': 256 * 1024 * 1024,
+            'cache_size': -64000,
+            'mmap_size': 256 * 1024 * 1024,
+            'temp_store': 'memory',
+            'wal_autocheckpoint': 10000
+        }
+    },
+    # minutes between 'PRAGMA optimize' and the WAL truncation, from the task queue
+    'MAINTENANCE_INTERVAL': 30
+}
+DATABASE_WRITER_SETTINGS = {
+    # records committed together in a single transaction, waiting up to 'BATCH_DEADLINE' seconds
+    'BATCH_SIZE': 64,
+    'BATCH_DEADLINE': 0.1,
+    'QUEUE_SIZE': 1024
+}
+
+# image analysis
+ANALYSIS_SETTINGS = {
+    'WORKERS': 2,
+    # 'thread': enough for the TFLite stages, 'process': also runs the MTCNN and PIL stages in parallel,
+    # each process keeps its own face index and unknown identities, they see the faces added by the
+    # others only when they sync from the database, up to 5 seconds later
+    'BACKEND': 'thread',
+    # images waiting per worker, captures wait up to 'QUEUE_TIMEOUT' seconds when it is full
+    'QUEUE_SIZE': 32,
+    'QUEUE_TIMEOUT': 1.0,
+    # seconds to finish the queued images when the server stops
+    'DRAIN_TIMEOUT': 30,
+    # max images analysed together in a single inference
+    'BATCH_SIZE': 8,
+    # seconds to wait for more images before running an incomplete batch
+    'BATCH_DEADLINE': 0.05,
+    # frames changing less than this (0 to 1) from the last analysed one are stored but not analysed
+    'CHANGE_THRESHOLD': 0.02,
+    # analyse a frame at least after skipping this many
+    'CHANGE_MAX_SKIPPED': 16,
+    # margin added around each person box before searching faces in it, relative to the box size
+    'FACE_SEARCH_PADDING': 0.15
+}
+
+# face recognition
+RECOGNITION_SETTINGS = {
+    # max distance between two embeddings of the same face
+    'DISTANCE_THRESHOLD': 0.799,
+    # 'exact': scan all the embeddings, 'ivf': approximate search for large galleries
+    'INDEX_TYPE': 'exact',
+    # relative to 'DATA_FOLDER'
+    'INDEX_FILE': 'embedding_index.npz',
+    'IVF_LISTS': 64,
+    'IVF_PROBES': 8,
+    'IVF_MIN_TRAIN_SIZE': 1024,
+    # unknown faces closer than this to an anonymous identity are grouped with it
+    'CLUSTER_DISTANCE_THRESHOLD': 0.799,
+    # daily hour of the batch re-clustering of the unknown faces
+    'RECLUSTER_HOUR': 3
+}
+
+# persons followed across the frames of a capture, their faces are recognized once instead of on every frame
+TRACKING_SETTINGS = {
+    'ENABLED': True,
+    # min overlap (0 to 1) between a detected person and the predicted box of a track
+    'IOU_THRESHOLD': 0.3,
+    # frames a track survives without detections
+    'MAX_MISSES': 8,
+    # frames between searches of a better face for the tracks already recognized
+    'FACE_CHECK_INTERVAL': 8,
+    # a face is recognized again when its quality is this many times the last one
+    'FACE_QUALITY_GAIN': 1.25,
+    # seconds without frames before the tracks of a capture are forgotten
+    'TRACKER_TIMEOUT': 60
 }
 
 # alerts
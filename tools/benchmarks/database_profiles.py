@@ -0,0 +1,86 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Captures per second written under each database profile, one transaction per capture and through the writer.
+# usage: python tools/benchmarks/database_profiles.py [--captures 2000] [--folder /tmp]
+# on disks with cheap syncs the single transactions win, the writer pays off where each fsync is slow (SD cards)
+
+import argparse
+import os
+import sys
+import tempfile
+from datetime import datetime
+from time import perf_counter
+from peewee import SqliteDatabase
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from config.base import DATABASE_SETTINGS, DATABASE_WRITER_SETTINGS
+from app.server.utils.database import get_pragmas
+from app.server.utils.database.models.images import Capture
+from app.server.utils.database.writer import DatabaseWriter
+
+
+def insert_capture(number):
+    return Capture.insert(
+        image_file='capture_{}.jpg'.format(number),
+        image_folder='benchmark',
+        datetime=datetime.now()
+    ).execute()
+
+
+def single_transactions(db, captures):
+    start = perf_counter()
+    for number in range(captures):
+        insert_capture(number)
+    return captures / (perf_counter() - start)
+
+
+def database_writer(db, captures):
+    writer = DatabaseWriter(db, DATABASE_WRITER_SETTINGS)
+    start = perf_counter()
+    futures = [writer.submit(insert_capture, number) for number in range(captures)]
+    for future in futures:
+        future.result()
+    elapsed = perf_counter() - start
+    writer.stop()
+    return captures / elapsed
+
+
+def run():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument('--captures', type=int, default=2000)
+    # the results depend on the disk, use a folder in the same device as the data folder
+    argument_parser.add_argument('--folder', type=str, default=None)
+    argument_parser.add_argument('--profiles', type=str, nargs='+', default=list(DATABASE_SETTINGS.get('PROFILES')))
+    args = argument_parser.parse_args()
+
+    print('{:<16}{:>20}{:>20}'.format('profile', 'single captures/s', 'writer captures/s'))
+
+    for profile in args.profiles:
+        settings = {**DATABASE_SETTINGS, 'PROFILE': profile}
+        results = []
+
+        for method in [single_transactions, database_writer]:
+            with tempfile.TemporaryDirectory(dir=args.folder) as folder:
+                db = SqliteDatabase(os.path.join(folder, 'benchmark.db'), pragmas=get_pragmas(settings))
+                db.bind([Capture])
+                Capture.create_table()
+                results.append(method(db, args.captures))
+                db.close()
+
+        print('{:<16}{:>20.0f}{:>20.0f}'.format(profile, *results))
+
+
+if __name__ == '__main__':
+    run()
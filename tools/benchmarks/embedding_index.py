@@ -0,0 +1,83 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+# Recall and latency of the approximate embedding index against the exact scan.
+# usage: python tools/benchmarks/embedding_index.py [--size 50000] [--queries 500]
+
+import argparse
+import os
+import sys
+from time import perf_counter
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from app.server.utils.image_analysis.embedding_index import EmbeddingIndex, IVFEmbeddingIndex
+
+
+def gallery(size, dimensions, identities, generator):
+    # faces of the same person are close to each other, like the MobileFaceNet embeddings
+    centers = generator.normal(size=(identities, dimensions)).astype(np.float32)
+    members = generator.integers(0, identities, size)
+    return centers[members] + generator.normal(scale=0.3, size=(size, dimensions)).astype(np.float32)
+
+
+def measure(index, queries):
+    results = []
+    start = perf_counter()
+    for query in queries:
+        results.append(index.nearest(query)[0])
+    elapsed = (perf_counter() - start) / len(queries)
+    return results, elapsed * 1000
+
+
+def run():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument('--size', type=int, default=50000)
+    argument_parser.add_argument('--dimensions', type=int, default=128)
+    argument_parser.add_argument('--queries', type=int, default=500)
+    argument_parser.add_argument('--lists', type=int, nargs='+', default=[64, 256])
+    argument_parser.add_argument('--probes', type=int, nargs='+', default=[1, 4, 8, 16])
+    args = argument_parser.parse_args()
+
+    generator = np.random.default_rng(0)
+    embeddings = gallery(args.size, args.dimensions, args.size // 10, generator)
+    ids = list(range(1, args.size + 1))
+    persons = [None] * args.size
+    queries = embeddings[generator.choice(args.size, args.queries, replace=False)]
+    queries = queries + generator.normal(scale=0.1, size=queries.shape).astype(np.float32)
+
+    exact_index = EmbeddingIndex()
+    exact_index.add_many(ids, persons, embeddings)
+    expected, exact_latency = measure(exact_index, queries)
+    print('{:<24}{:>12}{:>14}'.format('index', 'recall@1', 'ms/query'))
+    print('{:<24}{:>12.3f}{:>14.3f}'.format('exact', 1, exact_latency))
+
+    for lists in args.lists:
+        ivf_index = IVFEmbeddingIndex(lists=lists)
+        ivf_index.add_many(ids, persons, embeddings)
+        start = perf_counter()
+        ivf_index.train()
+        train_time = perf_counter() - start
+
+        for probes in args.probes:
+            ivf_index.PROBES = probes
+            found, latency = measure(ivf_index, queries)
+            recall = np.mean(np.array(found) == np.array(expected))
+            print('{:<24}{:>12.3f}{:>14.3f}'.format('ivf {}/{}'.format(lists, probes), recall, latency))
+        print('  (ivf {} lists trained in {:.2f}s)'.format(lists, train_time))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,94 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Latency of the report pages while other clients keep asking for captures, against a running server.
+# usage: python tools/benchmarks/http_load.py [--server http://localhost:8000] [--capture-clients 2] [--seconds 30]
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from time import perf_counter, sleep
+from urllib.error import URLError, HTTPError
+from urllib.request import urlopen
+import numpy as np
+
+
+def request(url, timeout):
+    start = perf_counter()
+    try:
+        with urlopen(url, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except HTTPError as e:
+        status = e.code
+    except (URLError, OSError):
+        status = None
+    return status, perf_counter() - start
+
+
+def keep_requesting(url, timeout, stop_event, results):
+    while not stop_event.is_set():
+        results.append(request(url, timeout))
+
+
+def summary(name, results):
+    latencies = np.array([elapsed for status, elapsed in results if status == 200]) * 1000
+    errors = len([status for status, elapsed in results if status != 200])
+    if len(latencies) == 0:
+        print('{:<24}{:>10}{:>10}{:>12}{:>12}{:>12}'.format(name, 0, errors, '-', '-', '-'))
+        return
+    print('{:<24}{:>10}{:>10}{:>12.1f}{:>12.1f}{:>12.1f}'.format(
+        name, len(latencies), errors, np.percentile(latencies, 50), np.percentile(latencies, 95), latencies.max()
+    ))
+
+
+def measure(args, capture_clients):
+    stop_event = Event()
+    capture_results, report_results, detail_results = [], [], []
+
+    with ThreadPoolExecutor(max_workers=capture_clients + args.report_clients * 2) as executor:
+        for _ in range(capture_clients):
+            executor.submit(keep_requesting, args.server + '/capture', args.timeout, stop_event, capture_results)
+        for _ in range(args.report_clients):
+            executor.submit(keep_requesting, args.server + '/reports/', args.timeout, stop_event, report_results)
+            executor.submit(keep_requesting, args.server + '/reports/ungrouped', args.timeout, stop_event, detail_results)
+        sleep(args.seconds)
+        stop_event.set()
+
+    return capture_results, report_results, detail_results
+
+
+def run():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument('--server', type=str, default='http://localhost:8000')
+    argument_parser.add_argument('--capture-clients', type=int, default=2)
+    argument_parser.add_argument('--report-clients', type=int, default=4)
+    argument_parser.add_argument('--seconds', type=float, default=30)
+    argument_parser.add_argument('--timeout', type=float, default=60)
+    args = argument_parser.parse_args()
+
+    print('{:<24}{:>10}{:>10}{:>12}{:>12}{:>12}'.format('endpoint', 'requests', 'errors', 'p50 ms', 'p95 ms', 'max ms'))
+
+    # reports alone first, then with the captures running
+    for capture_clients in [0, args.capture_clients]:
+        capture_results, report_results, detail_results = measure(args, capture_clients)
+        label = 'with {} capturing'.format(capture_clients) if capture_clients > 0 else 'idle'
+        if capture_clients > 0:
+            summary('/capture ({})'.format(label), capture_results)
+        summary('/reports/ ({})'.format(label), report_results)
+        summary('/reports/<group> ({})'.format(label), detail_results)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,90 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+# Cost and size of the JPEG encoding of a frame for every encoder, quality and size.
+# usage: python tools/benchmarks/jpeg_encoding.py [--image capture.jpg] [--frames 50]
+
+import argparse
+import os
+import sys
+from time import perf_counter
+import cv2 as cv
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from app.server.utils.camera import Camera
+from app.server.utils.camera.jpeg_encoders import JPEG_ENCODERS
+
+
+def synthetic_frame(width, height, generator):
+    # smooth areas, edges and sensor noise, random pixels alone would not compress like a capture
+    frame = np.zeros((height, width, 3), dtype=np.uint8)
+    frame[:] = np.linspace(40, 200, width, dtype=np.uint8)[None, :, None]
+    for _ in range(40):
+        x, y = generator.integers(0, width), generator.integers(0, height)
+        color = tuple(int(c) for c in generator.integers(0, 255, 3))
+        cv.rectangle(frame, (int(x), int(y)), (int(x) + 120, int(y) + 80), color, -1)
+    noise = generator.normal(scale=4, size=frame.shape)
+    return np.clip(frame + noise, 0, 255).astype(np.uint8)
+
+
+def measure(function, frames):
+    result = function()
+    start = perf_counter()
+    for _ in range(frames):
+        result = function()
+    return (perf_counter() - start) / frames * 1000, result
+
+
+def run():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument('--image', help='captured image used as frame, synthetic when missing')
+    argument_parser.add_argument('--width', type=int, default=1280)
+    argument_parser.add_argument('--height', type=int, default=960)
+    argument_parser.add_argument('--frames', type=int, default=50)
+    argument_parser.add_argument('--encoders', nargs='+', default=list(JPEG_ENCODERS.keys()))
+    argument_parser.add_argument('--qualities', type=int, nargs='+', default=[85, 70, 50])
+    argument_parser.add_argument('--sizes', nargs='+', default=['full', '640x480', '320x240'])
+    args = argument_parser.parse_args()
+
+    if args.image:
+        frame = cv.imread(args.image, cv.IMREAD_COLOR)
+    else:
+        frame = synthetic_frame(args.width, args.height, np.random.default_rng(0))
+    print('frame {}x{}'.format(frame.shape[1], frame.shape[0]))
+
+    # what the capture thread pays for every frame when the device can't rotate
+    destination = np.empty_like(frame)
+    rotate_latency, _ = measure(lambda: cv.rotate(frame, cv.ROTATE_180, destination), args.frames)
+    copy_latency, _ = measure(lambda: np.copyto(destination, frame), args.frames)
+    print('rotation copy {:.2f} ms/frame, plain copy {:.2f} ms/frame\n'.format(rotate_latency, copy_latency))
+
+    print('{:<12}{:>9}{:>10}{:>12}{:>14}'.format('encoder', 'quality', 'size', 'ms/frame', 'bytes/frame'))
+    for name in args.encoders:
+        encoder_class = JPEG_ENCODERS.get(name)
+        if encoder_class is None or not encoder_class.available():
+            print('{:<12}{:>45}'.format(name, 'not installed'))
+            continue
+        encoder = encoder_class()
+
+        for size in args.sizes:
+            fit_size = None if size == 'full' else [int(value) for value in size.split('x')]
+            for quality in args.qualities:
+                latency, image = measure(lambda: encoder.encode(Camera.fit_frame(frame, fit_size), quality), args.frames)
+                print('{:<12}{:>9}{:>10}{:>12.2f}{:>14}'.format(name, quality, size, latency, len(image)))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,75 @@
+#   Copyright 2020 Jesus Jerez <https://jerez.link>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+# Latency seen by the capture consumer and throughput of the storage writer for every sync policy.
+# usage: python tools/benchmarks/storage_writer.py --data-folder /media/sdcard/bench [--frames 200]
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+from time import perf_counter, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from app.server.utils.storage import Storage
+from app.server.utils.storage.writer import StorageWriter, FSYNC_POLICIES
+
+
+def run():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument('--data-folder', help='folder on the card to measure, a temporary one when missing')
+    argument_parser.add_argument('--frames', type=int, default=200)
+    argument_parser.add_argument('--image-size', type=int, default=120 * 1024)
+    argument_parser.add_argument('--policies', nargs='+', default=list(FSYNC_POLICIES))
+    args = argument_parser.parse_args()
+
+    data_folder = tempfile.mkdtemp(dir=args.data_folder)
+    image = os.urandom(args.image_size)
+    print('{} frames of {} bytes in {}\n'.format(args.frames, args.image_size, data_folder))
+    print('{:<8}{:>8}{:>10}{:>16}{:>14}'.format('fsync', 'direct', 'fadvise', 'submit ms/frame', 'frames/s'))
+
+    try:
+        for policy in args.policies:
+            for direct_io in (False, True):
+                for fadvise in ('dontneed', None):
+                    storage = Storage({'DATA_FOLDER': data_folder, 'CAPTURE_FOLDER': policy, 'ML_MODEL_FOLDER': ''})
+                    writer = StorageWriter(storage, {
+                        'FSYNC': policy, 'DIRECT_IO': direct_io, 'FADVISE': fadvise, 'QUEUE_SIZE': args.frames
+                    })
+                    folder = '{}_benchmark'.format(int(time()))
+
+                    start = perf_counter()
+                    futures = [
+                        writer.submit(image, storage.prepare_image(folder, 'capture_{}'.format(number), '.jpg'))
+                        for number in range(args.frames)
+                    ]
+                    submitted = perf_counter()
+                    for future in futures:
+                        future.result()
+                    finished = perf_counter()
+                    writer.stop()
+
+                    print('{:<8}{:>8}{:>10}{:>16.3f}{:>14.1f}'.format(
+                        policy, str(writer.DIRECT_IO), str(fadvise),
+                        (submitted - start) / args.frames * 1000, args.frames / (finished - start)
+                    ))
+                    shutil.rmtree(storage.CAPTURE_PATH, ignore_errors=True)
+    finally:
+        shutil.rmtree(data_folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    run()